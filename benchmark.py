@@ -0,0 +1,581 @@
+import gc
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+from esil import EsilExpressionTree, EsilNodeTable, EsilPatternSet, parse_cache, parse_esil
+from esil_analysis import Analysis
+from esil_corpus import X86_64_CORPUS, EsilGenerator
+from esil_dataflow import AccessCatcher, FunctionDataflow
+from esil_eval import EsilMachine
+from esil_profile import profiler
+from esil_simplify import EsilSimplifier, simplify_esil
+from esil_store import EsilStore
+from esil_vector import evaluate, np
+from esil_z3 import default_solver, z3
+from driver import analyze_binary
+from example import IOPnuke, Radare2SimpleApi, UnusedStackNuke, _blocks_from_graph
+from r2async import analyze_binaries
+from r2replay import RecordedR2
+
+def synthetic_expression(count):
+    ''' unrolled stack stores/compares, roughly what obfuscated functions look like '''
+    items = list()
+    for i in range(count):
+        items.append(f'{i:#x},0x{(i % 64) * 8:x},rbp,-,=[8],'
+                     f'0x{(i % 64) * 8:x},rbp,-,[8],{i:#x},==,$z,zf,:=')
+    return ','.join(items)
+
+def bench_parse(sizes=(100, 1000, 10000, 50000), repeat=3):
+    for size in sizes:
+        expr = synthetic_expression(size)
+        tokens = expr.count(',') + 1
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            EsilExpressionTree(expr)
+            best = min(best, time.perf_counter() - start)
+        print(f'parse {tokens:>9} tokens {len(expr):>10} bytes '
+              f'{best * 1000:10.2f} ms {tokens / best:14,.0f} tokens/s')
+
+class _DictNode:
+    ''' the node layout before __slots__, kept around for comparison '''
+    def __init__(self, cmd, op1=None, op2=None):
+        self.cmd = cmd
+        self.op1 = op1
+        self.op2 = op2
+
+class _DictNodeTree(EsilExpressionTree):
+    node_class = _DictNode
+
+def _count_nodes(root):
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node is not None:
+            count += 1
+            stack.append(node.op1)
+            stack.append(node.op2)
+    return count
+
+def bench_memory(copies=500):
+    for name, tree_class in (('__dict__', _DictNodeTree), ('__slots__', EsilExpressionTree)):
+        for expr in X86_64_CORPUS:
+            tree_class(expr)
+
+        tracemalloc.start()
+        roots = [tree_class(expr).root for _ in range(copies) for expr in X86_64_CORPUS]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        nodes = sum(_count_nodes(root) for root in roots)
+        print(f'memory {name:>10} {nodes:>8} nodes {size / nodes:8.1f} bytes/node')
+
+def bench_hash(copies=200, repeat=3):
+    ''' memory write addresses used as dict keys, like the passes in example.py do '''
+    for name, node_table in (('plain', None), ('hash-consed', EsilNodeTable())):
+        writes = [address
+                  for _ in range(copies) for expr in X86_64_CORPUS
+                  for address in EsilExpressionTree(expr, node_table=node_table)
+                                 .analyses.memory_write_catcher.mem_writes]
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            seen = dict()
+            for address in writes:
+                seen[address] = seen.get(address, 0) + 1
+            best = min(best, time.perf_counter() - start)
+        print(f'hash {name:>12} {len(writes):>8} keys {len(seen):>4} distinct '
+              f'{len(writes) / best:14,.0f} lookups/s')
+
+def bench_search(count=200, copies=50):
+    patterns = ([f'any,0x{i * 4:x},rbp,-,=[4]' for i in range(count // 2)] +
+                [f'0x{i * 4:x},rbp,-,[4],any,==' for i in range(count // 2)])
+    trees = [EsilExpressionTree(expr) for _ in range(copies) for expr in X86_64_CORPUS]
+
+    start = time.perf_counter()
+    for tree in trees:
+        for pattern in patterns:
+            tree.search(pattern)
+    elapsed = time.perf_counter() - start
+    print(f'search {"one by one":>12} {len(patterns):>4} patterns '
+          f'{len(trees) / elapsed:14,.0f} trees/s')
+
+    pattern_set = EsilPatternSet(patterns)
+    trees = [EsilExpressionTree(expr) for _ in range(copies) for expr in X86_64_CORPUS]
+    start = time.perf_counter()
+    for tree in trees:
+        tree.search_all(pattern_set)
+    elapsed = time.perf_counter() - start
+    print(f'search {"pattern set":>12} {len(patterns):>4} patterns '
+          f'{len(trees) / elapsed:14,.0f} trees/s')
+
+def obfuscate(expr, seed=0):
+    ''' the same instruction with every integer k turned into (k + j) - j '''
+    out = list()
+    for i, token in enumerate(expr.split(',')):
+        if token.isdigit() or token.startswith('0x'):
+            j = (seed + i) * 0x11 + 1
+            out.append(f'{j},0x{int(token, 0) + j:x},-')
+        else:
+            out.append(token)
+    return ','.join(out)
+
+def bench_simplify(copies=50):
+    patterns = EsilPatternSet(['0,0x4,rbp,-,=[4]', '0,0x4,rbp,-,[4],==', 'zf,?{,any,rip,=,}'])
+    exprs = [obfuscate(expr, seed) for seed in range(copies) for expr in X86_64_CORPUS]
+    simplifier = EsilSimplifier()
+
+    start = time.perf_counter()
+    found = sum(1 for expr in exprs for match in EsilExpressionTree(expr).search_all(patterns)
+                if match is not None)
+    elapsed = time.perf_counter() - start
+    print(f'simplify {"obfuscated":>10} {len(exprs):>6} trees {elapsed * 1000:10.2f} ms '
+          f'{found:>6} matches')
+
+    start = time.perf_counter()
+    found = 0
+    for expr in exprs:
+        result = simplifier.simplify_tree(EsilExpressionTree(expr))
+        found += sum(1 for match in EsilExpressionTree(str(result.root)).search_all(patterns)
+                     if match is not None)
+    elapsed = time.perf_counter() - start
+    info = simplifier.info()
+    print(f'simplify {"simplified":>10} {len(exprs):>6} trees {elapsed * 1000:10.2f} ms '
+          f'{found:>6} matches, {info.before} -> {info.after} nodes, '
+          f'{info.elapsed * 1000:.2f} ms rewriting, {info.rewrites} rewrites')
+
+def bench_cache(copies=500):
+    exprs = X86_64_CORPUS * copies
+    for name, parse in (('uncached', EsilExpressionTree), ('cached', parse_esil)):
+        parse_cache.clear()
+        start = time.perf_counter()
+        for expr in exprs:
+            parse(expr)
+        elapsed = time.perf_counter() - start
+        print(f'cache {name:>13} {len(exprs) / elapsed:14,.0f} instructions/s {parse_cache.info}')
+
+class _Subscribed(Analysis):
+    operators = frozenset({'%=[4]'})
+
+    def node_pass(self, node):
+        pass
+
+class _CatchAll(Analysis):
+    def node_pass(self, node):
+        if node.cmd in _Subscribed.operators:
+            pass
+
+def bench_dispatch(analyses=40, copies=200):
+    exprs = X86_64_CORPUS * copies
+    for name, analysis_class in (('catch-all', _CatchAll), ('subscribed', _Subscribed)):
+        external = {f'analysis_{i}': analysis_class() for i in range(analyses)}
+        start = time.perf_counter()
+        for expr in exprs:
+            EsilExpressionTree(expr, external)
+        elapsed = time.perf_counter() - start
+        print(f'dispatch {name:>10} {analyses:>4} analyses {len(exprs) / elapsed:14,.0f} instructions/s')
+
+# add rax, 1; add rbx, rax; dec rcx; jne 0x1000
+EMULATED_LOOP = {
+    0x1000: (4, '1,rax,+=,63,$o,of,:=,63,$s,sf,:=,$z,zf,:=,63,$c,cf,:=,$p,pf,:='),
+    0x1004: (3, 'rax,rbx,+=,63,$o,of,:=,63,$s,sf,:=,$z,zf,:=,63,$c,cf,:=,$p,pf,:='),
+    0x1007: (4, '1,rcx,-=,63,$o,of,:=,63,$s,sf,:=,$z,zf,:=,$p,pf,:='),
+    0x100b: (2, 'zf,!,?{,0x1000,rip,=,}'),
+}
+
+def bench_emulate(iterations=50000):
+    vm = EsilMachine({'rip': 0x1000, 'rcx': iterations})
+    start = time.perf_counter()
+    executed = vm.emulate(EMULATED_LOOP, iterations * 4 + 1)
+    elapsed = time.perf_counter() - start
+    assert vm.get_register('rbx') == iterations * (iterations + 1) // 2
+    print(f'emulate {executed:>10} instructions {elapsed * 1000:10.2f} ms '
+          f'{executed / elapsed:14,.0f} instructions/s')
+
+def _time(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def bench_vector(lanes=(1, 100, 10000), repeat=3):
+    if np is None:
+        print('vector skipped, numpy is not installed')
+        return
+    expr = X86_64_CORPUS[6]
+    for count in lanes:
+        registers = {'rax': np.arange(count, dtype=np.uint64), 'rbp': 0x1000}
+        best = min(_time(lambda: evaluate(expr, registers, lanes=count)) for _ in range(repeat))
+        scalar = _time(lambda: [EsilMachine({'rax': i, 'rbp': 0x1000}).execute(expr)
+                                for i in range(min(count, 1000))]) * count / min(count, 1000)
+        print(f'vector {count:>10} lanes {best * 1000:10.2f} ms '
+              f'scalar {scalar * 1000:10.2f} ms {scalar / best:8.1f}x')
+
+def synthetic_function(addr, blocks=16, instrs=12):
+    ''' agfj-style json for a function built from the x86-64 corpus '''
+    graph_blocks = list()
+    offset = addr
+    for b in range(blocks):
+        ops = list()
+        for i in range(instrs):
+            expr = X86_64_CORPUS[(b * instrs + i) % len(X86_64_CORPUS)]
+            ops.append({'offset': offset, 'esil': expr, 'size': 4})
+            offset += 4
+        graph_blocks.append({'offset': ops[0]['offset'], 'size': offset - ops[0]['offset'],
+                             'jump': offset, 'ops': ops})
+    return [{'name': f'fcn.{addr:08x}', 'offset': addr, 'blocks': graph_blocks}]
+
+# opaque predicates, x*(x+1) is even and a freshly stored stack slot is known
+OPAQUE_BLOCKS = [
+    ['rax,rax,*,rax,+,1,&,rbx,=', '0,rbx,==,$z,zf,:=,64,$b,cf,:=', 'zf,!,?{,0x401234,rip,=,}'],
+    ['0,0x4,rbp,-,=[4]', X86_64_CORPUS[8], 'zf,?{,0x401150,rip,=,}'],
+    ['rsp,rbp,=', X86_64_CORPUS[11], 'zf,!,?{,4535882,rip,=,}'],
+]
+
+def bench_z3(functions=50):
+    if z3 is None:
+        print('z3 skipped, z3-solver is not installed')
+        return
+    responses = dict()
+    addrs = [0x401000 + n * 0x1000 for n in range(functions)]
+    for addr in addrs:
+        offset = addr
+        blocks = list()
+        for exprs in OPAQUE_BLOCKS:
+            ops = list()
+            for expr in exprs:
+                ops.append({'offset': offset, 'esil': expr, 'size': 4})
+                offset += 4
+            blocks.append({'offset': ops[0]['offset'], 'size': 4 * len(ops), 'ops': ops})
+        responses[f'agfj @{addr}'] = json.dumps([{'offset': addr, 'blocks': blocks}])
+    logging.getLogger('iopnuke').setLevel(logging.WARNING)
+
+    solver = default_solver()
+    for label in ('uncached', 'cached'):
+        solver.clear()
+        api = Radare2SimpleApi(RecordedR2(responses))
+        patches = solver_calls = 0
+        start = time.perf_counter()
+        for addr in addrs:
+            if label == 'uncached':
+                solver_calls += solver.info().solver_calls
+                solver.clear()
+            iop = IOPnuke(api, addr)
+            iop.run(apply=False)
+            patches += len(iop.patches)
+        elapsed = time.perf_counter() - start
+        solver_calls += solver.info().solver_calls
+        print(f'z3 {label:>15} {functions:>6} functions {elapsed * 1000:10.2f} ms '
+              f'{patches:>6} patches {solver_calls:>6} solver calls')
+
+def bench_dataflow(blocks=400):
+    bbs = _blocks_from_graph(synthetic_function(0x401000, blocks))
+    start = time.perf_counter()
+    dataflow = FunctionDataflow(bbs)
+    elapsed = time.perf_counter() - start
+    print(f'dataflow {"full":>12} {blocks:>6} blocks {elapsed * 1000:10.2f} ms '
+          f'{dataflow.visits:>8} block visits')
+
+    # a store in the last few blocks only reaches and is only seen by a few
+    offset = bbs[-3].instrs[4]['offset']
+    visits = dataflow.visits
+    start = time.perf_counter()
+    dataflow.nop(offset)
+    elapsed = time.perf_counter() - start
+    print(f'dataflow {"incremental":>12} {blocks:>6} blocks {elapsed * 1000:10.2f} ms '
+          f'{dataflow.visits - visits:>8} block visits')
+
+def bench_r2(functions=20):
+    responses = dict()
+    for n in range(functions):
+        addr = 0x401000 + n * 0x1000
+        graph = synthetic_function(addr)
+        responses[f'agfj @{addr}'] = json.dumps(graph)
+        responses[f'abj @{addr}'] = json.dumps([{'addr': block['offset'], 'size': block['size']}
+                                                 for block in graph[0]['blocks']])
+        for block in graph[0]['blocks']:
+            responses[f'pdbj @{block["offset"]}'] = json.dumps(block['ops'])
+    addrs = [0x401000 + n * 0x1000 for n in range(functions)]
+    logging.getLogger('iopnuke').setLevel(logging.WARNING)
+
+    r2 = RecordedR2(responses)
+    start = time.perf_counter()
+    for addr in addrs:
+        api = Radare2SimpleApi(r2)
+        for _ in range(2):
+            for bb in api.get_fcn_bbs(addr):
+                api.get_bb_instrs(bb['addr'])
+    elapsed = time.perf_counter() - start
+    print(f'r2 {"abj+pdbj":>15} {len(r2.commands):>6} round trips {elapsed * 1000:10.2f} ms')
+
+    r2 = RecordedR2(responses)
+    api = Radare2SimpleApi(r2)
+    start = time.perf_counter()
+    for addr in addrs:
+        IOPnuke(api, addr).run()
+        UnusedStackNuke(api, addr).run()
+    elapsed = time.perf_counter() - start
+    print(f'r2 {"agfj + passes":>15} {len(r2.commands):>6} round trips {elapsed * 1000:10.2f} ms '
+          f'{functions / elapsed:10,.0f} functions/s')
+
+def bench_store(functions=50):
+    ''' cold (empty store) and warm (stored results) runs over the same
+    binary, in-process caches are dropped before each run '''
+    graphs = [synthetic_function(0x401000 + n * 0x1000, instrs=8) for n in range(functions)]
+    # distinct instructions per function, like a real binary
+    for n, graph in enumerate(graphs):
+        for block in graph[0]['blocks']:
+            for op in block['ops']:
+                op['esil'] = obfuscate(op['esil'], seed=op['offset'])
+    responses = {'agfj @@F': '\n'.join(map(json.dumps, graphs)),
+                 'itj': json.dumps({'sha256': 'synthetic'})}
+    exprs = [(graph[0]['offset'], op['esil']) for graph in graphs
+             for block in graph[0]['blocks'] for op in block['ops']]
+    logging.getLogger('iopnuke').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for label in ('cold', 'warm'):
+            parse_cache.clear()
+            simplify_esil.cache_clear()
+            start = time.perf_counter()
+            analyze_binary(RecordedR2(responses), workers=1, apply=False, cache_dir=directory)
+            elapsed = time.perf_counter() - start
+            print(f'store {label:>14} {functions:>6} functions {elapsed * 1000:10.2f} ms')
+
+        store = EsilStore.for_binary(directory, {'sha256': 'synthetic'})
+        start = time.perf_counter()
+        for addr, expr in exprs:
+            EsilExpressionTree(expr, {'access_catcher': AccessCatcher()})
+        parsed = time.perf_counter() - start
+        start = time.perf_counter()
+        for addr, expr in exprs:
+            store.get_analysis(expr, AccessCatcher, addr=addr)
+        loaded = time.perf_counter() - start
+        size = os.path.getsize(store.path)
+        store.close()
+    print(f'store {"parse":>14} {len(exprs):>6} accesses  {parsed * 1000:10.2f} ms')
+    print(f'store {"load":>14} {len(exprs):>6} accesses  {loaded * 1000:10.2f} ms '
+          f'{size / 1024:8.1f} KiB on disk')
+
+def bench_profile(copies=200):
+    ''' the same parses with the profiler off, on, and off again '''
+    exprs = [obfuscate(expr, seed) for seed in range(copies) for expr in X86_64_CORPUS]
+    for label in ('off', 'on', 'off again'):
+        if label == 'on':
+            profiler.clear()
+            profiler.enable()
+        start = time.perf_counter()
+        for expr in exprs:
+            EsilExpressionTree(expr).search('zf')
+        elapsed = time.perf_counter() - start
+        profiler.disable()
+        print(f'profile {label:>13} {len(exprs):>6} trees {elapsed * 1000:10.2f} ms')
+    print('\n'.join(f'profile {entry.name:>30} {entry.calls:>9} calls {entry.seconds * 1000:10.2f} ms'
+                     for entry in profiler.report()))
+
+def bench_async(delay=0.02, corpus=None):
+    ''' the recorded corpus through fake_r2 answering every agfj after delay
+    seconds, one function at a time and pipelined '''
+    corpus = corpus or CORPUS_PATH
+    fake = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_r2.py')
+    argv = lambda binary: (sys.executable, fake, '--delay', f'agfj @={delay}', binary)
+    logging.getLogger('iopnuke').setLevel(logging.WARNING)
+    for sessions, in_flight in ((1, 1), (1, 8), (2, 8)):
+        parse_cache.clear()
+        simplify_esil.cache_clear()
+        if z3 is not None:
+            default_solver().clear()
+        start = time.perf_counter()
+        results = asyncio.run(analyze_binaries([corpus], sessions_per_binary=sessions,
+                                               max_functions=in_flight, apply=False, argv=argv))
+        elapsed = time.perf_counter() - start
+        print(f'async {sessions:>2} sessions {in_flight:>2} in flight {len(results[corpus]):>4} functions '
+              f'{elapsed * 1000:10.2f} ms')
+
+# a recorded session over a generated binary, see esil_corpus.record
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'corpus', 'synthetic_x86_64.json')
+
+Measurement = namedtuple('Measurement', 'name unit items seconds peak')
+
+def measure(name, unit, items, fn, repeat=3, setup=None, trace=True):
+    ''' best of repeat timed runs, then one more under tracemalloc for the
+    peak memory (0 without trace), setup runs untimed before each. The
+    collector is off while timing, like timeit, its pauses are most of the
+    noise otherwise, and the time is the process's CPU time, so whatever
+    else the machine runs meanwhile isn't counted. '''
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.process_time()
+            fn()
+            best = min(best, time.process_time() - start)
+        finally:
+            gc.enable()
+    peak = 0
+    if trace:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return Measurement(name, unit, items, best, peak)
+
+def _tokens(exprs):
+    return sum(expr.count(',') + 1 for expr in exprs)
+
+def _iopnuke(r2):
+    api = Radare2SimpleApi(r2)
+    addrs = [fcn['offset'] for fcn in api.get_fcns()]
+    instrs = sum(len(bb.instrs) for addr in addrs for bb in api.get_fcn(addr))
+
+    def setup():
+        parse_cache.clear()
+        simplify_esil.cache_clear()
+        if z3 is not None:
+            default_solver().clear()
+
+    def run():
+        for addr in addrs:
+            IOPnuke(api, addr).run(apply=False)
+    return instrs, run, setup
+
+def suite(seed=0, repeat=3, corpus=CORPUS_PATH, rounds=3):
+    ''' Measurement list over generated ESIL and the recorded corpus. The
+    benchmarks run one after the other, rounds times over, and each keeps
+    its best round: a slow phase of the machine then costs one round of
+    every benchmark instead of all repeats of one of them. '''
+    logging.getLogger('iopnuke').setLevel(logging.WARNING)
+    generator = EsilGenerator(seed)
+    instructions = generator.generate(5000)
+    nested = [generator.nested(64) for _ in range(200)]
+    unrolled = [generator.unrolled(256) for _ in range(20)]
+    benchmarks = list()
+
+    for name, exprs in (('parse', instructions), ('parse nested', nested),
+                        ('parse unrolled', unrolled)):
+        benchmarks.append((name, 'tokens', _tokens(exprs),
+                           lambda exprs=exprs: [EsilExpressionTree(expr) for expr in exprs], None))
+
+    trees = [EsilExpressionTree(expr) for expr in instructions]
+    copies = [EsilExpressionTree(expr) for expr in instructions]
+    benchmarks.append(('eq', 'trees', len(trees),
+                       lambda: [a == b for a, b in zip(trees, copies)], None))
+    benchmarks.append(('hash', 'trees', len(trees),
+                       lambda: len({tree.root for tree in trees + copies}), None))
+
+    patterns = EsilPatternSet(['zf,?{,any,rip,=,}', 'zf,!,?{,any,rip,=,}', 'any,any,==',
+                               'any,0x4,rbp,-,=[4]', 'any,any,rbp,-,[8]', '1,any,+=[4]'])
+    benchmarks.append(('search', 'trees', len(trees),
+                       lambda: [tree.search_all(patterns) for tree in trees], None))
+
+    external = {f'subscribed_{i}': _Subscribed() for i in range(32)}
+    external.update((f'catch_all_{i}', _CatchAll()) for i in range(4))
+    benchmarks.append(('dispatch', 'tokens', _tokens(instructions),
+                       lambda: [EsilExpressionTree(expr, external) for expr in instructions],
+                       None))
+
+    if os.path.exists(corpus):
+        instrs, run, setup = _iopnuke(RecordedR2.load(corpus))
+        benchmarks.append(('iopnuke', 'instructions', instrs, run, setup))
+
+    results = dict()
+    for i in range(rounds):
+        for name, unit, items, fn, setup in benchmarks:
+            # the peak doesn't depend on the machine's mood, measured once
+            result = measure(name, unit, items, fn, repeat, setup, trace=not i)
+            best = results.get(name)
+            if best is None or result.seconds < best.seconds:
+                results[name] = result._replace(peak=best.peak) if best else result
+    return list(results.values())
+
+def print_suite(results, baseline=None, tolerance=0.15):
+    ''' throughput and peak memory, against baseline when given. Returns
+    the names of the benchmarks more than tolerance slower or bigger than it. '''
+    reference = baseline['results'] if baseline else dict()
+    regressed = list()
+    for result in results:
+        rate = result.items / result.seconds
+        line = (f'{result.name:>16} {rate:14,.0f} {result.unit}/s '
+                f'{result.peak / 1024:10,.0f} KiB peak')
+        previous = reference.get(result.name)
+        if previous is not None:
+            previous_rate = previous['items'] / previous['seconds']
+            change = rate / previous_rate - 1
+            memory = result.peak / previous['peak'] - 1 if previous['peak'] else 0.0
+            line += f' {change:+8.1%} throughput {memory:+8.1%} memory'
+            if change < -tolerance:
+                line += ' SLOWER'
+            elif change > tolerance:
+                line += ' faster'
+            if memory > tolerance:
+                line += ' BIGGER'
+            if change < -tolerance or memory > tolerance:
+                regressed.append(result.name)
+        print(line)
+    return regressed
+
+def save_baseline(path, results, seed=0):
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                   'seed': seed,
+                   'results': {result.name: result._asdict() for result in results}},
+                  f, indent=2)
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['suite']:
+        # python benchmark.py suite [--save baseline.json] [--compare baseline.json]
+        import argparse
+
+        parser = argparse.ArgumentParser(prog='benchmark.py suite')
+        parser.add_argument('--save', help='write the results as a baseline')
+        parser.add_argument('--compare', help='baseline to compare against')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--rounds', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--tolerance', type=float, default=0.15)
+        args = parser.parse_args(sys.argv[2:])
+
+        baseline = load_baseline(args.compare) if args.compare else None
+        if baseline is not None and baseline['seed'] != args.seed:
+            print(f'baseline was measured with seed {baseline["seed"]}')
+        results = suite(args.seed, args.repeat, rounds=args.rounds)
+        regressed = print_suite(results, baseline, args.tolerance)
+        if args.save:
+            save_baseline(args.save, results, args.seed)
+        sys.exit(1 if regressed else 0)
+    elif len(sys.argv) > 1:
+        bench_parse([int(size) for size in sys.argv[1:]])
+    else:
+        bench_parse()
+        bench_memory()
+        bench_hash()
+        bench_search()
+        bench_cache()
+        bench_simplify()
+        bench_dispatch()
+        bench_r2()
+        bench_dataflow()
+        bench_store()
+        bench_profile()
+        bench_async()
+        bench_emulate()
+        bench_vector()
+        bench_z3()
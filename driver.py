@@ -0,0 +1,149 @@
+import logging
+import os
+import sys
+import time
+import traceback
+from collections import namedtuple
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import esil_profile
+from esil_store import EsilStore, attached
+from example import BasicBlock, IOPnuke, Radare2SimpleApi, UnusedStackNuke, _as_api
+
+logger = logging.getLogger('driver')
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+FunctionResult = namedtuple('FunctionResult', 'addr predicates patches elapsed error')
+
+default_passes = (IOPnuke, UnusedStackNuke)
+
+def analyze_function(addr, blocks, passes=default_passes, store=None):
+    ''' runs the passes on plain (info, instrs) block data, no r2 needed.
+    Simplified ESIL and dataflow results come from store, when given, and
+    new ones are added to it. '''
+    start = time.perf_counter()
+    predicates = list()
+    patches = list()
+    try:
+        api = Radare2SimpleApi(None)
+        api.preload(addr, [BasicBlock(info, instrs) for info, instrs in blocks])
+        with attached(store) if store is not None else nullcontext(), \
+                store.function(addr) if store is not None else nullcontext(), \
+                esil_profile.function(addr):
+            for pass_class in passes:
+                analysis = pass_class(api, addr)
+                analysis.run(apply=False)
+                predicates += analysis.predicates
+                patches += analysis.patches
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return FunctionResult(addr, predicates, patches, time.perf_counter() - start, error)
+
+def _analyze_chunk(chunk, passes, store_path=None, profile=False):
+    ''' results, the records the chunk added to the store and what the
+    profiler measured. Workers only read the store file, the parent
+    writes it. '''
+    profiler = esil_profile.profiler
+    if profile:
+        # a pool worker runs many chunks, each one ships only its own numbers
+        profiler.clear()
+        profiler.enable()
+    store = EsilStore(store_path) if store_path is not None else None
+    try:
+        results = [analyze_function(addr, blocks, passes, store) for addr, blocks in chunk]
+        return (results, store.pending() if store is not None else dict(),
+                profiler.state() if profile else None)
+    finally:
+        if profile:
+            profiler.disable()
+        if store is not None:
+            store.close()
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def analyze_binary(r2, passes=default_passes, workers=None, chunk_size=16, apply=True,
+                   cache_dir=None, profile=False):
+    ''' analyzes every function in a process pool, patches are applied in
+    one batch once all workers are done. With cache_dir, simplified ESIL and
+    dataflow results are kept on disk per binary (see esil_store) and
+    reused by later runs.
+    With profile, what the workers measured ends up in esil_profile.profiler. '''
+    api = _as_api(r2)
+    payload = [(addr, [(bb.info, bb.instrs) for bb in bbs])
+               for addr, bbs in api.load_all_fcns().items()]
+    store = EsilStore.for_binary(cache_dir, api.get_hashes()) if cache_dir else None
+    store_path = store.path if store is not None else None
+
+    results = list()
+    records = dict()
+    if workers == 1:
+        # measured straight into this process' profiler
+        profiler = esil_profile.profiler
+        enable = profile and not profiler.enabled
+        if enable:
+            profiler.enable()
+        try:
+            for chunk in _chunks(payload, chunk_size):
+                chunk_results, chunk_records, _ = _analyze_chunk(chunk, passes, store_path)
+                results += chunk_results
+                records.update(chunk_records)
+        finally:
+            if enable:
+                profiler.disable()
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_analyze_chunk, chunk, passes, store_path, profile)
+                       for chunk in _chunks(payload, chunk_size)]
+            for future in as_completed(futures):
+                chunk_results, chunk_records, measured = future.result()
+                results += chunk_results
+                records.update(chunk_records)
+                if measured is not None:
+                    esil_profile.profiler.merge(measured)
+    results.sort(key=lambda result: result.addr)
+    if store is not None:
+        store.merge(records)
+        store.save()
+        store.close()
+
+    patches = sorted({patch for result in results for patch in result.patches},
+                     key=lambda patch: patch[1])
+    if apply and patches:
+        api.apply_patches(patches)
+    return results
+
+def report(results, top=10):
+    total = sum(result.elapsed for result in results)
+    logger.info(f'{len(results)} functions, {total:.3f}s cpu, '
+                f'{sum(len(result.predicates) for result in results)} predicates, '
+                f'{sum(len(result.patches) for result in results)} patches')
+    for result in sorted(results, key=lambda result: result.elapsed, reverse=True)[:top]:
+        logger.info(f'0x{result.addr:x} {result.elapsed * 1000:8.2f} ms '
+                    f'{len(result.predicates)} predicates {len(result.patches)} patches')
+    for result in results:
+        if result.error:
+            logger.error(f'0x{result.addr:x} failed:\n{result.error}')
+
+if __name__ == '__main__':
+    import r2pipe
+
+    r2 = r2pipe.open()
+    r2.cmd('e io.cache=True')
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    cache_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    # folded stacks go there, the per-function report to the log
+    profile_path = os.environ.get('ESIL_PROFILE')
+
+    start = time.perf_counter()
+    results = analyze_binary(r2, workers=workers, cache_dir=cache_dir,
+                             profile=profile_path is not None)
+    report(results)
+    logger.info(f'wall time {time.perf_counter() - start:.3f}s with {workers} workers')
+    if profile_path is not None:
+        logger.info(esil_profile.profiler.format_report())
+        esil_profile.profiler.dump(profile_path)
@@ -1,6 +1,9 @@
 import logging
-from collections import namedtuple
+import sys
+from collections import namedtuple, OrderedDict
 from contextlib import suppress
+from functools import lru_cache
+from threading import Lock
 from esil_analysis import AnalysisEngine
 
 logger = logging.getLogger('esil')
@@ -165,85 +168,232 @@ cmp dword [rbp - 4], 0; 0,0x4,rbp,-,[4],==,$z,zf,:=,32,$b,cf,:=,$p,pf,:=,31,$s,s
 jne 0x45364a          ; zf,!,?{,4535882,rip,=,}
 '''
 
+def tokenize(expr):
+    start = 0
+    find = expr.find
+    while True:
+        end = find(',', start)
+        if end < 0:
+            yield expr[start:]
+            return
+        yield expr[start:end]
+        start = end + 1
+
+EsilToken = namedtuple('EsilToken', 'cmd opcode kind pop_count value internal_name')
+
+TOKEN_OPERATOR, TOKEN_INTEGER, TOKEN_VARIABLE = range(3)
+
+# integers all share one opcode and are matched by value, operators and
+# variables count up from 0
+OPCODE_INTEGER = -1
+
+_tokens = dict()
+_tokens_lock = Lock()
+# integer literals are as many as a trace has addresses and immediates, so
+# they aren't interned but cached apart, and the cache is dropped when full
+_integers = dict()
+integer_cache_size = 1 << 16
+
+def _classify(cmd, opcode):
+    operator = esil_operators.get(cmd)
+    if operator:
+        return EsilToken(cmd, opcode, TOKEN_OPERATOR,
+                         operator.pop_count, None, operator.internal_name)
+    with suppress(ValueError):
+        value = int(cmd, 16) if cmd.startswith('0x') else int(cmd, 10)
+        return EsilToken(cmd, OPCODE_INTEGER, TOKEN_INTEGER, 0, value, None)
+    return EsilToken(cmd, opcode, TOKEN_VARIABLE, 0, None, None)
+
+def intern_token(cmd: str) -> EsilToken:
+    token = _tokens.get(cmd) or _integers.get(cmd)
+    if token is None:
+        with _tokens_lock:
+            token = _tokens.get(cmd) or _integers.get(cmd)
+            if token is None:
+                token = _classify(cmd, len(_tokens))
+                if token.kind == TOKEN_INTEGER:
+                    if len(_integers) >= integer_cache_size:
+                        _integers.clear()
+                    _integers[cmd] = token
+                else:
+                    cmd = sys.intern(cmd)
+                    token = _tokens[cmd] = token._replace(cmd=cmd)
+    return token
+
+# operators get the first, dense opcodes
+for _cmd in esil_operators:
+    intern_token(_cmd)
+
 class EsilCommand:
+    __slots__ = ('token',)
+
     def __init__(self, cmd: str):
-        self.cmd = cmd
+        self.token = intern_token(cmd)
+
+    @property
+    def cmd(self) -> str:
+        return self.token.cmd
+
+    @property
+    def opcode(self) -> int:
+        return self.token.opcode
 
     @property
     def is_operator(self) -> bool:
-        return self.cmd in esil_operators
+        return self.token.kind == TOKEN_OPERATOR
 
     @property
     def pop_count(self) -> int:
-        return esil_operators[self.cmd].pop_count
+        return self.token.pop_count
 
     @property
     def is_integer(self) -> bool:
-        with suppress(ValueError):
-            if self.cmd.startswith('0x'):
-                return isinstance(int(self.cmd, 16), int)
-            return isinstance(int(self.cmd, 10), int)
-        return False
+        return self.token.kind == TOKEN_INTEGER
+
+    @property
+    def value(self) -> int:
+        return self.token.value
 
     @property
     def is_variable(self) -> bool:
-        return not (self.is_operator or self.is_integer)
+        return self.token.kind == TOKEN_VARIABLE
 
     @property
     def is_sequence(self) -> bool:
-        return self.cmd == 'seq'
+        return self.token.cmd == 'seq'
 
     @property
     def is_wildcard(self) -> bool:
-        return self.cmd == 'any'
+        return self.token.cmd == 'any'
 
     @property
     def internal_name(self) -> str:
-        return esil_operators[self.cmd].internal_name
+        return self.token.internal_name
 
 class EsilExpressionTreeNode(EsilCommand):
+    __slots__ = ('op1', 'op2', '_hash', '_wild')
+
     def __init__(self, cmd: str, op1=None, op2=None):
         super(EsilExpressionTreeNode, self).__init__(cmd)
         self.op1 = op1
         self.op2 = op2
+        # the structural hash is only computed when something asks for it,
+        # most nodes are never hashed or compared
+        self._hash = None
+        self._wild = (self.token.cmd == 'any'
+                      or (op1 is not None and op1._wild)
+                      or (op2 is not None and op2._wild))
 
     def __repr__(self):
-        if self.is_sequence:
-            return f'{self.op2},{self.op1}'
-        elif self.is_wildcard:
-            return f'any'
-        elif not self.is_operator or self.pop_count == 0:
-            return f'{self.cmd}'
-        elif self.pop_count == 1:
-            return f'{self.op1},{self.cmd}'
-        elif self.pop_count == 2:
-            return f'{self.op2},{self.op1},{self.cmd}'
-        else:
-            return 'UNKNOWN'
+        # iterative, seq chains of long expressions are thousands deep
+        out = list()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, EsilExpressionTreeNode):
+                out.append(str(node))
+                continue
+            token = node.token
+            if token.cmd == 'seq':
+                stack += (node.op1, node.op2)
+            elif token.pop_count == 0:
+                out.append(token.cmd)
+            elif token.pop_count == 1:
+                stack += (token.cmd, node.op1)
+            elif token.pop_count == 2:
+                stack += (token.cmd, node.op1, node.op2)
+            else:
+                out.append('UNKNOWN')
+        return ','.join(out)
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if isinstance(other, EsilExpressionTreeNode):
-            if self.is_wildcard or other.is_wildcard:
-                return True
-            elif self.is_leaf and other.is_leaf:
-                return self.cmd == other.cmd
-            return (self.cmd == other.cmd
-                    and self.op1 == other.op1
-                    and self.op2 == other.op2)
+            # iterative, seq chains of long expressions are thousands deep
+            stack = [(self, other)]
+            while stack:
+                a, b = stack.pop()
+                if a is b:
+                    continue
+                elif a is None or b is None:
+                    return False
+                elif a.is_wildcard or b.is_wildcard:
+                    continue
+                elif not (a._wild or b._wild) and hash(a) != hash(b):
+                    return False
+                elif a.is_leaf and b.is_leaf:
+                    if not (a.token is b.token
+                            or (a.token.kind == TOKEN_INTEGER
+                                and b.token.kind == TOKEN_INTEGER
+                                and a.token.value == b.token.value)):
+                        return False
+                elif a.token is not b.token:
+                    return False
+                else:
+                    stack.append((a.op2, b.op2))
+                    stack.append((a.op1, b.op1))
+            return True
 
     def __hash__(self):
-        return hash(self.__repr__())
+        if self._hash is None:
+            _structural_hash(self)
+        return self._hash
 
     @property
     def is_leaf(self) -> bool:
-        return not (self.op1 or self.op2)
+        return self.op1 is None and self.op2 is None
+
+def _structural_hash(node):
+    ''' fills in _hash bottom up. Children are never replaced, so it is
+    computed once per node. Integers hash by value (~value, the other
+    opcodes are never negative), 4 and 0x4 are the same leaf. Iterative,
+    seq chains are thousands deep '''
+    stack = [node]
+    while stack:
+        node = stack[-1]
+        op1, op2 = node.op1, node.op2
+        if op1 is not None and op1._hash is None:
+            stack.append(op1)
+        elif op2 is not None and op2._hash is None:
+            stack.append(op2)
+        else:
+            stack.pop()
+            token = node.token
+            node._hash = hash((token.opcode if token.kind != TOKEN_INTEGER else ~token.value,
+                               op1._hash if op1 is not None else None,
+                               op2._hash if op2 is not None else None))
+
+class EsilNodeTable:
+    ''' hash-consing node factory, structurally identical subtrees built
+    through the same table are the same object '''
+    node_class = EsilExpressionTreeNode
+
+    def __init__(self):
+        self._nodes = dict()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __call__(self, cmd: str, op1=None, op2=None):
+        # children come from this table as well, so identity is enough
+        key = (cmd, id(op1), id(op2))
+        node = self._nodes.get(key)
+        if node is None:
+            node = self._nodes[key] = self.node_class(cmd, op1, op2)
+        return node
 
 class EsilExpressionTree:
-    def __init__(self, expr, external_analyses=dict({})):
+    node_class = EsilExpressionTreeNode
+
+    def __init__(self, expr, external_analyses=dict({}), node_table=None, sink=None):
         self._expr = expr
+        if node_table is not None:
+            self.node_class = node_table
         self._stack = list()
-        self.analyses = AnalysisEngine(external_analyses)
+        self.analyses = AnalysisEngine(external_analyses, sink)
         self.root = None
+        self._index = None
         self._parse()
 
     def __repr__(self):
@@ -259,57 +409,266 @@ class EsilExpressionTree:
             raise Exception("Operands must be of the same type.")
 
     def _parse(self):
-        self._items = self._expr.split(',')
-        self.analyses.init_analyses()
+        analyses = self.analyses
+        stack = self._stack
+        push = stack.append
+        pop = stack.pop
+        node_class = self.node_class
+        tokens = _tokens
+        integers = _integers
+        debug = logger.isEnabledFor(logging.DEBUG)
+        handlers = analyses.dispatch.get
+        catch_all = analyses.catch_all
+
+        analyses.init_analyses()
 
-        while self._items:
-            cmd = EsilCommand(self._items.pop(0))
-            logger.debug(f'Next item: {cmd.cmd}')
+        for item in tokenize(self._expr):
+            token = tokens.get(item) or integers.get(item) or intern_token(item)
+            pop_count = token.pop_count
 
-            if not cmd.is_operator or cmd.pop_count == 0:
-                node = EsilExpressionTreeNode(cmd.cmd)
+            if pop_count == 0:
+                node = node_class(item)
 
-            elif cmd.pop_count == 1:
-                op1 = self._stack.pop()
-                node = EsilExpressionTreeNode(cmd.cmd, op1)
+            elif pop_count == 1:
+                node = node_class(item, pop())
 
-            elif cmd.pop_count == 2:
-                op1 = self._stack.pop()
-                op2 = self._stack.pop()
-                node = EsilExpressionTreeNode(cmd.cmd, op1, op2)
+            elif pop_count == 2:
+                op1 = pop()
+                node = node_class(item, op1, pop())
 
             else:
                 raise Exception("Parsing failed.")
 
-            self.analyses.run(node)
-            self._stack.append(node)
-            logger.debug(f'Pushed {node}')
+            for handler in handlers(token.opcode, catch_all):
+                handler(node)
+            push(node)
+            if debug:
+                logger.debug(f'Pushed {node}')
+
+        while len(stack) > 1:
+            op1 = pop()
+            op2 = pop()
+            push(node_class('seq', op1, op2))
 
-        while len(self._stack) > 1:
-            op1 = self._stack.pop()
-            op2 = self._stack.pop()
-            sequence_node = EsilExpressionTreeNode('seq', op1, op2)
-            self._stack.append(sequence_node)
+        self.root = pop()
+        analyses.fini_analyses()
 
-        self.root = self._stack.pop()
-        self.analyses.fini_analyses()
+    @property
+    def index(self):
+        ''' root opcode -> nodes, in the order search visits them '''
+        if self._index is None:
+            self._index = index = dict()
+            for node in preorder(self.root):
+                index.setdefault(node.token.opcode, []).append(node)
+        return self._index
 
     def search(self, subtree):
-        if isinstance(subtree, str):
-            subtree = EsilExpressionTree(subtree).root
-        elif isinstance(subtree, EsilExpressionTree):
-            subtree = subtree.root
+        pattern = compile_pattern(subtree)
+        if self.root._wild:
+            # wildcards in the searched tree match anything, no shortcuts
+            return pattern.search(self.root)
+        elif pattern.opcode is None:
+            return self.root
+
+        for node in self.index.get(pattern.opcode, ()):
+            if pattern.match(node):
+                return node
+        return None
+
+    def search_all(self, patterns):
+        if not isinstance(patterns, EsilPatternSet):
+            patterns = EsilPatternSet(patterns)
+        return patterns.search(self)
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+class EsilParseCache:
+    ''' LRU cache of parsed trees keyed by the ESIL string. Trees handed out
+    are shared, callers must treat them (and their analyses) as read-only.
+    Trees are only cached when every analysis run on them is pure. '''
+    def __init__(self, maxsize=4096, hash_cons=True):
+        self.maxsize = maxsize
+        self.hash_cons = hash_cons
+        self.hits = 0
+        self.misses = 0
+        self._trees = OrderedDict()
+        self._node_table = EsilNodeTable() if hash_cons else None
+        self._lock = Lock()
+        # backing store for results derived from parsed trees, simplify_esil
+        # and FunctionDataflow consult it on misses, see esil_store
+        self.store = None
+
+    def __len__(self):
+        return len(self._trees)
+
+    def __contains__(self, expr):
+        return expr in self._trees
 
-        if isinstance(subtree, EsilExpressionTreeNode):
-            return self._search_subtree(self.root, subtree)
+    @property
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._trees))
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+            self.hits = self.misses = 0
+            if self.hash_cons:
+                self._node_table = EsilNodeTable()
+
+    def get(self, expr, external_analyses=dict({})):
+        if external_analyses:
+            if not all(getattr(analysis, 'pure', False)
+                       for analysis in external_analyses.values()):
+                return EsilExpressionTree(expr, external_analyses)
+            key = (expr, tuple((name, type(analysis))
+                               for name, analysis in external_analyses.items()))
         else:
+            key = expr
+
+        with self._lock:
+            tree = self._trees.get(key)
+            if tree is not None:
+                self._trees.move_to_end(key)
+                self.hits += 1
+                return tree
+            self.misses += 1
+            node_table = self._node_table
+
+        if external_analyses:
+            # the tree is shared with every later caller, it runs instances
+            # of its own rather than the ones whoever parsed it first passed
+            external_analyses = {name: type(analysis)()
+                                 for name, analysis in external_analyses.items()}
+        tree = EsilExpressionTree(expr, external_analyses, node_table=node_table)
+
+        with self._lock:
+            self._trees[key] = tree
+            if len(self._trees) > self.maxsize:
+                self._trees.popitem(last=False)
+            # evicted trees keep their nodes alive through the node table,
+            # start a fresh one once it clearly outgrew the cache
+            if node_table is not None and len(node_table) > self.maxsize * 32:
+                self._node_table = EsilNodeTable()
+        return tree
+
+parse_cache = EsilParseCache()
+
+def parse_esil(expr, external_analyses=dict({})):
+    return parse_cache.get(expr, external_analyses)
+
+def preorder(root):
+    stack = [root]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node = pop()
+        if node is not None:
+            yield node
+            push(node.op1)
+            push(node.op2)
+
+def _match(node, pattern):
+    if node is pattern:
+        return True
+    elif node is None or pattern is None:
+        return False
+    elif not (node._wild or pattern._wild):
+        if node._hash is None:
+            _structural_hash(node)
+        if pattern._hash is None:
+            _structural_hash(pattern)
+        return node._hash == pattern._hash and node == pattern
+    elif node.token.cmd == 'any' or pattern.token.cmd == 'any':
+        return True
+    return (node.token is pattern.token
+            and _match(node.op1, pattern.op1)
+            and _match(node.op2, pattern.op2))
+
+class EsilPattern:
+    def __init__(self, pattern):
+        if isinstance(pattern, str):
+            pattern = EsilExpressionTree(pattern).root
+        elif isinstance(pattern, EsilExpressionTree):
+            pattern = pattern.root
+
+        if not isinstance(pattern, EsilExpressionTreeNode):
             raise Exception('Subtree type not recognized.')
 
-    def _search_subtree(self, root, subtree):
-        if root is None:
-            return None
-        elif root == subtree:
-            return root
+        self.root = pattern
+        self.opcode = None if pattern.is_wildcard else pattern.token.opcode
+
+    def __repr__(self):
+        return f'<EsilPattern {self.root}>'
+
+    def match(self, node) -> bool:
+        return _match(node, self.root)
+
+    def search(self, root):
+        for node in preorder(root):
+            if _match(node, self.root):
+                return node
+        return None
+
+@lru_cache(maxsize=4096)
+def _compile_pattern(pattern: str) -> EsilPattern:
+    return EsilPattern(pattern)
+
+def compile_pattern(pattern) -> EsilPattern:
+    if isinstance(pattern, EsilPattern):
+        return pattern
+    elif isinstance(pattern, str):
+        return _compile_pattern(pattern)
+    return EsilPattern(pattern)
+
+class EsilPatternSet:
+    ''' matches many patterns against a tree in one pass, only trying the
+    patterns whose root opcode matches the visited node '''
+    def __init__(self, patterns):
+        self.patterns = [compile_pattern(pattern) for pattern in patterns]
+        self._wildcards = list()
+        self._buckets = dict()
+        for i, pattern in enumerate(self.patterns):
+            if pattern.opcode is None:
+                self._wildcards.append(i)
+            else:
+                self._buckets.setdefault(pattern.opcode, []).append(i)
+
+    def __len__(self):
+        return len(self.patterns)
 
-        return (self._search_subtree(root.op2, subtree) or
-                self._search_subtree(root.op1, subtree))
+    def search(self, tree):
+        ''' first match for every pattern, None where nothing matched '''
+        root = tree.root if isinstance(tree, EsilExpressionTree) else tree
+        patterns = self.patterns
+        results = [None] * len(patterns)
+        if root is None:
+            return results
+
+        for i in self._wildcards:
+            results[i] = root
+
+        if isinstance(tree, EsilExpressionTree) and not root._wild:
+            index = tree.index
+            for opcode, bucket in self._buckets.items():
+                candidates = index.get(opcode)
+                if candidates:
+                    for i in bucket:
+                        match = patterns[i].match
+                        for node in candidates:
+                            if match(node):
+                                results[i] = node
+                                break
+            return results
+
+        pending = len(patterns) - len(self._wildcards)
+        buckets = self._buckets
+        everything = [i for bucket in buckets.values() for i in bucket]
+        for node in preorder(root):
+            if not pending:
+                break
+            bucket = everything if node.is_wildcard else buckets.get(node.token.opcode, ())
+            for i in bucket:
+                if results[i] is None and patterns[i].match(node):
+                    results[i] = node
+                    pending -= 1
+        return results
@@ -1,9 +1,20 @@
-from types import SimpleNamespace
-
 class Analysis:
+    # pure analyses only depend on the nodes they are shown, so their results
+    # can be shared between trees parsed from the same expression. The parse
+    # cache runs instances of its own, made by calling the class
+    pure = False
+    # set by the engine when results should be streamed out as events
+    # instead of being accumulated on the analysis
+    sink = None
+    # operators this analysis wants to see, None subscribes to every node
+    operators = None
+
     def init(self):
         pass
 
+    def emit(self, *event):
+        self.sink(event)
+
     def node_pass(self, node):
         pass
 
@@ -11,41 +22,82 @@ class Analysis:
         pass
 
 class MemoryWriteCatcher(Analysis):
+    pure = True
     mem_write_operators = frozenset({'=[]', '=[1]', '=[4]', '=[2]', '=[8]'})
+    operators = mem_write_operators
 
     def init(self):
         self.mem_writes = dict()
 
     def node_pass(self, node):
-        if node.cmd in self.mem_write_operators:
+        if self.sink is None:
             self.mem_writes[node.op1] = node.op2
+        else:
+            self.emit('mem_write', node.op1, node.op2)
 
 class MemoryReadCatcher(Analysis):
+    pure = True
     mem_read_operators = frozenset({'[]', '[1]', '[2]', '[4]', '[8]'})
+    operators = mem_read_operators
 
     def init(self):
         self.mem_reads = list()
 
     def node_pass(self, node):
-        if node.cmd in self.mem_read_operators:
+        if self.sink is None:
             self.mem_reads.append(node.op1)
+        else:
+            self.emit('mem_read', node.op1)
 
 class CompareCatcher(Analysis):
+    pure = True
+    operators = frozenset({'=='})
+
     def init(self):
         self.cmps = list()
 
     def node_pass(self, node):
-        if node.cmd == "==":
+        if self.sink is None:
             self.cmps.append(node)
+        else:
+            self.emit('cmp', node)
+
+# operator subscriptions -> (opcode, indices of the subscribed analyses),
+# shared by every engine registering the same kinds of analyses
+_dispatch_layouts = dict()
+
+def _dispatch_layout(subscriptions):
+    layout = _dispatch_layouts.get(subscriptions)
+    if layout is None:
+        from esil import intern_token
+
+        opcodes = {intern_token(operator).opcode
+                   for operators in subscriptions if operators is not None
+                   for operator in operators}
+        opcode_sets = [None if operators is None else
+                       {intern_token(operator).opcode for operator in operators}
+                       for operators in subscriptions]
+        layout = tuple((opcode, tuple(i for i, subscribed in enumerate(opcode_sets)
+                                      if subscribed is None or opcode in subscribed))
+                       for opcode in opcodes)
+        layout = _dispatch_layouts[subscriptions] = (
+            layout, tuple(i for i, subscribed in enumerate(opcode_sets) if subscribed is None))
+    return layout
 
 class AnalysisEngine:
-    def __init__(self, external_analyses=dict({})):
-        self.analyses = dict({'memory_read_catcher':MemoryReadCatcher(),
-                              'memory_write_catcher':MemoryWriteCatcher(),
-                              'compare_catcher':CompareCatcher()})
+    # the instance __dict__ holds the analyses, engine state lives in slots
+    __slots__ = ('__dict__', 'sink', 'dispatch', 'catch_all')
+
+    def __init__(self, external_analyses=dict({}), sink=None):
+        self.sink = sink
+        self.add_analyses(memory_read_catcher=MemoryReadCatcher(),
+                          memory_write_catcher=MemoryWriteCatcher(),
+                          compare_catcher=CompareCatcher(),
+                          **external_analyses)
 
-        self.add_analyses(**external_analyses)
-        self.__dict__ = self.analyses
+    @property
+    def is_pure(self):
+        return all(getattr(analysis, 'pure', False) for analysis in self.__dict__.values())
 
     def init_analyses(self):
         for analysis in self.__dict__.values():
@@ -53,11 +105,28 @@ class AnalysisEngine:
 
     def add_analyses(self, **kwargs):
         for k, v in kwargs.items():
+            v.sink = self.sink
             self.__dict__.__setitem__(k, v)
+        self._build_dispatch()
+
+    def _build_dispatch(self):
+        ''' opcode -> node_pass handlers of the analyses subscribed to it, in
+        registration order. Opcodes nobody subscribed to only reach the
+        catch-all analyses. '''
+        analyses = list(self.__dict__.values())
+        subscriptions = [getattr(analysis, 'operators', None) for analysis in analyses]
+        # plain sets and lists are fine to declare, the layout key needs them hashable
+        layout, catch_all = _dispatch_layout(
+            tuple(None if operators is None else frozenset(operators)
+                  for operators in subscriptions))
+        handler = [analysis.node_pass for analysis in analyses].__getitem__
+        self.dispatch = {opcode: tuple(map(handler, indices))
+                         for opcode, indices in layout}
+        self.catch_all = tuple(map(handler, catch_all))
 
     def run(self, node):
-        for analysis in self.__dict__.values():
-            analysis.node_pass(node)
+        for handler in self.dispatch.get(node.token.opcode, self.catch_all):
+            handler(node)
 
     def fini_analyses(self):
         for analysis in self.__dict__.values():
@@ -0,0 +1,208 @@
+import json
+import random
+
+from esil import esil_operators
+
+# radare2 output for common x86-64 instructions
+X86_64_CORPUS = [
+    'rbp,8,rsp,-,=[8],8,rsp,-=',                                           # push rbp
+    'rsp,rbp,=',                                                           # mov rbp, rsp
+    '0x20,rsp,-=,63,$o,of,:=,63,$s,sf,:=,$z,zf,:=,$p,pf,:=,64,$b,cf,:=',   # sub rsp, 0x20
+    'rdi,0x18,rbp,-,=[8]',                                                 # mov qword [rbp - 0x18], rdi
+    '0,0x4,rbp,-,=[4]',                                                    # mov dword [rbp - 4], 0
+    '0x4,rbp,-,[4],rax,=',                                                 # mov eax, dword [rbp - 4]
+    '1,eax,+=,31,$o,of,:=,31,$s,sf,:=,$z,zf,:=,31,$c,cf,:=,$p,pf,:=',      # add eax, 1
+    'eax,0x4,rbp,-,=[4]',                                                  # mov dword [rbp - 4], eax
+    '0,0x4,rbp,-,[4],==,$z,zf,:=,32,$b,cf,:=,$p,pf,:=,31,$s,sf,:=,31,$o,of,:=',  # cmp dword [rbp - 4], 0
+    'zf,!,?{,4535882,rip,=,}',                                             # jne 0x45364a
+    'zf,?{,0x401150,rip,=,}',                                              # je 0x401150
+    'eax,eax,^=,$z,zf,:=,$p,pf,:=,31,$s,sf,:=,0,cf,:=,0,of,:=',            # xor eax, eax
+    '0,eax,eax,&,==,$z,zf,:=,$p,pf,:=,31,$s,sf,:=,0,cf,:=,0,of,:=',          # test eax, eax
+    '0x10,rbp,-,rax,=',                                                    # lea rax, [rbp - 0x10]
+    '0x1,rbp,-,[1],rax,=',                                                 # movzx eax, byte [rbp - 1]
+    '2,eax,<<=,$z,zf,:=,$p,pf,:=,31,$s,sf,:=',                             # shl eax, 2
+    'rip,8,rsp,-=,rsp,=[8],0x401126,rip,=',                                # call 0x401126
+    '0x401160,rip,=',                                                      # jmp 0x401160
+    'rbp,rsp,=,rsp,[8],rbp,=,8,rsp,+=',                                    # leave
+    'rsp,[8],rip,=,8,rsp,+=',                                              # ret
+]
+
+REGISTERS64 = ('rax', 'rbx', 'rcx', 'rdx', 'rsi', 'rdi', 'r8', 'r9', 'r10', 'r11', 'r12')
+REGISTERS32 = ('eax', 'ebx', 'ecx', 'edx', 'esi', 'edi', 'r8d', 'r9d', 'r10d', 'r11d', 'r12d')
+
+# how radare2 ends arithmetic, logic and compare instructions, by operand bits
+_arith_flags = '{top},$o,of,:=,{top},$s,sf,:=,$z,zf,:=,{top},$c,cf,:=,$p,pf,:='
+_logic_flags = '$z,zf,:=,$p,pf,:=,{top},$s,sf,:=,0,cf,:=,0,of,:='
+_cmp_flags = '$z,zf,:=,{bits},$b,cf,:=,$p,pf,:=,{top},$s,sf,:=,{top},$o,of,:='
+
+# x86-64 conditions as radare2 writes them
+_conditions = ('zf', 'zf,!', 'cf', 'cf,!', 'sf', 'sf,!', 'cf,zf,|', 'cf,zf,|,!',
+               'of,sf,^', 'of,sf,^,!', 'of,sf,^,zf,|', 'of,sf,^,zf,|,!')
+
+# read-modify-write memory operators (add dword [rbp - 8], 1 and the like)
+rmw_operators = tuple(
+    cmd for cmd, operator in esil_operators.items()
+    if '=[' in cmd and cmd[0] != '=' and cmd != '=[*]' and not cmd.endswith('[]'))
+
+class EsilGenerator:
+    ''' reproducible ESIL in the shape radare2 emits for x86-64: moves,
+    arithmetic with flags, compares, conditional jumps, stack traffic,
+    read-modify-write memory operators, deeply nested and huge unrolled
+    expressions '''
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+
+    def _register(self, wide=True):
+        return self.random.choice(REGISTERS64 if wide else REGISTERS32)
+
+    def _slot(self):
+        ''' rbp - k with k 8 byte aligned '''
+        return f'0x{self.random.randrange(1, 64) * 8:x},rbp,-'
+
+    def _imm(self):
+        value = self.random.choice((0, 1, 2, 4, 8, 0xff, self.random.randrange(1 << 16)))
+        return str(value) if value < 10 else f'0x{value:x}'
+
+    def mov(self):
+        wide = self.random.random() < 0.5
+        size = 8 if wide else 4
+        kind = self.random.randrange(4)
+        if kind == 0:
+            return f'{self._register()},{self._register()},='
+        elif kind == 1:
+            return f'{self._slot()},[{size}],{self._register()},='
+        elif kind == 2:
+            return f'{self._register(wide)},{self._slot()},=[{size}]'
+        return f'{self._imm()},{self._slot()},=[{size}]'
+
+    def arith(self):
+        wide = self.random.random() < 0.5
+        top = 63 if wide else 31
+        op = self.random.choice(('+=', '-=', '*=', '<<=', '>>='))
+        source = self._imm() if self.random.random() < 0.5 else self._register(wide)
+        return f'{source},{self._register(wide)},{op},' + _arith_flags.format(top=top)
+
+    def logic(self):
+        wide = self.random.random() < 0.5
+        top = 63 if wide else 31
+        op = self.random.choice(('^=', '&=', '|='))
+        dst = self._register(wide)
+        source = dst if op == '^=' and self.random.random() < 0.5 else self._register(wide)
+        return f'{source},{dst},{op},' + _logic_flags.format(top=top)
+
+    def cmp(self):
+        wide = self.random.random() < 0.5
+        bits, size = (64, 8) if wide else (32, 4)
+        if self.random.random() < 0.5:
+            operands = f'{self._imm()},{self._register(wide)},=='
+        else:
+            operands = f'{self._imm()},{self._slot()},[{size}],=='
+        return f'{operands},' + _cmp_flags.format(bits=bits, top=bits - 1)
+
+    def test(self):
+        reg = self._register(False)
+        return f'0,{reg},{reg},&,==,' + _logic_flags.format(top=31)
+
+    def jcc(self, target=None):
+        target = self.random.randrange(0x401000, 0x500000) if target is None else target
+        return f'{self.random.choice(_conditions)},?{{,0x{target:x},rip,=,}}'
+
+    def stack(self):
+        return self.random.choice((
+            f'{self._register()},8,rsp,-,=[8],8,rsp,-=',
+            f'rsp,[8],{self._register()},=,8,rsp,+=',
+            f'rip,8,rsp,-=,rsp,=[8],0x{self.random.randrange(0x401000, 0x500000):x},rip,=',
+            'rbp,rsp,=,rsp,[8],rbp,=,8,rsp,+=',
+            f'{self._slot()},{self._register()},=',
+        ))
+
+    def memory_update(self):
+        op = self.random.choice(rmw_operators)
+        if esil_operators[op].pop_count == 1:
+            return f'{self._slot()},{op}'
+        return f'{self._imm()},{self._slot()},{op}'
+
+    def instruction(self):
+        ''' one instruction, weighted roughly like compiled code '''
+        kind = self.random.choices(
+            (self.mov, self.arith, self.logic, self.cmp, self.test, self.jcc,
+             self.stack, self.memory_update),
+            weights=(30, 15, 8, 10, 5, 10, 15, 7))[0]
+        return kind()
+
+    def nested(self, depth):
+        ''' one value depth operators deep, alternating sides so neither
+        left nor right spines dominate '''
+        expr = self._register()
+        for i in range(depth):
+            op = self.random.choice(('+', '-', '*', '^', '&', '|'))
+            if i % 2:
+                expr = f'{expr},{self._imm()},{op}'
+            else:
+                expr = f'{self._imm()},{expr},{op}'
+        return f'{expr},{self._register()},='
+
+    def unrolled(self, count):
+        ''' count instructions in a single expression, like an unrolled
+        loop or a rep prefix radare2 expands '''
+        return ','.join(self.instruction() for _ in range(count))
+
+    def generate(self, count, nested=0, unrolled=0):
+        ''' count instructions, every nested-th one a 32 deep expression
+        and every unrolled-th one 256 instructions long '''
+        out = list()
+        for i in range(count):
+            if unrolled and i % unrolled == unrolled - 1:
+                out.append(self.unrolled(256))
+            elif nested and i % nested == nested - 1:
+                out.append(self.nested(32))
+            else:
+                out.append(self.instruction())
+        return out
+
+    def function(self, addr, blocks=16, instrs=12):
+        ''' agfj-style json for a function ending its blocks in jccs '''
+        graph_blocks = list()
+        offset = addr
+        block_size = instrs * 4
+        end = addr + blocks * block_size
+        for b in range(blocks):
+            ops = list()
+            for i in range(instrs):
+                ops.append({'offset': offset, 'esil': self.instruction(), 'size': 4})
+                offset += 4
+            block = {'offset': ops[0]['offset'], 'size': block_size, 'ops': ops}
+            if offset < end:
+                # a jcc forward, or straight on
+                target = addr + self.random.randrange(b + 1, blocks) * block_size
+                ops[-1]['esil'] = self.jcc(target)
+                block['jump'] = target
+                if target != offset:
+                    block['fail'] = offset
+            graph_blocks.append(block)
+        return [{'name': f'fcn.{addr:08x}', 'offset': addr, 'blocks': graph_blocks}]
+
+def record(functions=32, seed=0, blocks=16, instrs=12):
+    ''' the answers a RecordedR2 needs to analyze a generated binary offline '''
+    generator = EsilGenerator(seed)
+    responses = dict()
+    graphs = list()
+    for n in range(functions):
+        addr = 0x401000 + n * 0x1000
+        graph = generator.function(addr, blocks, instrs)
+        graphs.append(graph)
+        responses[f'agfj @{addr}'] = json.dumps(graph)
+    responses['agfj @@F'] = '\n'.join(map(json.dumps, graphs))
+    responses['aflj'] = json.dumps([{'name': graph[0]['name'], 'offset': graph[0]['offset'],
+                                     'nbbs': len(graph[0]['blocks'])} for graph in graphs])
+    responses['itj'] = json.dumps({'md5': f'synthetic-{seed}-{functions}'})
+    return responses
+
+if __name__ == '__main__':
+    import sys
+
+    # python esil_corpus.py corpus.json [functions] [seed]
+    functions = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    with open(sys.argv[1], 'w') as f:
+        json.dump(record(functions, seed), f)
@@ -0,0 +1,352 @@
+from collections import deque, namedtuple
+
+from esil import TOKEN_INTEGER, compile_pattern, parse_cache, parse_esil
+from esil_analysis import Analysis
+from esil_eval import (memory_update_operators, peek_operators, poke_operators, register,
+                       unary_update_operators, update_operators)
+
+# one instruction's effect as bitsets over the function's locations: uses
+# not preceded by a full definition, locations fully (kills) or at all
+# (defined) written, and the definition ids it generates
+Access = namedtuple('Access', 'offset uses kills defined defs stack')
+
+Definition = namedtuple('Definition', 'offset location')
+
+# x86-64 ret, rip popped off the stack
+ret_pattern = compile_pattern('rsp,[8],rip,=')
+
+def _signed(value):
+    ''' 64 bit two's complement, 0xfffffffffffffff8 is -8 '''
+    value &= (1 << 64) - 1
+    return value - (1 << 64) if value >> 63 else value
+
+def _displacement(value):
+    ''' value as a signed 32 bit displacement, None when it can't be one '''
+    value = _signed(value)
+    return value if -(1 << 31) <= value < (1 << 31) else None
+
+def stack_offset(node):
+    ''' k for rbp + k address nodes, None for everything else '''
+    cmd = node.token.cmd
+    if node.is_leaf:
+        return 0 if cmd == 'rbp' else None
+    elif cmd not in ('+', '-') or node.op1 is None or node.op2 is None:
+        return None
+    elif node.op1.token.cmd == 'rbp' and node.op2.token.kind == TOKEN_INTEGER:
+        return _displacement(node.op2.token.value if cmd == '+' else -node.op2.token.value)
+    elif cmd == '+' and node.op2.token.cmd == 'rbp' and node.op1.token.kind == TOKEN_INTEGER:
+        return _displacement(node.op1.token.value)
+    return None
+
+def register_location(name):
+    ''' flag bits are locations of their own, other registers are tracked
+    as their full width parent '''
+    reg = register(name)
+    return reg.name if reg.bits == 1 else reg.parent
+
+class AccessCatcher(Analysis):
+    ''' the locations an instruction reads and writes, in order: registers
+    and rbp-relative stack bytes as ('rbp', offset). Writes through other
+    pointers are ignored, stack slots whose address is taken (lea) end up
+    in escaped, from the slot up to rbp, since anything may read them. '''
+    pure = True
+
+    def init(self):
+        # ('use', location, node) and ('def', location, full width)
+        self.events = list()
+        self.escaped = set()
+        self._addresses = set()
+        self._candidates = list()
+
+    def _memory(self, kind, addr, size):
+        offset = stack_offset(addr)
+        self._addresses.add(id(addr))
+        if offset is None:
+            return
+        for i in range(size):
+            self.events.append((kind, ('rbp', offset + i), True))
+
+    def node_pass(self, node):
+        token = node.token
+        cmd = token.cmd
+        events = self.events
+
+        if node.is_variable and node.is_leaf:
+            events.append(('use', register_location(cmd), node))
+        elif cmd in ('=', ':=') or cmd in update_operators or cmd in unary_update_operators:
+            dst = node.op1
+            if dst is None or not dst.is_variable or not dst.is_leaf:
+                return
+            if cmd in ('=', ':=') and events and events[-1][2] is dst:
+                # plain assignments don't read their destination
+                events.pop()
+            events.append(('def', register_location(dst.token.cmd),
+                           register(dst.token.cmd).bits in (1, 64)))
+        elif cmd in peek_operators:
+            self._memory('use', node.op1, peek_operators[cmd])
+        elif cmd in poke_operators:
+            self._memory('def', node.op1, poke_operators[cmd])
+        elif cmd in memory_update_operators:
+            size = memory_update_operators[cmd][1]
+            self._memory('use', node.op1, size)
+            self._memory('def', node.op1, size)
+        elif cmd in ('+', '-') and stack_offset(node) is not None:
+            self._candidates.append(node)
+
+    def fini(self):
+        for node in self._candidates:
+            if id(node) not in self._addresses:
+                offset = stack_offset(node)
+                self.escaped.update(('rbp', i) for i in range(offset, max(offset + 8, 0)))
+        del self._candidates
+        del self._addresses
+
+def _successors(bb):
+    ''' jump, fail and switch case targets of a block, None when radare2
+    couldn't resolve all of them '''
+    info = bb.info
+    succs = [info[key] for key in ('jump', 'fail') if info.get(key) is not None]
+    switch = info.get('switchop')
+    if switch is not None:
+        cases = switch.get('cases') or ()
+        targets = [case.get('jump', case.get('addr')) for case in cases]
+        if not targets or None in targets:
+            return None
+        succs += targets
+    return succs
+
+def _returns(bb):
+    ''' whether a block without successors ends in a ret, rather than an
+    unresolved indirect jump or a call that doesn't come back '''
+    if not bb.instrs:
+        return False
+    last = bb.instrs[-1]
+    if 'type' in last:
+        return last['type'] == 'ret'
+    return bool(last.get('esil')) and parse_esil(last['esil']).search(ret_pattern) is not None
+
+def _bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+class FunctionDataflow:
+    ''' reaching definitions, liveness and def-use chains for one function.
+
+    Locations and definitions are numbered per function and every set is
+    an int bitset. Both problems are solved with a worklist over the CFG
+    (jump, fail and switch case edges of the blocks). Only blocks ending in
+    a ret are function exits, after a block whose successors are unknown
+    (an unresolved indirect jump, a jump out of the function) everything
+    is live. After nop() the patched blocks are solved again and changes
+    spread from there, as far as they reach. '''
+    def __init__(self, bbs):
+        self.blocks = {bb.addr: bb for bb in bbs}
+        self.order = [bb.addr for bb in bbs]
+        self.succs = dict()
+        unknown = set()
+        for addr, bb in self.blocks.items():
+            succs = _successors(bb)
+            if succs is None or any(succ not in self.blocks for succ in succs) \
+                    or (not succs and not _returns(bb)):
+                unknown.add(addr)
+            self.succs[addr] = list(dict.fromkeys(succ for succ in succs or ()
+                                                  if succ in self.blocks))
+        self.preds = {addr: list() for addr in self.blocks}
+        for addr, succs in self.succs.items():
+            for succ in succs:
+                self.preds[succ].append(addr)
+
+        self.locations = dict()
+        self.names = list()
+        self.definitions = list()
+        self.location_defs = dict()     # location bit -> bitset of its definitions
+        self.escaped = 0
+        self.instrs = {addr: [self._access(instr) for instr in bb.instrs]
+                       for addr, bb in self.blocks.items()}
+
+        # stack slots are dead once the function returns, registers are not
+        self.exit_live = 0
+        for location, bit in self.locations.items():
+            if isinstance(location, str) and register(location).bits != 1:
+                self.exit_live |= 1 << bit
+        # what is live after a block besides what its successors read
+        all_live = (1 << len(self.names)) - 1
+        self.boundary = {addr: all_live if addr in unknown
+                         else 0 if self.succs[addr] else self.exit_live
+                         for addr in self.blocks}
+
+        self.summaries = {addr: self._summarize(addr) for addr in self.blocks}
+        self.reach_in, self.reach_out = dict.fromkeys(self.blocks, 0), dict.fromkeys(self.blocks, 0)
+        self.live_in, self.live_out = dict.fromkeys(self.blocks, 0), dict.fromkeys(self.blocks, 0)
+        self.visits = 0
+        self._solve_reaching(self.order)
+        self._solve_liveness(self.order)
+
+    def _location(self, location):
+        bit = self.locations.get(location)
+        if bit is None:
+            bit = self.locations[location] = len(self.names)
+            self.names.append(location)
+        return bit
+
+    def _access(self, instr):
+        uses = kills = defined = stack = 0
+        defs = list()
+        if not instr.get('esil'):
+            return Access(instr['offset'], uses, kills, defined, defs, stack)
+        expr = instr['esil']
+        store = parse_cache.store
+        catcher = store.get_analysis(expr, AccessCatcher) if store is not None else None
+        if catcher is None:
+            catcher = parse_esil(expr, {'access_catcher': AccessCatcher()}).analyses.access_catcher
+            if store is not None:
+                store.add_analysis(expr, catcher)
+        for kind, location, full in catcher.events:
+            bit = 1 << self._location(location)
+            if kind == 'use':
+                if not kills & bit:
+                    uses |= bit
+                continue
+            def_id = len(self.definitions)
+            self.definitions.append(Definition(instr['offset'], location))
+            self.location_defs[bit] = self.location_defs.get(bit, 0) | (1 << def_id)
+            defs.append((def_id, bit, full))
+            defined |= bit
+            if full:
+                kills |= bit
+            if not isinstance(location, str):
+                stack |= bit
+        for location in catcher.escaped:
+            self.escaped |= 1 << self._location(location)
+        return Access(instr['offset'], uses, kills, defined, defs, stack)
+
+    def _summarize(self, addr):
+        ''' (gen, kill) for reaching definitions, (use, def) for liveness '''
+        gen = kill = use = killed = 0
+        for access in self.instrs[addr]:
+            for def_id, bit, full in access.defs:
+                if full:
+                    gen &= ~self.location_defs[bit]
+                    kill |= self.location_defs[bit]
+                gen |= 1 << def_id
+            use |= access.uses & ~killed
+            killed |= access.kills
+        return gen, kill, use, killed
+
+    def _solve_reaching(self, blocks):
+        work = deque(blocks)
+        queued = set(blocks)
+        while work:
+            addr = work.popleft()
+            queued.discard(addr)
+            self.visits += 1
+            gen, kill, _, _ = self.summaries[addr]
+            reach_in = 0
+            for pred in self.preds[addr]:
+                reach_in |= self.reach_out[pred]
+            self.reach_in[addr] = reach_in
+            reach_out = gen | (reach_in & ~kill)
+            if reach_out != self.reach_out[addr]:
+                self.reach_out[addr] = reach_out
+                for succ in self.succs[addr]:
+                    if succ not in queued:
+                        queued.add(succ)
+                        work.append(succ)
+
+    def _solve_liveness(self, blocks):
+        work = deque(reversed(blocks))
+        queued = set(blocks)
+        while work:
+            addr = work.popleft()
+            queued.discard(addr)
+            self.visits += 1
+            _, _, use, killed = self.summaries[addr]
+            live_out = self.boundary[addr]
+            for succ in self.succs[addr]:
+                live_out |= self.live_in[succ]
+            self.live_out[addr] = live_out
+            live_in = use | (live_out & ~killed)
+            if live_in != self.live_in[addr]:
+                self.live_in[addr] = live_in
+                for pred in self.preds[addr]:
+                    if pred not in queued:
+                        queued.add(pred)
+                        work.append(pred)
+
+    def block_of(self, offset):
+        for addr, bb in self.blocks.items():
+            if offset in bb or any(access.offset == offset for access in self.instrs[addr]):
+                return addr
+        return None
+
+    def nop(self, *offsets):
+        ''' forgets the instructions at offsets and solves again, starting
+        at the patched blocks and only going on where their results change.
+        Definitions of the nopped instructions are dropped everywhere. A
+        location that is no longer read can stay live around a loop, which
+        only ever keeps stores. '''
+        patched = set()
+        removed = 0
+        for offset in offsets:
+            addr = self.block_of(offset)
+            if addr is None:
+                continue
+            instrs = self.instrs[addr]
+            for i, access in enumerate(instrs):
+                if access.offset == offset:
+                    for def_id, _, _ in access.defs:
+                        removed |= 1 << def_id
+                    instrs[i] = Access(offset, 0, 0, 0, [], 0)
+            patched.add(addr)
+        if not patched:
+            return
+        for addr in patched:
+            self.summaries[addr] = self._summarize(addr)
+
+        if removed:
+            for addr in self.blocks:
+                self.reach_in[addr] &= ~removed
+                self.reach_out[addr] &= ~removed
+        blocks = [addr for addr in self.order if addr in patched]
+        self._solve_reaching(blocks)
+        self._solve_liveness(blocks)
+
+    def decode(self, mask):
+        return {self.names[bit] for bit in _bits(mask)}
+
+    def reaching(self, addr):
+        ''' definitions reaching the start of a block '''
+        return [self.definitions[def_id] for def_id in _bits(self.reach_in[addr])]
+
+    def live(self, addr):
+        ''' (live in, live out) locations of a block '''
+        return self.decode(self.live_in[addr]), self.decode(self.live_out[addr])
+
+    def def_use(self):
+        ''' definition -> offsets of the instructions that may read it '''
+        chains = {definition: list() for definition in self.definitions}
+        for addr in self.order:
+            reaching = self.reach_in[addr]
+            for access in self.instrs[addr]:
+                for bit in _bits(access.uses):
+                    for def_id in _bits(reaching & self.location_defs.get(1 << bit, 0)):
+                        chains[self.definitions[def_id]].append(access.offset)
+                for def_id, bit, full in access.defs:
+                    if full:
+                        reaching &= ~self.location_defs[bit]
+                    reaching |= 1 << def_id
+        return chains
+
+    def dead_stores(self):
+        ''' offsets of instructions writing the stack where nothing they
+        write is read afterwards, escaped slots are always live '''
+        dead = list()
+        for addr in self.order:
+            live = self.live_out[addr]
+            for access in reversed(self.instrs[addr]):
+                if access.stack and not access.defined & (live | self.escaped):
+                    dead.append(access.offset)
+                live = access.uses | (live & ~access.kills)
+        return sorted(dead)
@@ -0,0 +1,681 @@
+from collections import namedtuple
+
+from esil import TOKEN_INTEGER, TOKEN_VARIABLE, esil_operators, parse_esil
+
+MASK64 = (1 << 64) - 1
+
+class EsilError(Exception):
+    pass
+
+class EsilTrap(EsilError):
+    pass
+
+def genmask(bits):
+    ''' same as radare2's, n+1 low bits set '''
+    if 0 < bits < 64:
+        return (2 << bits) - 1
+    return MASK64
+
+Register = namedtuple('Register', 'name parent shift mask bits')
+
+def _x86_64_registers():
+    registers = dict()
+
+    def add(name, parent, shift, bits):
+        registers[name] = Register(name, parent, shift, (1 << bits) - 1, bits)
+
+    for r in 'abcd':
+        add(f'r{r}x', f'r{r}x', 0, 64)
+        add(f'e{r}x', f'r{r}x', 0, 32)
+        add(f'{r}x', f'r{r}x', 0, 16)
+        add(f'{r}l', f'r{r}x', 0, 8)
+        add(f'{r}h', f'r{r}x', 8, 8)
+    for r in ('si', 'di', 'bp', 'sp'):
+        add(f'r{r}', f'r{r}', 0, 64)
+        add(f'e{r}', f'r{r}', 0, 32)
+        add(r, f'r{r}', 0, 16)
+        add(f'{r}l', f'r{r}', 0, 8)
+    for n in range(8, 16):
+        add(f'r{n}', f'r{n}', 0, 64)
+        add(f'r{n}d', f'r{n}', 0, 32)
+        add(f'r{n}w', f'r{n}', 0, 16)
+        add(f'r{n}b', f'r{n}', 0, 8)
+    add('rip', 'rip', 0, 64)
+    add('eip', 'rip', 0, 32)
+    add('rflags', 'rflags', 0, 64)
+    add('eflags', 'rflags', 0, 32)
+    for bit, flag in ((0, 'cf'), (2, 'pf'), (4, 'af'), (6, 'zf'), (7, 'sf'),
+                      (8, 'tf'), (9, 'if'), (10, 'df'), (11, 'of')):
+        add(flag, 'rflags', bit, 1)
+    return registers
+
+x86_64_registers = _x86_64_registers()
+
+def register(name):
+    ''' unknown names are plain 64-bit registers of their own '''
+    reg = x86_64_registers.get(name)
+    if reg is None:
+        reg = x86_64_registers.setdefault(name, Register(name, name, 0, MASK64, 64))
+    return reg
+
+def _signed(value):
+    return value - (1 << 64) if value >> 63 else value
+
+def _div(a, b):
+    if not b:
+        raise EsilTrap('division by zero')
+    return a // b
+
+def _mod(a, b):
+    if not b:
+        raise EsilTrap('division by zero')
+    return a % b
+
+def _asr(a, b):
+    return (_signed(a) >> b) & MASK64 if b < 64 else (MASK64 if a >> 63 else 0)
+
+def _ror(a, b):
+    b &= 63
+    return ((a >> b) | (a << (64 - b))) & MASK64
+
+def _rol(a, b):
+    b &= 63
+    return ((a << b) | (a >> (64 - b))) & MASK64
+
+# dst op src, dst is the first value popped
+binary_operators = {
+    '+'   : lambda a, b: (a + b) & MASK64,
+    '-'   : lambda a, b: (a - b) & MASK64,
+    '*'   : lambda a, b: (a * b) & MASK64,
+    '/'   : _div,
+    '%'   : _mod,
+    '&'   : lambda a, b: a & b,
+    '|'   : lambda a, b: a | b,
+    '^'   : lambda a, b: a ^ b,
+    '<<'  : lambda a, b: (a << b) & MASK64 if b < 64 else 0,
+    '>>'  : lambda a, b: a >> b,
+    '>>>>': _asr,
+    '>>>' : _ror,
+    '<<<' : _rol,
+}
+
+comparison_operators = {
+    '<' : lambda a, b: _signed(a) < _signed(b),
+    '>' : lambda a, b: _signed(a) > _signed(b),
+    '<=': lambda a, b: _signed(a) <= _signed(b),
+    '>=': lambda a, b: _signed(a) >= _signed(b),
+}
+
+unary_operators = {
+    '!' : lambda a: int(not a),
+    '++': lambda a: (a + 1) & MASK64,
+    '--': lambda a: (a - 1) & MASK64,
+}
+
+# register and memory updates in place, a,b,+= is b = b + a
+update_operators = {f'{cmd}=': fn for cmd, fn in binary_operators.items()}
+unary_update_operators = {'++=': unary_operators['++'],
+                          '--=': unary_operators['--'],
+                          '!=' : unary_operators['!']}
+
+def _size(cmd):
+    ''' access size in bytes from a [n] suffix, [] is a full word '''
+    size = cmd[cmd.index('[') + 1:-1]
+    return int(size) if size else 8
+
+peek_operators = {cmd: _size(cmd) for cmd in ('[]', '[1]', '[2]', '[3]', '[4]', '[8]', '[16]')}
+poke_operators = {f'={cmd}': size for cmd, size in peek_operators.items()}
+memory_update_operators = {
+    cmd: (update_operators[cmd[:cmd.index('[')]] if cmd[:cmd.index('[')] in update_operators
+          else unary_update_operators[cmd[:cmd.index('[')]], _size(cmd))
+    for cmd, operator in esil_operators.items()
+    if '=[' in cmd and cmd[0] != '=' and cmd != '=[*]'}
+
+class EsilMachine:
+    ''' concrete register file, byte addressed memory and the last
+    operation's old/cur values the flag operators are computed from '''
+    def __init__(self, registers=dict({}), memory=None):
+        self.regs = dict()
+        self.memory = memory if memory is not None else dict()
+        self.stack = list()
+        self.old = 0
+        self.cur = 0
+        self.lastsz = 64
+        self.address = 0
+        self.jump_target = None
+        self.delay_slot = 0
+        self.interrupts = list()
+        for name, value in registers.items():
+            self.set_register(name, value)
+
+    def read(self, reg):
+        return (self.regs.get(reg.parent, 0) >> reg.shift) & reg.mask
+
+    def write(self, reg, value):
+        if reg.bits == 64:
+            self.regs[reg.parent] = value & MASK64
+        else:
+            mask = reg.mask << reg.shift
+            self.regs[reg.parent] = ((self.regs.get(reg.parent, 0) & ~mask)
+                                     | ((value << reg.shift) & mask))
+
+    def get_register(self, name):
+        return self.read(register(name))
+
+    def set_register(self, name, value):
+        self.write(register(name), value)
+
+    def value(self, item):
+        if type(item) is int:
+            return item
+        elif isinstance(item, Register):
+            return self.read(item)
+        raise EsilError(f'{item} is not a value')
+
+    def load(self, addr, size):
+        memory = self.memory
+        value = 0
+        for i in range(size - 1, -1, -1):
+            value = (value << 8) | memory.get((addr + i) & MASK64, 0)
+        return value
+
+    def store(self, addr, size, value):
+        memory = self.memory
+        for i in range(size):
+            memory[(addr + i) & MASK64] = (value >> (8 * i)) & 0xff
+
+    def run(self, program):
+        code = program.code
+        end = len(code)
+        pc = 0
+        self.stack.clear()
+        while pc < end:
+            target = code[pc](self)
+            pc = pc + 1 if target is None else target
+
+    def execute(self, expr):
+        self.run(compile_esil(expr))
+
+    def emulate(self, instructions, steps, pc_name='rip'):
+        ''' instructions maps addresses to (size, esil), execution stops after
+        `steps` instructions or when the pc leaves the map '''
+        pc = register(pc_name)
+        programs = dict()
+        executed = 0
+        while executed < steps:
+            addr = self.read(pc)
+            program = programs.get(addr)
+            if program is None:
+                if addr not in instructions:
+                    break
+                size, expr = instructions[addr]
+                program = programs[addr] = (size, compile_esil(expr))
+            # like radare2, the pc points past the instruction while it runs
+            self.address = addr
+            self.write(pc, addr + program[0])
+            self.run(program[1])
+            executed += 1
+        return executed
+
+EsilProgram = namedtuple('EsilProgram', 'expr code')
+
+def compile_esil(expr):
+    ''' compiled once per cached tree '''
+    tree = parse_esil(expr)
+    program = getattr(tree, 'program', None)
+    if program is None:
+        program = tree.program = compile_tree(tree)
+    return program
+
+def _statements(root):
+    statements = list()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node.token.cmd == 'seq':
+            stack.append(node.op1)
+            stack.append(node.op2)
+        else:
+            statements.append(node)
+    return statements
+
+def _postorder(node, out):
+    if node is not None:
+        _postorder(node.op2, out)
+        _postorder(node.op1, out)
+        out.append(node)
+    return out
+
+def _is_register(node):
+    return node is not None and node.token.kind == TOKEN_VARIABLE and node.is_leaf
+
+def _flag_value(cmd):
+    ''' $ flags computed from the last operation, radare2 semantics '''
+    if cmd == '$z':
+        return lambda vm: int(not (vm.cur & genmask(vm.lastsz - 1)))
+    elif cmd == '$p':
+        return lambda vm: int(not bin(vm.cur & 0xff).count('1') & 1)
+    elif cmd == '$$':
+        return lambda vm: vm.address
+    elif cmd == '$r':
+        return lambda vm: 8
+    elif cmd == '$ds':
+        return lambda vm: vm.delay_slot
+    elif cmd == '$jt':
+        return lambda vm: vm.jump_target or 0
+    elif cmd == '$js':
+        return lambda vm: int(vm.jump_target is not None)
+    return None
+
+def _flag_function(cmd):
+    if cmd == '$c':
+        def carry(vm, bit):
+            mask = genmask(bit)
+            return int((vm.cur & mask) < (vm.old & mask))
+        return carry
+    elif cmd == '$b':
+        def borrow(vm, bit):
+            mask = genmask(bit - 1)
+            return int((vm.old & mask) < (vm.cur & mask))
+        return borrow
+    elif cmd == '$s':
+        return lambda vm, bit: (vm.cur >> bit) & 1 if bit < 64 else 0
+    elif cmd == '$o':
+        def overflow(vm, bit):
+            m0, m1 = genmask(bit & 0x3f), genmask((bit + 0x3f) & 0x3f)
+            return int(((vm.cur & m0) < (vm.old & m0)) ^ ((vm.cur & m1) < (vm.old & m1)))
+        return overflow
+    return None
+
+def _compile_value(node):
+    ''' closure computing a side-effect free (apart from flags) subtree,
+    None when the subtree has to go through the stack machine '''
+    token = node.token
+    cmd = token.cmd
+
+    if token.kind == TOKEN_INTEGER:
+        value = token.value & MASK64
+        return lambda vm: value
+    elif token.kind == TOKEN_VARIABLE:
+        reg = register(cmd)
+        parent, shift, mask = reg.parent, reg.shift, reg.mask
+        if reg.bits == 64:
+            return lambda vm: vm.regs.get(parent, 0)
+        return lambda vm: (vm.regs.get(parent, 0) >> shift) & mask
+
+    flag = _flag_value(cmd)
+    if flag is not None:
+        return flag
+
+    f1 = _compile_value(node.op1) if node.op1 is not None else None
+    f2 = _compile_value(node.op2) if node.op2 is not None else None
+    if (node.op1 is not None and f1 is None) or (node.op2 is not None and f2 is None):
+        return None
+
+    if cmd in binary_operators:
+        fn = binary_operators[cmd]
+        if node.op2.token.kind == TOKEN_INTEGER:
+            b = node.op2.token.value & MASK64
+            return lambda vm: fn(f1(vm), b)
+        def binary(vm):
+            b = f2(vm)
+            return fn(f1(vm), b)
+        return binary
+    elif cmd in comparison_operators:
+        fn = comparison_operators[cmd]
+        def compare(vm):
+            b = f2(vm)
+            a = f1(vm)
+            vm.old, vm.cur = a, (a - b) & MASK64
+            return int(fn(a, b))
+        return compare
+    elif cmd in unary_operators:
+        fn = unary_operators[cmd]
+        return lambda vm: fn(f1(vm))
+    elif cmd in peek_operators:
+        size = peek_operators[cmd]
+        def peek(vm):
+            addr = f1(vm)
+            vm.lastsz = size * 8
+            return vm.load(addr, size)
+        return peek
+    elif cmd == 'NUM':
+        return f1
+
+    fn = _flag_function(cmd)
+    if fn is not None:
+        return lambda vm: fn(vm, f1(vm))
+    return None
+
+def _compile_assignment(node):
+    ''' fused closure for register assignments with plain operands '''
+    cmd = node.token.cmd
+    if not _is_register(node.op1):
+        return None
+    reg = register(node.op1.token.cmd)
+    bits = reg.bits
+    read, write = EsilMachine.read, EsilMachine.write
+
+    if cmd in unary_update_operators:
+        fn = unary_update_operators[cmd]
+        def unary_update(vm):
+            old = read(vm, reg)
+            new = fn(old) & reg.mask
+            write(vm, reg, new)
+            vm.old, vm.cur, vm.lastsz = old, new, bits
+        return unary_update
+
+    src = _compile_value(node.op2) if node.op2 is not None else None
+    if src is None:
+        return None
+
+    if cmd == ':=':
+        # no flags, mostly flag bits being set, so keep it tight
+        parent, shift, mask = reg.parent, reg.shift, reg.mask
+        if bits == 64:
+            def weak_assign(vm):
+                vm.regs[parent] = src(vm)
+            return weak_assign
+        clear = ~(mask << shift)
+        def weak_assign(vm):
+            value = (src(vm) & mask) << shift
+            regs = vm.regs
+            regs[parent] = (regs.get(parent, 0) & clear) | value
+        return weak_assign
+    elif cmd == '=':
+        def assign(vm):
+            new = src(vm) & reg.mask
+            vm.old = read(vm, reg)
+            write(vm, reg, new)
+            vm.cur, vm.lastsz = new, bits
+        return assign
+    elif cmd in update_operators:
+        fn = update_operators[cmd]
+        def update(vm):
+            value = src(vm)
+            old = read(vm, reg)
+            new = fn(old, value) & reg.mask
+            write(vm, reg, new)
+            vm.old, vm.cur, vm.lastsz = old, new, bits
+        return update
+    return None
+
+def _compile_statement(node):
+    ''' fused closure for a whole top level statement, or None '''
+    cmd = node.token.cmd
+
+    if cmd == '==':
+        f1 = _compile_value(node.op1)
+        f2 = _compile_value(node.op2)
+        if f1 is None or f2 is None:
+            return None
+        bits = register(node.op1.token.cmd).bits if _is_register(node.op1) else None
+        def cmp(vm):
+            b = f2(vm)
+            a = f1(vm)
+            vm.old, vm.cur = a, (a - b) & MASK64
+            if bits is not None:
+                vm.lastsz = bits
+        return cmp
+
+    elif cmd in poke_operators or cmd in memory_update_operators:
+        addr = _compile_value(node.op1)
+        if addr is None:
+            return None
+        if cmd in poke_operators:
+            size = poke_operators[cmd]
+            src = _compile_value(node.op2)
+            if src is None:
+                return None
+            def poke(vm):
+                value = src(vm)
+                vm.store(addr(vm), size, value)
+            return poke
+
+        fn, size = memory_update_operators[cmd]
+        if node.op2 is None:
+            def memory_unary_update(vm):
+                where = addr(vm)
+                old = vm.load(where, size)
+                new = fn(old) & genmask(size * 8 - 1)
+                vm.store(where, size, new)
+                vm.old, vm.cur, vm.lastsz = old, new, size * 8
+            return memory_unary_update
+        src = _compile_value(node.op2)
+        if src is None:
+            return None
+        def memory_update(vm):
+            value = src(vm)
+            where = addr(vm)
+            old = vm.load(where, size)
+            new = fn(old, value) & genmask(size * 8 - 1)
+            vm.store(where, size, new)
+            vm.old, vm.cur, vm.lastsz = old, new, size * 8
+        return memory_update
+
+    assignment = _compile_assignment(node)
+    if assignment is not None:
+        return assignment
+
+    value = _compile_value(node)
+    if value is not None:
+        return lambda vm: vm.stack.append(value(vm))
+    return None
+
+def _generic_operation(node):
+    ''' one token on the ESIL value stack, the slow path for everything the
+    statement compiler can't fuse '''
+    token = node.token
+    cmd = token.cmd
+
+    if token.kind == TOKEN_INTEGER:
+        value = token.value & MASK64
+        return lambda vm: vm.stack.append(value)
+    elif token.kind == TOKEN_VARIABLE:
+        reg = register(cmd)
+        return lambda vm: vm.stack.append(reg)
+
+    flag = _flag_value(cmd)
+    if flag is not None:
+        return lambda vm: vm.stack.append(flag(vm))
+
+    def pop_value(vm):
+        if not vm.stack:
+            raise EsilError(f'{cmd}: stack underflow')
+        return vm.value(vm.stack.pop())
+
+    def pop_register(vm):
+        if not vm.stack:
+            raise EsilError(f'{cmd}: stack underflow')
+        dst = vm.stack.pop()
+        if not isinstance(dst, Register):
+            raise EsilError(f'{cmd}: {dst} is not a register')
+        return dst
+
+    if cmd in binary_operators:
+        fn = binary_operators[cmd]
+        def binary(vm):
+            a = pop_value(vm)
+            vm.stack.append(fn(a, pop_value(vm)))
+        return binary
+    elif cmd in comparison_operators:
+        fn = comparison_operators[cmd]
+        def compare(vm):
+            a = pop_value(vm)
+            b = pop_value(vm)
+            vm.old, vm.cur = a, (a - b) & MASK64
+            vm.stack.append(int(fn(a, b)))
+        return compare
+    elif cmd in unary_operators:
+        fn = unary_operators[cmd]
+        return lambda vm: vm.stack.append(fn(pop_value(vm)))
+    elif cmd in peek_operators:
+        size = peek_operators[cmd]
+        def peek(vm):
+            addr = pop_value(vm)
+            vm.lastsz = size * 8
+            vm.stack.append(vm.load(addr, size))
+        return peek
+    elif cmd == '==':
+        def cmp(vm):
+            dst = vm.stack[-1] if vm.stack else None
+            a = pop_value(vm)
+            b = pop_value(vm)
+            vm.old, vm.cur = a, (a - b) & MASK64
+            if isinstance(dst, Register):
+                vm.lastsz = dst.bits
+        return cmp
+    elif cmd in ('=', ':=') or cmd in update_operators or cmd in unary_update_operators:
+        def assign(vm):
+            reg = pop_register(vm)
+            old = vm.read(reg)
+            if cmd in unary_update_operators:
+                new = unary_update_operators[cmd](old)
+            elif cmd in update_operators:
+                new = update_operators[cmd](old, pop_value(vm))
+            else:
+                new = pop_value(vm)
+            new &= reg.mask
+            vm.write(reg, new)
+            if cmd != ':=':
+                vm.old, vm.cur, vm.lastsz = old, new, reg.bits
+        return assign
+    elif cmd in poke_operators:
+        size = poke_operators[cmd]
+        def poke(vm):
+            addr = pop_value(vm)
+            vm.store(addr, size, pop_value(vm))
+        return poke
+    elif cmd in memory_update_operators:
+        fn, size = memory_update_operators[cmd]
+        unary = esil_operators[cmd].pop_count == 1
+        def memory_update(vm):
+            addr = pop_value(vm)
+            old = vm.load(addr, size)
+            new = (fn(old) if unary else fn(old, pop_value(vm))) & genmask(size * 8 - 1)
+            vm.store(addr, size, new)
+            vm.old, vm.cur, vm.lastsz = old, new, size * 8
+        return memory_update
+    elif cmd == 'NUM':
+        return lambda vm: vm.stack.append(pop_value(vm))
+    elif cmd == 'DUP':
+        return lambda vm: vm.stack.append(vm.stack[-1])
+    elif cmd == 'SWAP':
+        def swap(vm):
+            vm.stack[-1], vm.stack[-2] = vm.stack[-2], vm.stack[-1]
+        return swap
+    elif cmd == 'POP':
+        return lambda vm: vm.stack.pop()
+    elif cmd == 'CLEAR':
+        return lambda vm: vm.stack.clear()
+    elif cmd == 'BITS':
+        return lambda vm: vm.stack.append(64)
+    elif cmd in ('STACK', '}'):
+        return lambda vm: None
+    elif cmd == '$':
+        return lambda vm: vm.interrupts.append(pop_value(vm))
+    elif cmd in ('SETJT', 'SETJTS'):
+        def set_jump_target(vm):
+            vm.jump_target = pop_value(vm)
+        return set_jump_target
+    elif cmd == 'SETD':
+        def set_delay_slot(vm):
+            vm.delay_slot = pop_value(vm)
+        return set_delay_slot
+    elif cmd == 'TRAP':
+        def trap(vm):
+            raise EsilTrap(f'trap at 0x{vm.address:x}')
+        return trap
+
+    fn = _flag_function(cmd)
+    if fn is not None:
+        return lambda vm: vm.stack.append(fn(vm, pop_value(vm)))
+
+    def unsupported(vm):
+        raise EsilError(f'{cmd} is not supported')
+    return unsupported
+
+def compile_tree(tree):
+    ''' flattens the tree into closures run in order. Plain statements
+    (assignments, compares, memory writes, conditions) become a single fused
+    closure, the rest falls back to one closure per token. A closure returns
+    the index to continue at or None for the next one. '''
+    code = list()
+    blocks = list()     # open ?{ as [jump cell, else jump cell or None]
+    token_starts = dict()
+    gotos = list()
+    statements = _statements(tree.root)
+    token_index = 0
+    i = 0
+
+    while i < len(statements):
+        node = statements[i]
+        cmd = node.token.cmd
+        token_starts[token_index] = len(code)
+        token_index += len(_postorder(node, []))
+
+        if cmd == '?{' and node.is_leaf:
+            target = [None]
+            def branch(vm, target=target):
+                if not vm.value(vm.stack.pop()):
+                    return target[0]
+            code.append(branch)
+            blocks.append([target, None])
+
+        elif cmd == '}{' and node.is_leaf:
+            if not blocks:
+                raise EsilError('}{ without ?{')
+            target = [None]
+            code.append(lambda vm, target=target: target[0])
+            blocks[-1][0][0] = len(code)
+            blocks[-1][1] = target
+
+        elif cmd == '}' and node.is_leaf:
+            if not blocks:
+                raise EsilError('} without ?{')
+            cond_target, else_target = blocks.pop()
+            if else_target is None:
+                cond_target[0] = len(code)
+            else:
+                else_target[0] = len(code)
+
+        elif cmd == 'BREAK' and node.is_leaf:
+            code.append(lambda vm: 1 << 62)
+
+        elif cmd == 'GOTO':
+            target = [None]
+            value = _compile_value(node.op1)
+            if value is None:
+                raise EsilError('GOTO needs a constant target')
+            gotos.append((node.op1, target))
+            code.append(lambda vm, target=target: target[0])
+
+        else:
+            statement = _compile_statement(node)
+            # a value statement directly followed by ?{ becomes one branch
+            if (statement is not None and i + 1 < len(statements)
+                    and statements[i + 1].token.cmd == '?{' and statements[i + 1].is_leaf
+                    and node.token.cmd != '==' and _compile_value(node) is not None):
+                value = _compile_value(node)
+                target = [None]
+                def branch(vm, value=value, target=target):
+                    if not value(vm):
+                        return target[0]
+                code.append(branch)
+                blocks.append([target, None])
+                token_index += 1
+                i += 1
+            elif statement is not None:
+                code.append(statement)
+            else:
+                code.extend(_generic_operation(op) for op in _postorder(node, []))
+        i += 1
+
+    if blocks:
+        raise EsilError('unterminated ?{')
+    for target_node, target in gotos:
+        if not target_node.is_integer or target_node.value not in token_starts:
+            raise EsilError(f'GOTO {target_node} does not start a statement')
+        target[0] = token_starts[target_node.value]
+
+    return EsilProgram(tree._expr, code)
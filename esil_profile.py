@@ -0,0 +1,198 @@
+import time
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+import esil
+import esil_analysis
+import example
+
+ProfileEntry = namedtuple('ProfileEntry', 'name calls seconds')
+
+def _label(function):
+    if function is None:
+        return 'all'
+    return f'fcn.{function:x}' if isinstance(function, int) else str(function)
+
+class Profiler:
+    ''' counters and timers for the hot paths of parsing, analysis, search
+    and r2 round trips.
+
+    Nothing is measured until enable(), which swaps timed wrappers into the
+    classes and modules, disable() puts the originals back. So with the
+    profiler off, the code runs exactly as if this module didn't exist.
+    Every timed call is recorded under the current function (see
+    function()) and its call stack, for per-function reports and folded
+    stacks flame graph tools read. '''
+    def __init__(self):
+        # (function, name) -> [calls, seconds including callees]
+        self.totals = dict()
+        # call path -> [calls, seconds spent in the frame itself]
+        self.stacks = dict()
+        self.current = None
+        self._frames = list()
+        self._originals = list()
+
+    def state(self):
+        ''' what was measured, to merge into the profiler of another process '''
+        return self.totals, self.stacks
+
+    def merge(self, state):
+        for table, other in zip((self.totals, self.stacks), state):
+            for key, (calls, seconds) in other.items():
+                entry = table.setdefault(key, [0, 0.0])
+                entry[0] += calls
+                entry[1] += seconds
+
+    @property
+    def enabled(self):
+        return bool(self._originals)
+
+    def clear(self):
+        self.totals.clear()
+        self.stacks.clear()
+
+    def _record(self, name, elapsed, own, path):
+        key = (self.current, name)
+        total = self.totals.get(key)
+        if total is None:
+            total = self.totals[key] = [0, 0.0]
+        total[0] += 1
+        total[1] += elapsed
+        stack = self.stacks.get(path)
+        if stack is None:
+            stack = self.stacks[path] = [0, 0.0]
+        stack[0] += 1
+        stack[1] += own
+
+    def timed(self, name, fn):
+        ''' fn wrapped to be recorded as name, name can be a callable
+        deriving it from the arguments '''
+        frames = self._frames
+        clock = time.perf_counter
+        record = self._record
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            label = name(*args, **kwargs) if callable(name) else name
+            parent = frames[-1] if frames else None
+            path = (parent[0] if parent else (self.current,)) + (label,)
+            # [path, seconds spent in callees]
+            frame = [path, 0.0]
+            frames.append(frame)
+            start = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                frames.pop()
+                if parent is not None:
+                    parent[1] += elapsed
+                record(label, elapsed, elapsed - frame[1], path)
+        return wrapper
+
+    def _patch(self, owner, attr, wrapper):
+        self._originals.append((owner, attr, owner.__dict__[attr]))
+        setattr(owner, attr, wrapper)
+
+    def enable(self):
+        if self.enabled:
+            return
+        timed = self.timed
+        tokenize = esil.tokenize
+        self._patch(esil, 'tokenize', timed('tokenize', lambda expr: list(tokenize(expr))))
+        self._patch(esil.EsilExpressionTree, '_parse',
+                    timed('parse', esil.EsilExpressionTree._parse))
+        self._patch(esil.EsilExpressionTreeNode, '__init__',
+                    timed('node', esil.EsilExpressionTreeNode.__init__))
+        self._patch(esil.EsilExpressionTree, 'search',
+                    timed('search', esil.EsilExpressionTree.search))
+        self._patch(esil.EsilExpressionTree, 'search_all',
+                    timed('search_all', esil.EsilExpressionTree.search_all))
+
+        # dispatch tables hold bound node_pass methods, so the engine wraps
+        # them as it builds the tables
+        build_dispatch = esil_analysis.AnalysisEngine._build_dispatch
+
+        def _build_dispatch(engine):
+            build_dispatch(engine)
+            wrapped = dict()
+            for analysis in engine.__dict__.values():
+                handler = analysis.node_pass
+                wrapped[handler] = timed(f'{type(analysis).__name__}.node_pass', handler)
+            engine.dispatch = {opcode: tuple(wrapped[handler] for handler in handlers)
+                               for opcode, handlers in engine.dispatch.items()}
+            engine.catch_all = tuple(wrapped[handler] for handler in engine.catch_all)
+
+        def _fini_analyses(engine):
+            for analysis in engine.__dict__.values():
+                timed(f'{type(analysis).__name__}.fini', analysis.fini)()
+
+        self._patch(esil_analysis.AnalysisEngine, '_build_dispatch', _build_dispatch)
+        self._patch(esil_analysis.AnalysisEngine, 'fini_analyses', _fini_analyses)
+
+        command = lambda api, cmd: f'r2 {cmd.split(maxsplit=1)[0] if cmd.strip() else cmd}'
+        self._patch(example.Radare2SimpleApi, '_cmd',
+                    timed(command, example.Radare2SimpleApi._cmd))
+        self._patch(example.Radare2SimpleApi, '_cmdj',
+                    timed(command, example.Radare2SimpleApi._cmdj))
+
+    def disable(self):
+        while self._originals:
+            owner, attr, original = self._originals.pop()
+            setattr(owner, attr, original)
+
+    @contextmanager
+    def function(self, addr):
+        ''' calls inside are recorded under the function at addr '''
+        previous, self.current = self.current, addr
+        try:
+            yield self
+        finally:
+            self.current = previous
+
+    def report(self, addr=None):
+        ''' ProfileEntry list of a function (of everything when addr is
+        None), most expensive first '''
+        merged = dict()
+        for (function, name), (calls, seconds) in self.totals.items():
+            if addr is None or function == addr:
+                entry = merged.setdefault(name, [0, 0.0])
+                entry[0] += calls
+                entry[1] += seconds
+        return sorted((ProfileEntry(name, calls, seconds)
+                       for name, (calls, seconds) in merged.items()),
+                      key=lambda entry: entry.seconds, reverse=True)
+
+    def functions(self):
+        return sorted({function for function, _ in self.totals}, key=lambda function:
+                      (function is None, function if isinstance(function, int) else 0))
+
+    def format_report(self, top=10):
+        lines = list()
+        for function in self.functions():
+            lines.append(_label(function))
+            for entry in self.report(function)[:top]:
+                lines.append(f'  {entry.name:<36} {entry.calls:>9} calls '
+                             f'{entry.seconds * 1000:10.3f} ms')
+        return '\n'.join(lines)
+
+    def folded(self):
+        ''' frame;frame;frame microseconds lines, as flamegraph.pl and
+        speedscope read them '''
+        lines = list()
+        for path, (_, seconds) in sorted(self.stacks.items(), key=lambda item: str(item[0])):
+            frames = [_label(path[0]), *path[1:]]
+            lines.append(f'{";".join(frames)} {round(seconds * 1e6)}')
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.folded())
+            f.write('\n')
+
+profiler = Profiler()
+
+def function(addr):
+    ''' profiler.function(addr) while profiling, a no-op otherwise '''
+    return profiler.function(addr) if profiler.enabled else nullcontext()
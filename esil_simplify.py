@@ -0,0 +1,290 @@
+import logging
+import time
+from collections import namedtuple
+from functools import lru_cache
+
+from esil import TOKEN_INTEGER, EsilExpressionTree, EsilNodeTable, parse_cache, parse_esil, preorder
+from esil_eval import MASK64, binary_operators, register, unary_operators
+
+logger = logging.getLogger('simplify')
+
+SimplifyResult = namedtuple('SimplifyResult', 'root before after elapsed')
+SimplifyInfo = namedtuple('SimplifyInfo', 'trees before after elapsed rewrites')
+
+class EsilRule:
+    ''' pattern -> replacement, both in ESIL. #1, #2, ... in the pattern
+    capture subtrees (the same capture twice has to match the same
+    subtree), any matches without capturing and integers match by value,
+    so 0 matches 0x0 too. The replacement is rebuilt from the captures. '''
+    def __init__(self, pattern, replacement):
+        self.pattern = EsilExpressionTree(pattern).root
+        self.replacement = EsilExpressionTree(replacement).root
+        self.opcode = self.pattern.token.opcode
+        self.text = f'{pattern} -> {replacement}'
+
+    def __repr__(self):
+        return f'<EsilRule {self.text}>'
+
+    def bind(self, node, pattern=None, captures=None):
+        ''' captures by name when the rule applies to node, None otherwise '''
+        if pattern is None:
+            pattern, captures = self.pattern, dict()
+        if pattern.token.cmd == 'any':
+            return captures
+        elif pattern.token.cmd.startswith('#'):
+            bound = captures.get(pattern.token.cmd)
+            if bound is None:
+                captures[pattern.token.cmd] = node
+            elif not (bound is node or bound == node):
+                return None
+            return captures
+        elif node is None:
+            return None
+        elif pattern.token.kind == TOKEN_INTEGER:
+            if (node.token.kind != TOKEN_INTEGER
+                    or node.token.value & MASK64 != pattern.token.value & MASK64):
+                return None
+            return captures
+        elif node.token is not pattern.token:
+            return None
+
+        for child, sub in ((node.op1, pattern.op1), (node.op2, pattern.op2)):
+            if sub is None:
+                if child is not None:
+                    return None
+            elif self.bind(child, sub, captures) is None:
+                return None
+        return captures
+
+    def build(self, captures, table, replacement=None):
+        if replacement is None:
+            replacement = self.replacement
+        cmd = replacement.token.cmd
+        if cmd.startswith('#'):
+            return captures[cmd]
+        op1 = self.build(captures, table, replacement.op1) if replacement.op1 is not None else None
+        op2 = self.build(captures, table, replacement.op2) if replacement.op2 is not None else None
+        return table(cmd, op1, op2)
+
+# a,b,op is b op a: op1 (b) comes last in the text
+default_rules = [
+    ('0,#1,+', '#1'),
+    ('#1,0,+', '#1'),
+    ('0,#1,-', '#1'),
+    ('#1,#1,-', '0'),
+    ('#1,#1,^', '0'),
+    ('0,#1,^', '#1'),
+    ('#1,0,^', '#1'),
+    ('#1,#1,&', '#1'),
+    ('#1,#1,|', '#1'),
+    ('0,#1,&', '0'),
+    ('#1,0,&', '0'),
+    ('0,#1,|', '#1'),
+    ('#1,0,|', '#1'),
+    ('1,#1,*', '#1'),
+    ('#1,1,*', '#1'),
+    ('0,#1,*', '0'),
+    ('#1,0,*', '0'),
+    ('1,#1,/', '#1'),
+    ('0,#1,<<', '#1'),
+    ('0,#1,>>', '#1'),
+    ('0,#1,>>>>', '#1'),
+    ('#1,!,!,!', '#1,!'),
+    ('#2,#1,-,#2,+', '#1'),
+    ('#2,#2,#1,-,+', '#1'),
+    ('#2,#2,#1,+,-', '#1'),
+    ('#2,#1,#2,+,-', '#1'),
+]
+
+# operators whose result is already 0 or 1, so !! is a no-op on them
+_boolean_operators = {'!', '<', '>', '<=', '>=', '$z', '$c', '$b', '$p', '$s', '$o'}
+
+def _is_boolean(node):
+    token = node.token
+    if token.cmd in _boolean_operators:
+        return True
+    elif token.kind == TOKEN_INTEGER:
+        return token.value in (0, 1)
+    return node.is_variable and register(token.cmd).bits == 1
+
+def _flag_size(node):
+    ''' the size == takes for the flags from its op1, None keeps the last one '''
+    if node.is_variable and node.is_leaf:
+        return register(node.token.cmd).bits
+    return None
+
+def _count(root):
+    return sum(1 for _ in preorder(root))
+
+class EsilSimplifier:
+    ''' bottom-up rewriting to a fixpoint. Every node is rebuilt through
+    the simplifier's node table once its children are simplified, then
+    folded and rewritten at its root until nothing applies. Simplified
+    nodes are memoized, so shared and repeated subtrees (and whole
+    instructions seen before) are never matched again. '''
+    def __init__(self, rules=default_rules, fold=True, maxsize=1 << 18):
+        self.rules = [rule if isinstance(rule, EsilRule) else EsilRule(*rule) for rule in rules]
+        self.fold = fold
+        self.maxsize = maxsize
+        self._buckets = dict()
+        for rule in self.rules:
+            self._buckets.setdefault(rule.opcode, []).append(rule)
+        self.node_table = EsilNodeTable()
+        self._memo = dict()
+        self._trees = self._before = self._after = self._rewrites = 0
+        self._elapsed = 0.0
+
+    def info(self):
+        return SimplifyInfo(self._trees, self._before, self._after, self._elapsed, self._rewrites)
+
+    def clear(self):
+        self.node_table = EsilNodeTable()
+        self._memo.clear()
+
+    def integer(self, value):
+        value &= MASK64
+        return self.node_table(str(value) if value < 10 else f'0x{value:x}')
+
+    def _offset(self, node):
+        ''' (base, k) when node is base + k or base - k with an integer k '''
+        cmd = node.token.cmd
+        if cmd in ('+', '-') and node.op2.token.kind == TOKEN_INTEGER:
+            k = node.op2.token.value
+            return node.op1, (k if cmd == '+' else -k) & MASK64
+        elif cmd == '+' and node.op1.token.kind == TOKEN_INTEGER:
+            return node.op2, node.op1.token.value & MASK64
+        return node, 0
+
+    def _fold(self, node):
+        token = node.token
+        cmd = token.cmd
+        op1, op2 = node.op1, node.op2
+        integers = ((op1 is not None and op1.token.kind == TOKEN_INTEGER)
+                    + (op2 is not None and op2.token.kind == TOKEN_INTEGER))
+        if cmd in ('+', '-') and op1 is not None and op2 is not None and integers == 1:
+            # 0x8,rbp,-,0x4,+ (4 + (rbp - 8)), 0x4,rbp,-,0x4,+ and the like
+            base, k = self._offset(node)
+            if base is not node:
+                inner, j = self._offset(base)
+                if inner is not base:
+                    return self._add(inner, (j + k) & MASK64)
+        if op1 is None or op1.token.kind != TOKEN_INTEGER:
+            if cmd == '!' and op1 is not None and op1.token.cmd == '!' and _is_boolean(op1.op1):
+                return op1.op1
+            return None
+
+        a = op1.token.value & MASK64
+        if op2 is None:
+            if cmd in unary_operators:
+                return self.integer(unary_operators[cmd](a))
+            return None
+        elif op2.token.kind != TOKEN_INTEGER or cmd not in binary_operators:
+            return None
+        b = op2.token.value & MASK64
+        if cmd in ('/', '%') and not b:
+            return None
+        return self.integer(binary_operators[cmd](a, b))
+
+    def _intern(self, node):
+        ''' node through the node table as it is '''
+        if node is None:
+            return None
+        return self.node_table(node.token.cmd, self._intern(node.op1), self._intern(node.op2))
+
+    def _add(self, base, k):
+        if not k:
+            return base
+        elif k >> 63:
+            return self.node_table('-', base, self.integer(-k))
+        return self.node_table('+', base, self.integer(k))
+
+    def _rewrite(self, node):
+        ''' one step at the root of node, None when it is in normal form '''
+        if self.fold:
+            folded = self._fold(node)
+            if folded is not None:
+                return folded
+        for rule in self._buckets.get(node.token.opcode, ()):
+            captures = rule.bind(node)
+            if captures is not None:
+                return rule.build(captures, self.node_table)
+        return None
+
+    def simplify(self, root):
+        ''' the simplified, hash-consed equivalent of root '''
+        if root is None:
+            return None
+        if len(self.node_table) > self.maxsize:
+            self.clear()
+
+        # memo is keyed by canonical nodes of the table, so lookups are
+        # identity hits. The nodes of root are only known by id for the call.
+        memo = self._memo
+        table = self.node_table
+        simplified = dict()
+        pending = set()
+        stack = [(root, 0, None)]
+        while stack:
+            node, state, step = stack.pop()
+            if node is None:
+                continue
+            key = id(node)
+
+            if state == 0:
+                if key not in simplified:
+                    stack.append((node, 1, None))
+                    stack.append((node.op1, 0, None))
+                    stack.append((node.op2, 0, None))
+            elif state == 1:
+                if key in simplified:
+                    continue
+                op1 = simplified[id(node.op1)] if node.op1 is not None else None
+                op2 = simplified[id(node.op2)] if node.op2 is not None else None
+                if node.token.cmd == '==' and _flag_size(op1) != _flag_size(node.op1):
+                    # 0,eax,eax,&,== keeps the last size, 0,eax,== sets 32
+                    op1 = self._intern(node.op1)
+                rebuilt = table(node.token.cmd, op1, op2)
+                done = memo.get(rebuilt)
+                if done is not None:
+                    simplified[key] = done
+                    continue
+                result = self._rewrite(rebuilt) if rebuilt not in pending else None
+                if result is None or result is rebuilt:
+                    simplified[key] = memo[rebuilt] = rebuilt
+                else:
+                    self._rewrites += 1
+                    pending.add(rebuilt)
+                    stack.append((node, 2, (rebuilt, result)))
+                    stack.append((result, 0, None))
+            else:
+                rebuilt, result = step
+                simplified[key] = memo[rebuilt] = simplified[id(result)]
+        return simplified[id(root)]
+
+    def simplify_tree(self, tree):
+        ''' SimplifyResult with node counts before and after '''
+        root = tree.root if isinstance(tree, EsilExpressionTree) else tree
+        start = time.perf_counter()
+        simplified = self.simplify(root)
+        elapsed = time.perf_counter() - start
+        before, after = _count(root), _count(simplified)
+        self._trees += 1
+        self._before += before
+        self._after += after
+        self._elapsed += elapsed
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'{root} -> {simplified}, {before} -> {after} nodes in {elapsed * 1e6:.1f} us')
+        return SimplifyResult(simplified, before, after, elapsed)
+
+default_simplifier = EsilSimplifier()
+
+@lru_cache(maxsize=4096)
+def simplify_esil(expr):
+    ''' simplified ESIL text of expr, for parse_esil and the passes '''
+    store = parse_cache.store
+    text = store.get_text('simplify', expr) if store is not None else None
+    if text is None:
+        text = str(default_simplifier.simplify_tree(parse_esil(expr)).root)
+        if store is not None:
+            store.add_text('simplify', expr, text)
+    return text
@@ -0,0 +1,295 @@
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+from contextlib import contextmanager
+
+import esil
+import esil_analysis
+import esil_dataflow
+import esil_eval
+import esil_simplify
+from esil_dataflow import AccessCatcher
+
+MAGIC = b'ESIL'
+FORMAT_VERSION = 2
+
+# magic, format, code version, index offset, entry count
+_header = struct.Struct('<4sI16sQQ')
+# function address, key (hash of the ESIL string and what is stored), record offset, length
+_entry = struct.Struct('<QQQQ')
+_u32 = struct.Struct('<I')
+
+RECORD_TEXT = 1
+RECORD_ANALYSIS = 2
+
+def code_version(modules=(esil, esil_analysis, esil_dataflow, esil_eval, esil_simplify)):
+    ''' digest of the sources stored results depend on, files written by
+    another version are thrown away '''
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(_u32.pack(FORMAT_VERSION))
+    for module in modules:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.digest()
+
+def binary_hash(hashes):
+    ''' the strongest hash of itj output '''
+    for name in ('sha256', 'sha1', 'md5'):
+        if hashes.get(name):
+            return hashes[name]
+    raise Exception('no binary hash in itj output')
+
+def _key(expr, names=()):
+    text = '\0'.join((expr, *names)).encode()
+    return int.from_bytes(hashlib.blake2b(text, digest_size=8).digest(), 'little')
+
+# analysis results as signed 64-bit ints, strings as indices into the
+# record's own strings. decode returns the analysis and the position after
+# its data. Only results that don't point into the tree can be stored,
+# a stored analysis comes back without one.
+
+def _encode_accesses(catcher, string):
+    # events as (use/def | stack << 1, register or offset, full), the node
+    # of a use only matters while catching
+    out = [len(catcher.events)]
+    for kind, location, extra in catcher.events:
+        tag = int(kind == 'def')
+        if isinstance(location, str):
+            out += (tag, string(location), int(kind == 'def' and extra))
+        else:
+            out += (tag | 2, location[1], int(extra))
+    out.append(len(catcher.escaped))
+    out += (offset for _, offset in catcher.escaped)
+    return out
+
+def _decode_accesses(data, pos, strings):
+    catcher = AccessCatcher()
+    catcher.events = events = list()
+    count = data[pos]
+    pos += 1
+    for i in range(pos, pos + 3 * count, 3):
+        tag, location, extra = data[i:i + 3]
+        kind = 'def' if tag & 1 else 'use'
+        if tag & 2:
+            events.append((kind, ('rbp', location), bool(extra)))
+        else:
+            events.append((kind, strings[location], bool(extra) if kind == 'def' else None))
+    pos += 3 * count
+    count = data[pos]
+    catcher.escaped = {('rbp', offset) for offset in data[pos + 1:pos + 1 + count]}
+    return catcher, pos + 1 + count
+
+# analyses whose results can be stored, by type
+analysis_codecs = {
+    AccessCatcher: (_encode_accesses, _decode_accesses),
+}
+
+class EsilStore:
+    ''' per-instruction results for one binary, on disk: simplified ESIL
+    and the analysis results the dataflow needs.
+
+    Parsed trees themselves are not stored, parsing one again costs about
+    as much as decoding it. Analysis results are kept as int64s through
+    analysis_codecs. The file is memory-mapped and the sorted index is
+    binary searched in place, so only the records that are asked for get
+    read. New entries are kept in memory until save(), which rewrites the
+    file. '''
+    def __init__(self, path, version=None):
+        self.path = path
+        self.version = code_version() if version is None else version
+        self.addr = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = False
+        self._pending = dict()
+        self._file = None
+        self._map = None
+        self._index = 0
+        self._entries = 0
+        self._load()
+
+    @classmethod
+    def for_binary(cls, directory, hashes, version=None):
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, f'{binary_hash(hashes)}.esil'), version)
+
+    def __len__(self):
+        return self._entries + len(self._pending)
+
+    def _load(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < _header.size:
+            return
+        self._file = open(self.path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, file_format, version, index, entries = _header.unpack_from(self._map)
+        if magic != MAGIC or file_format != FORMAT_VERSION or version != self.version:
+            self.invalidated = True
+            self.close()
+            return
+        self._index = index
+        self._entries = entries
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._map = self._file = None
+        self._index = self._entries = 0
+
+    @contextmanager
+    def function(self, addr):
+        ''' entries looked up and added inside belong to the function at addr '''
+        previous, self.addr = self.addr, addr
+        try:
+            yield self
+        finally:
+            self.addr = previous
+
+    def _find(self, addr, key):
+        lo, hi = 0, self._entries
+        target = (addr, key)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = _entry.unpack_from(self._map, self._index + mid * _entry.size)
+            if entry[:2] < target:
+                lo = mid + 1
+            elif entry[:2] > target:
+                hi = mid
+            else:
+                return self._map[entry[2]:entry[2] + entry[3]]
+        return None
+
+    def _lookup(self, addr, key, kind, expr):
+        ''' the fields of the pending entry or stored record, None when it
+        is missing or was stored for another expression with the same key '''
+        addr = self.addr if addr is None else addr
+        entry = self._pending.get((addr, key))
+        if entry is not None:
+            return entry[2:] if entry[:2] == (kind, expr) else None
+        elif self._map is None:
+            return None
+        record = self._find(addr, key)
+        if record is None or record[0] != kind:
+            return None
+        size, = _u32.unpack_from(record, 1)
+        if record[5:5 + size] != expr.encode():
+            return None
+        pos = 5 + size
+        if kind == RECORD_TEXT:
+            return (record[pos:].decode(),)
+
+        size, = _u32.unpack_from(record, pos)
+        pos += 4
+        strings = record[pos:pos + size].decode().split('\0') if size else []
+        data = array('q')
+        data.frombytes(record[pos + size:])
+        return strings, data
+
+    def _record(self, kind, expr, *fields):
+        text = expr.encode()
+        head = bytes((kind,)) + _u32.pack(len(text)) + text
+        if kind == RECORD_TEXT:
+            return head + fields[0].encode()
+        strings, data = fields
+        strings = '\0'.join(strings).encode()
+        return head + _u32.pack(len(strings)) + strings + data.tobytes()
+
+    def encode(self, analysis):
+        ''' (strings, int64 array) of an analysis' results '''
+        strings = list()
+        string_ids = dict()
+
+        def string(text):
+            string_id = string_ids.get(text)
+            if string_id is None:
+                string_id = string_ids[text] = len(strings)
+                strings.append(text)
+            return string_id
+
+        data = array('q', analysis_codecs[type(analysis)][0](analysis, string))
+        return tuple(strings), data
+
+    def get_analysis(self, expr, analysis_class, addr=None):
+        ''' the stored results of an analysis_class run on expr, in the
+        function at addr (the current function by default) '''
+        entry = None
+        if analysis_class in analysis_codecs:
+            entry = self._lookup(addr, _key(expr, ('analysis', analysis_class.__name__)),
+                                 RECORD_ANALYSIS, expr)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        strings, data = entry
+        return analysis_codecs[analysis_class][1](data, 0, strings)[0]
+
+    def add_analysis(self, expr, analysis, addr=None):
+        analysis_class = type(analysis)
+        if analysis_class not in analysis_codecs:
+            return
+        addr = self.addr if addr is None else addr
+        key = _key(expr, ('analysis', analysis_class.__name__))
+        self._pending[(addr, key)] = (RECORD_ANALYSIS, expr, *self.encode(analysis))
+
+    def get_text(self, namespace, expr, addr=None):
+        ''' a string stored for expr under namespace, like its simplified ESIL '''
+        entry = self._lookup(addr, _key(expr, (namespace,)), RECORD_TEXT, expr)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def add_text(self, namespace, expr, text, addr=None):
+        addr = self.addr if addr is None else addr
+        self._pending[(addr, _key(expr, (namespace,)))] = (RECORD_TEXT, expr, text)
+
+    def pending(self):
+        ''' entries added since the last save, for merging into another store '''
+        return dict(self._pending)
+
+    def merge(self, entries):
+        self._pending.update(entries)
+
+    def save(self):
+        ''' writes stored and new records to a fresh file, then maps it '''
+        if not self._pending:
+            return
+        records = dict()
+        for i in range(self._entries):
+            addr, key, offset, size = _entry.unpack_from(self._map, self._index + i * _entry.size)
+            records[(addr, key)] = self._map[offset:offset + size]
+        for key, entry in self._pending.items():
+            records[key] = self._record(*entry)
+
+        index = list()
+        body = list()
+        offset = _header.size
+        for addr, key in sorted(records):
+            record = records[(addr, key)]
+            index.append(_entry.pack(addr, key, offset, len(record)))
+            body.append(record)
+            offset += len(record)
+
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_header.pack(MAGIC, FORMAT_VERSION, self.version, offset, len(index)))
+            f.writelines(body)
+            f.writelines(index)
+        self.close()
+        os.replace(tmp, self.path)
+        self._pending.clear()
+        self._load()
+
+@contextmanager
+def attached(store, cache=None):
+    ''' simplify_esil and FunctionDataflow misses go through store while inside '''
+    if cache is None:
+        cache = esil.parse_cache
+    previous, cache.store = cache.store, store
+    try:
+        yield store
+    finally:
+        cache.store = previous
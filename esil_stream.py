@@ -0,0 +1,71 @@
+import mmap
+import os
+from collections import deque, namedtuple
+
+from esil import EsilExpressionTree, parse_esil
+
+TraceRecord = namedtuple('TraceRecord', 'lineno offset tree events')
+
+def read_lines(source, buffer_size=1 << 20):
+    ''' lines of a trace file (memory-mapped when possible), a file object
+    or any iterable of strings '''
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb', buffering=buffer_size) as f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # empty files and pipes can't be mapped
+                for line in f:
+                    yield line.decode()
+                return
+            with mapped:
+                for line in iter(mapped.readline, b''):
+                    yield line.decode()
+        return
+
+    for line in source:
+        yield line.decode() if isinstance(line, bytes) else line
+
+def parse_line(line):
+    ''' "esil" or "offset esil", blank lines and # comments give None '''
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    offset, _, expr = line.partition(' ')
+    if not expr:
+        return None, offset
+    return int(offset, 0), expr.strip()
+
+def stream_trace(source, external_analyses=dict({}), emit=False):
+    ''' parses and analyzes a trace one instruction at a time.
+
+    With emit=False trees come from the parse cache and carry the usual
+    analysis results. With emit=True the analyses stream events into the
+    record instead of accumulating them, and nothing is kept around. '''
+    for lineno, line in enumerate(read_lines(source), 1):
+        parsed = parse_line(line)
+        if parsed is None:
+            continue
+        offset, expr = parsed
+        if emit:
+            events = list()
+            tree = EsilExpressionTree(expr, external_analyses, sink=events.append)
+        else:
+            events = ()
+            tree = parse_esil(expr, external_analyses)
+        yield TraceRecord(lineno, offset, tree, events)
+
+def stream_events(source, external_analyses=dict({})):
+    ''' (record, event) for every analysis event in the trace '''
+    for record in stream_trace(source, external_analyses, emit=True):
+        for event in record.events:
+            yield record, event
+
+def sliding_window(records, size):
+    ''' tuples of the last `size` records, for analyses that look across
+    neighbouring instructions '''
+    window = deque(maxlen=size)
+    for record in records:
+        window.append(record)
+        if len(window) == size:
+            yield tuple(window)
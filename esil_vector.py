@@ -0,0 +1,389 @@
+from collections import namedtuple
+
+from esil import TOKEN_INTEGER, TOKEN_VARIABLE, EsilExpressionTree, parse_esil
+from esil_eval import (EsilError, Register, genmask, memory_update_operators,
+                       peek_operators, poke_operators, register)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+VectorResult = namedtuple('VectorResult', 'state stack flags trapped')
+
+def _u64(value):
+    return np.uint64(value & 0xffffffffffffffff)
+
+def _mask(bits):
+    return _u64(genmask(bits - 1))
+
+def _masks(bits):
+    ''' _mask of every lane, bits an array '''
+    return np.where((bits > 0) & (bits < 64),
+                    (_u64(1) << (bits & _u64(63))) - _u64(1), _mask(64))
+
+def _signed(a):
+    return np.asarray(a, dtype=np.uint64).astype(np.int64)
+
+def _shl(a, b):
+    return np.where(b < 64, a << (b & _u64(63)), _u64(0))
+
+def _shr(a, b):
+    return np.where(b < 64, a >> (b & _u64(63)), _u64(0))
+
+def _asr(a, b):
+    shift = np.minimum(b, _u64(63)).astype(np.int64)
+    return (_signed(a) >> shift).astype(np.uint64)
+
+def _ror(a, b):
+    b = b & _u64(63)
+    return (a >> b) | np.where(b == 0, _u64(0), a << ((_u64(64) - b) & _u64(63)))
+
+def _rol(a, b):
+    b = b & _u64(63)
+    return (a << b) | np.where(b == 0, _u64(0), a >> ((_u64(64) - b) & _u64(63)))
+
+def _div(a, b):
+    with np.errstate(divide='ignore'):
+        return np.where(b == 0, _u64(0), a // np.where(b == 0, _u64(1), b))
+
+def _mod(a, b):
+    with np.errstate(divide='ignore'):
+        return np.where(b == 0, _u64(0), a % np.where(b == 0, _u64(1), b))
+
+# same table layout as esil_eval, uint64 arrays wrap around by themselves
+binary_operators = {
+    '+'   : lambda a, b: a + b,
+    '-'   : lambda a, b: a - b,
+    '*'   : lambda a, b: a * b,
+    '/'   : _div,
+    '%'   : _mod,
+    '&'   : lambda a, b: a & b,
+    '|'   : lambda a, b: a | b,
+    '^'   : lambda a, b: a ^ b,
+    '<<'  : _shl,
+    '>>'  : _shr,
+    '>>>>': _asr,
+    '>>>' : _ror,
+    '<<<' : _rol,
+}
+
+comparison_operators = {
+    '<' : lambda a, b: _signed(a) < _signed(b),
+    '>' : lambda a, b: _signed(a) > _signed(b),
+    '<=': lambda a, b: _signed(a) <= _signed(b),
+    '>=': lambda a, b: _signed(a) >= _signed(b),
+}
+
+unary_operators = {
+    '!' : lambda a: (a == 0).astype(np.uint64),
+    '++': lambda a: a + _u64(1),
+    '--': lambda a: a - _u64(1),
+}
+
+update_operators = {f'{cmd}=': fn for cmd, fn in binary_operators.items()}
+unary_update_operators = {'++=': unary_operators['++'],
+                          '--=': unary_operators['--'],
+                          '!=' : unary_operators['!']}
+
+class EsilVectorState:
+    ''' one register file and memory per lane, every register is a uint64
+    array with one entry per lane '''
+    def __init__(self, registers=dict({}), memory=dict({}), lanes=None):
+        if np is None:
+            raise ImportError('numpy is required for vectorized evaluation')
+
+        if lanes is None:
+            lanes = max([np.size(value) for value in registers.values()] or [1])
+        self.lanes = lanes
+        self.regs = dict()
+        # address -> uint8 array, addresses no lane wrote read as 0
+        self.memory = {addr: np.broadcast_to(np.asarray(value, dtype=np.uint8), (lanes,)).copy()
+                       for addr, value in memory.items()}
+        self.old = self.zeros()
+        self.cur = self.zeros()
+        # per lane, a masked off lane keeps the width of its own last operation
+        self.lastsz = self.array(64)
+        self.trapped = np.zeros(lanes, dtype=bool)
+        for name, value in registers.items():
+            self.write(register(name), self.array(value), self.everywhere())
+
+    def zeros(self):
+        return np.zeros(self.lanes, dtype=np.uint64)
+
+    def everywhere(self):
+        return np.ones(self.lanes, dtype=bool)
+
+    def array(self, value):
+        return np.broadcast_to(np.asarray(value, dtype=np.uint64), (self.lanes,)).copy()
+
+    def read(self, reg):
+        parent = self.regs.get(reg.parent)
+        if parent is None:
+            return self.zeros()
+        return (parent >> _u64(reg.shift)) & _u64(reg.mask)
+
+    def write(self, reg, value, active):
+        parent = self.regs.get(reg.parent)
+        if parent is None:
+            parent = self.zeros()
+        field = _u64(reg.mask << reg.shift)
+        new = (parent & ~field) | ((value << _u64(reg.shift)) & field)
+        self.regs[reg.parent] = np.where(active, new, parent)
+
+    def get_register(self, name):
+        return self.read(register(name))
+
+    def value(self, item):
+        if isinstance(item, Register):
+            return self.read(item)
+        return item
+
+    def load(self, addr, size):
+        value = self.zeros()
+        addrs = np.unique(addr)
+        for i in range(size - 1, -1, -1):
+            if len(addrs) == 1:
+                byte = self.memory.get(int(addrs[0]) + i)
+                byte = byte.astype(np.uint64) if byte is not None else self.zeros()
+            else:
+                # lanes disagree on the address, gather per distinct address
+                byte = self.zeros()
+                for base in addrs:
+                    stored = self.memory.get(int(base) + i)
+                    if stored is not None:
+                        lanes = addr == base
+                        byte[lanes] = stored[lanes]
+            value = (value << _u64(8)) | byte
+        return value
+
+    def store(self, addr, size, value, active):
+        for base in np.unique(addr[active]) if active.any() else ():
+            lanes = active & (addr == base)
+            for i in range(size):
+                stored = self.memory.get(int(base) + i)
+                if stored is None:
+                    stored = self.memory[int(base) + i] = np.zeros(self.lanes, dtype=np.uint8)
+                stored[lanes] = ((value[lanes] >> _u64(8 * i)) & _u64(0xff)).astype(np.uint8)
+
+    def set_size(self, bits, active):
+        self.lastsz = np.where(active, _u64(bits), self.lastsz)
+
+    def set_flags(self, old, cur, active, lastsz=None):
+        self.old = np.where(active, old, self.old)
+        self.cur = np.where(active, cur, self.cur)
+        if lastsz is not None:
+            self.set_size(lastsz, active)
+
+    def flag(self, cmd, bit=None):
+        ''' radare2 flag semantics on every lane at once '''
+        old, cur = self.old, self.cur
+        if cmd == '$z':
+            return ((cur & _masks(self.lastsz)) == 0).astype(np.uint64)
+        elif cmd == '$p':
+            low = cur & _u64(0xff)
+            ones = self.zeros()
+            for i in range(8):
+                ones += (low >> _u64(i)) & _u64(1)
+            return ((ones & _u64(1)) == 0).astype(np.uint64)
+        elif cmd == '$c':
+            mask = _u64(genmask(bit))
+            return ((cur & mask) < (old & mask)).astype(np.uint64)
+        elif cmd == '$b':
+            mask = _u64(genmask(bit - 1))
+            return ((old & mask) < (cur & mask)).astype(np.uint64)
+        elif cmd == '$s':
+            return (cur >> _u64(bit)) & _u64(1) if bit < 64 else self.zeros()
+        elif cmd == '$o':
+            m0, m1 = _u64(genmask(bit & 0x3f)), _u64(genmask((bit + 0x3f) & 0x3f))
+            return (((cur & m0) < (old & m0)) ^ ((cur & m1) < (old & m1))).astype(np.uint64)
+        raise EsilError(f'{cmd} is not a flag')
+
+    def flags(self, bits=None):
+        ''' every flag of the last operation, sign and overflow at `bits`,
+        by default at the width of every lane's last operation '''
+        if bits is None:
+            flags = None
+            for size in np.unique(self.lastsz):
+                lanes = self.lastsz == size
+                sized = self.flags(int(size))
+                flags = sized if flags is None else {
+                    name: np.where(lanes, value, flags[name]) for name, value in sized.items()}
+            return flags
+        return {'$z': self.flag('$z'),
+                '$p': self.flag('$p'),
+                '$c': self.flag('$c', bits - 1),
+                '$b': self.flag('$b', bits),
+                '$s': self.flag('$s', bits - 1),
+                '$o': self.flag('$o', bits - 1)}
+
+def _postorder(root):
+    out = list()
+    stack = [(root, False)]
+    while stack:
+        node, visited = stack.pop()
+        if node is None:
+            continue
+        if visited:
+            if node.token.cmd != 'seq':
+                out.append(node.token)
+        else:
+            stack.append((node, True))
+            stack.append((node.op1, False))
+            stack.append((node.op2, False))
+    return out
+
+def _tokens(tree):
+    ''' token stream of a tree, cached on it like compiled programs are '''
+    tokens = getattr(tree, 'vector_tokens', None)
+    if tokens is None:
+        tokens = tree.vector_tokens = _postorder(tree.root)
+    return tokens
+
+def evaluate(tree, registers=dict({}), memory=dict({}), lanes=None, state=None):
+    ''' runs the expression on every lane. registers maps names to arrays
+    (or scalars, broadcast to every lane). Conditional blocks run under a
+    per-lane mask, writes only land in the lanes where they are active. '''
+    if isinstance(tree, str):
+        tree = parse_esil(tree)
+    elif not isinstance(tree, EsilExpressionTree):
+        raise Exception('Expression type not recognized.')
+
+    if state is None:
+        state = EsilVectorState(registers, memory, lanes)
+    stack = list()
+    active = state.everywhere()
+    blocks = list()     # (active mask outside the block, condition)
+
+    def pop_value(cmd):
+        if not stack:
+            raise EsilError(f'{cmd}: stack underflow')
+        return state.value(stack.pop())
+
+    def pop_register(cmd):
+        if not stack or not isinstance(stack[-1], Register):
+            raise EsilError(f'{cmd}: destination is not a register')
+        return stack.pop()
+
+    for token in _tokens(tree):
+        cmd = token.cmd
+
+        if token.kind == TOKEN_INTEGER:
+            stack.append(state.array(token.value & 0xffffffffffffffff))
+        elif token.kind == TOKEN_VARIABLE:
+            stack.append(register(cmd))
+
+        elif cmd == '?{':
+            cond = pop_value(cmd) != 0
+            blocks.append((active, cond))
+            active = active & cond
+        elif cmd == '}{':
+            if not blocks:
+                raise EsilError('}{ without ?{')
+            outer, cond = blocks[-1]
+            active = outer & ~cond
+        elif cmd == '}':
+            if not blocks:
+                raise EsilError('} without ?{')
+            active = blocks.pop()[0]
+
+        elif cmd in binary_operators:
+            a = pop_value(cmd)
+            b = pop_value(cmd)
+            if cmd in ('/', '%'):
+                state.trapped |= active & (b == 0)
+            stack.append(binary_operators[cmd](a, b))
+        elif cmd in comparison_operators:
+            a = pop_value(cmd)
+            b = pop_value(cmd)
+            state.set_flags(a, a - b, active)
+            stack.append(comparison_operators[cmd](a, b).astype(np.uint64))
+        elif cmd in unary_operators:
+            stack.append(unary_operators[cmd](pop_value(cmd)))
+        elif cmd == '==':
+            dst = stack[-1] if stack else None
+            a = pop_value(cmd)
+            b = pop_value(cmd)
+            state.set_flags(a, a - b, active,
+                            dst.bits if isinstance(dst, Register) else None)
+
+        elif cmd in ('=', ':=') or cmd in update_operators or cmd in unary_update_operators:
+            reg = pop_register(cmd)
+            old = state.read(reg)
+            if cmd in unary_update_operators:
+                new = unary_update_operators[cmd](old)
+            elif cmd in update_operators:
+                src = pop_value(cmd)
+                if cmd in ('/=', '%='):
+                    state.trapped |= active & (src == 0)
+                new = update_operators[cmd](old, src)
+            else:
+                new = pop_value(cmd)
+            new = new & _u64(reg.mask)
+            state.write(reg, new, active)
+            if cmd != ':=':
+                state.set_flags(old, new, active, reg.bits)
+
+        elif cmd in peek_operators:
+            size = peek_operators[cmd]
+            stack.append(state.load(pop_value(cmd), size))
+            state.set_size(size * 8, active)
+        elif cmd in poke_operators:
+            size = poke_operators[cmd]
+            addr = pop_value(cmd)
+            state.store(addr, size, pop_value(cmd), active)
+        elif cmd in memory_update_operators:
+            fn, size = memory_update_operators[cmd]
+            addr = pop_value(cmd)
+            old = state.load(addr, size)
+            op = cmd[:cmd.index('[')]
+            if op in unary_update_operators:
+                new = unary_update_operators[op](old)
+            else:
+                src = pop_value(cmd)
+                if op in ('/=', '%='):
+                    state.trapped |= active & (src == 0)
+                new = update_operators[op](old, src)
+            new = new & _mask(size * 8)
+            state.store(addr, size, new, active)
+            state.set_flags(old, new, active, size * 8)
+
+        elif cmd in ('$z', '$p'):
+            stack.append(state.flag(cmd))
+        elif cmd in ('$c', '$b', '$s', '$o'):
+            bits = pop_value(cmd)
+            if len(np.unique(bits)) != 1:
+                raise EsilError(f'{cmd}: flag width differs between lanes')
+            stack.append(state.flag(cmd, int(bits[0])))
+        elif cmd == '$r':
+            stack.append(state.array(8))
+        elif cmd == 'NUM':
+            stack.append(pop_value(cmd))
+        elif cmd == 'DUP':
+            stack.append(stack[-1])
+        elif cmd == 'POP':
+            stack.pop()
+        elif cmd == 'CLEAR':
+            stack.clear()
+        elif cmd == 'STACK':
+            pass
+        else:
+            raise EsilError(f'{cmd} is not supported in vectorized evaluation')
+
+    if blocks:
+        raise EsilError('unterminated ?{')
+
+    return VectorResult(state, [state.value(item) for item in stack],
+                        state.flags(), state.trapped)
+
+def invariant_value(tree, registers=dict({}), memory=dict({}), lanes=None, register_name=None):
+    ''' the value of a register (or of the top of the stack) when every lane
+    agrees on it, None otherwise '''
+    result = evaluate(tree, registers, memory, lanes)
+    if register_name is not None:
+        values = result.state.get_register(register_name)
+    elif result.stack:
+        values = result.stack[-1]
+    else:
+        return None
+    return int(values[0]) if np.all(values == values[0]) else None
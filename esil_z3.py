@@ -0,0 +1,500 @@
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+
+from esil import TOKEN_INTEGER, TOKEN_VARIABLE, EsilExpressionTree, parse_esil
+from esil_eval import (MASK64, EsilError, Register, _postorder, _statements, genmask,
+                       memory_update_operators, peek_operators, poke_operators, register)
+
+try:
+    import z3
+except ImportError:
+    z3 = None
+
+ALWAYS, NEVER = 'always', 'never'
+
+QueryInfo = namedtuple('QueryInfo', 'hits misses solver_calls maxsize currsize')
+
+def _ror(a, b):
+    return z3.RotateRight(a, b & 63)
+
+def _rol(a, b):
+    return z3.RotateLeft(a, b & 63)
+
+# same layout as esil_eval's tables, on 64-bit bit-vectors. z3 defines
+# division by zero instead of trapping, x/0 is all ones and x%0 is x
+binary_operators = {
+    '+'   : lambda a, b: a + b,
+    '-'   : lambda a, b: a - b,
+    '*'   : lambda a, b: a * b,
+    '/'   : lambda a, b: z3.UDiv(a, b),
+    '%'   : lambda a, b: z3.URem(a, b),
+    '&'   : lambda a, b: a & b,
+    '|'   : lambda a, b: a | b,
+    '^'   : lambda a, b: a ^ b,
+    '<<'  : lambda a, b: a << b,
+    '>>'  : lambda a, b: z3.LShR(a, b),
+    '>>>>': lambda a, b: a >> b,
+    '>>>' : _ror,
+    '<<<' : _rol,
+}
+
+# bit-vector comparisons are signed, like radare2's
+comparison_operators = {
+    '<' : lambda a, b: a < b,
+    '>' : lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+}
+
+_booleans = dict()
+
+def _bool(cond):
+    values = _booleans.get(cond.ctx)
+    if values is None:
+        values = _booleans[cond.ctx] = (z3.BitVecVal(1, 64, cond.ctx), z3.BitVecVal(0, 64, cond.ctx))
+    return z3.If(cond, *values)
+
+unary_operators = {
+    '!' : lambda a: _bool(a == 0),
+    '++': lambda a: a + 1,
+    '--': lambda a: a - 1,
+}
+
+update_operators = {f'{cmd}=': fn for cmd, fn in binary_operators.items()}
+unary_update_operators = {'++=': unary_operators['++'],
+                          '--=': unary_operators['--'],
+                          '!=' : unary_operators['!']}
+
+class EsilZ3State:
+    ''' symbolic register file and memory. Registers that were never
+    written are free 64-bit constants named after their parent register,
+    so the same expression on the same block entry state always lowers to
+    the same (hash-consed) z3 term. Subtrees are memoized until the next
+    write. '''
+    def __init__(self, ctx=None):
+        if z3 is None:
+            raise ImportError('z3-solver is required for symbolic lowering')
+
+        self.ctx = ctx or z3.main_ctx()
+        self.constants = dict()
+        self.regs = dict()
+        self.memory = z3.Array('mem', z3.BitVecSort(64, self.ctx), z3.BitVecSort(8, self.ctx))
+        self.generation = 0
+        self.old = self.symbol('old')
+        self.cur = self.symbol('cur')
+        # width of the last operation as the mask $z applies, a term since
+        # a guarded operation only sets it when the guard holds
+        self.size_mask = self.const(MASK64)
+        self.guard = z3.BoolVal(True, self.ctx)
+        self.conditions = list()
+        self.memo = dict()
+
+    def const(self, value):
+        value &= MASK64
+        const = self.constants.get(value)
+        if const is None:
+            const = self.constants[value] = z3.BitVecVal(value, 64, self.ctx)
+        return const
+
+    def symbol(self, name):
+        if self.generation:
+            name = f'{name}!{self.generation}'
+        return z3.BitVec(name, 64, self.ctx)
+
+    def havoc(self):
+        ''' forget everything, after an instruction that couldn't be lowered '''
+        self.generation += 1
+        self.regs.clear()
+        self.memory = z3.Array(f'mem!{self.generation}',
+                               z3.BitVecSort(64, self.ctx), z3.BitVecSort(8, self.ctx))
+        self.old = self.symbol('old')
+        self.cur = self.symbol('cur')
+        self.guard = z3.BoolVal(True, self.ctx)
+        self.memo.clear()
+
+    def _guarded(self, new, old):
+        if z3.is_true(self.guard) or new.eq(old):
+            return new
+        return z3.If(self.guard, new, old)
+
+    def read(self, reg):
+        parent = self.regs.get(reg.parent)
+        if parent is None:
+            parent = self.regs[reg.parent] = self.symbol(reg.parent)
+        if reg.bits == 64:
+            return parent
+        return z3.LShR(parent, self.const(reg.shift)) & self.const(reg.mask)
+
+    def write(self, reg, value):
+        parent = self.read(register(reg.parent))
+        if reg.bits == 64:
+            new = value
+        else:
+            field = reg.mask << reg.shift
+            new = ((parent & self.const(~field)) |
+                   ((value << self.const(reg.shift)) & self.const(field)))
+        self.regs[reg.parent] = z3.simplify(self._guarded(new, parent))
+        self.memo.clear()
+
+    def get_register(self, name):
+        return self.read(register(name))
+
+    def load(self, addr, size):
+        value = z3.Select(self.memory, addr)
+        for i in range(1, size):
+            value = z3.Concat(z3.Select(self.memory, addr + self.const(i)), value)
+        if size < 8:
+            return z3.simplify(z3.ZeroExt(64 - size * 8, value))
+        return z3.simplify(z3.Extract(63, 0, value))
+
+    def store(self, addr, size, value):
+        memory = self.memory
+        for i in range(size):
+            memory = z3.Store(memory, addr + self.const(i), z3.Extract(8 * i + 7, 8 * i, value))
+        self.memory = self._guarded(memory, self.memory)
+        self.memo.clear()
+
+    def set_size(self, bits):
+        self.size_mask = self._guarded(self.const(genmask(bits - 1)), self.size_mask)
+        self.memo.clear()
+
+    def set_flags(self, old, cur, lastsz=None):
+        self.old = self._guarded(old, self.old)
+        self.cur = self._guarded(cur, self.cur)
+        if lastsz is not None:
+            self.set_size(lastsz)
+        self.memo.clear()
+
+    def flag(self, cmd, bit=None):
+        ''' radare2 flag semantics, see esil_eval '''
+        old, cur = self.old, self.cur
+        if cmd == '$z':
+            return _bool(cur & self.size_mask == self.const(0))
+        elif cmd == '$p':
+            parity = z3.Extract(0, 0, cur)
+            for i in range(1, 8):
+                parity = parity ^ z3.Extract(i, i, cur)
+            return z3.ZeroExt(63, ~parity)
+        elif cmd == '$c':
+            mask = self.const(genmask(bit))
+            return _bool(z3.ULT(cur & mask, old & mask))
+        elif cmd == '$b':
+            mask = self.const(genmask(bit - 1))
+            return _bool(z3.ULT(old & mask, cur & mask))
+        elif cmd == '$s':
+            return z3.LShR(cur, self.const(bit)) & self.const(1) if bit < 64 else self.const(0)
+        elif cmd == '$o':
+            m0, m1 = self.const(genmask(bit & 0x3f)), self.const(genmask((bit + 0x3f) & 0x3f))
+            return _bool(z3.Xor(z3.ULT(cur & m0, old & m0), z3.ULT(cur & m1, old & m1)))
+        elif cmd == '$r':
+            return self.const(8)
+        raise EsilError(f'{cmd} is not supported in symbolic lowering')
+
+def _constant(value, cmd):
+    value = z3.simplify(value)
+    if not z3.is_bv_value(value):
+        raise EsilError(f'{cmd}: operand is not constant')
+    return value.as_long()
+
+flag_operators = {'$c', '$b', '$s', '$o'}
+
+def _operate(state, cmd, a, b):
+    if cmd in binary_operators and b is not None:
+        return binary_operators[cmd](a, b)
+    elif cmd in comparison_operators and b is not None:
+        state.set_flags(a, a - b)
+        return _bool(comparison_operators[cmd](a, b))
+    elif cmd in unary_operators:
+        return unary_operators[cmd](a)
+    elif cmd in peek_operators:
+        size = peek_operators[cmd]
+        value = state.load(a, size)
+        state.set_size(size * 8)
+        return value
+    elif cmd in flag_operators:
+        return state.flag(cmd, _constant(a, cmd))
+    elif cmd == 'NUM':
+        return a
+    raise EsilError(f'{cmd} is not supported in symbolic lowering')
+
+def _compare(state, a, b, dst):
+    state.set_flags(a, a - b, dst.bits if isinstance(dst, Register) else None)
+
+def _assign(state, cmd, reg, src):
+    old = state.read(reg)
+    if cmd in unary_update_operators:
+        new = unary_update_operators[cmd](old)
+    elif src is None:
+        raise EsilError(f'{cmd}: stack underflow')
+    elif cmd in update_operators:
+        new = update_operators[cmd](old, src)
+    else:
+        new = src
+    new = new & state.const(reg.mask)
+    state.write(reg, new)
+    if cmd != ':=':
+        state.set_flags(old, new, reg.bits)
+
+def _memory_update(state, cmd, addr, src):
+    if cmd in poke_operators:
+        if src is None:
+            raise EsilError(f'{cmd}: stack underflow')
+        state.store(addr, poke_operators[cmd], src)
+        return
+
+    size = memory_update_operators[cmd][1]
+    op = cmd[:cmd.index('[')]
+    old = state.load(addr, size)
+    if op in unary_update_operators:
+        new = unary_update_operators[op](old)
+    elif src is None:
+        raise EsilError(f'{cmd}: stack underflow')
+    else:
+        new = update_operators[op](old, src)
+    new = new & state.const(genmask(size * 8 - 1))
+    state.store(addr, size, new)
+    state.set_flags(old, new, size * 8)
+
+def _is_value(node):
+    ''' true for subtrees that only compute a value, the tree nests whatever
+    follows a statement that pushes nothing under the next operator '''
+    if node is None or node.is_leaf:
+        return True
+    cmd = node.token.cmd
+    return ((cmd in binary_operators or cmd in comparison_operators or cmd in unary_operators
+             or cmd in peek_operators or cmd in flag_operators or cmd == 'NUM')
+            and _is_value(node.op1) and _is_value(node.op2))
+
+def lower_value(state, node):
+    ''' z3 term of a value subtree, memoized per node until the state changes '''
+    value = state.memo.get(node)
+    if value is not None:
+        return value
+
+    token = node.token
+    cmd = token.cmd
+    if token.kind == TOKEN_INTEGER:
+        value = state.const(token.value)
+    elif token.kind == TOKEN_VARIABLE:
+        value = state.read(register(cmd))
+    elif cmd in ('$z', '$p', '$r'):
+        value = state.flag(cmd)
+    elif node.op1 is None:
+        raise EsilError(f'{cmd} is not supported in symbolic lowering')
+    else:
+        # op2 was pushed first and is evaluated first
+        b = lower_value(state, node.op2) if node.op2 is not None else None
+        value = _operate(state, cmd, lower_value(state, node.op1), b)
+
+    state.memo[node] = value
+    return value
+
+def _lower_statement(state, stack, node):
+    ''' a statement whose operands are plain values, False otherwise '''
+    cmd = node.token.cmd
+    if not (_is_value(node.op1) and _is_value(node.op2)):
+        return False
+
+    if cmd == '==':
+        b = lower_value(state, node.op2)
+        dst = node.op1
+        _compare(state, lower_value(state, dst), b,
+                 register(dst.token.cmd) if dst.token.kind == TOKEN_VARIABLE and dst.is_leaf else None)
+    elif cmd in ('=', ':=') or cmd in update_operators or cmd in unary_update_operators:
+        dst = node.op1
+        if dst is None or dst.token.kind != TOKEN_VARIABLE or not dst.is_leaf:
+            return False
+        src = lower_value(state, node.op2) if node.op2 is not None else None
+        _assign(state, cmd, register(dst.token.cmd), src)
+    elif cmd in poke_operators or cmd in memory_update_operators:
+        if node.op1 is None:
+            return False
+        src = lower_value(state, node.op2) if node.op2 is not None else None
+        _memory_update(state, cmd, lower_value(state, node.op1), src)
+    elif _is_value(node):
+        stack.append(lower_value(state, node))
+    else:
+        return False
+    return True
+
+def _lower_tokens(state, stack, node):
+    ''' the statement token by token on the value stack, the slow path '''
+    for op in _postorder(node, []):
+        token = op.token
+        cmd = token.cmd
+
+        def pop_value():
+            if not stack:
+                raise EsilError(f'{cmd}: stack underflow')
+            item = stack.pop()
+            return state.read(item) if isinstance(item, Register) else item
+
+        if token.kind == TOKEN_INTEGER:
+            stack.append(state.const(token.value))
+        elif token.kind == TOKEN_VARIABLE:
+            stack.append(register(cmd))
+        elif cmd in ('$z', '$p', '$r'):
+            stack.append(state.flag(cmd))
+        elif cmd == '==':
+            dst = stack[-1] if stack else None
+            a = pop_value()
+            _compare(state, a, pop_value(), dst)
+        elif cmd in ('=', ':=') or cmd in update_operators or cmd in unary_update_operators:
+            if not stack or not isinstance(stack[-1], Register):
+                raise EsilError(f'{cmd}: destination is not a register')
+            reg = stack.pop()
+            _assign(state, cmd, reg, None if cmd in unary_update_operators else pop_value())
+        elif cmd in poke_operators or cmd in memory_update_operators:
+            addr = pop_value()
+            unary = cmd in memory_update_operators and cmd[:cmd.index('[')] in unary_update_operators
+            _memory_update(state, cmd, addr, None if unary else pop_value())
+        elif cmd in binary_operators or cmd in comparison_operators:
+            a = pop_value()
+            stack.append(_operate(state, cmd, a, pop_value()))
+        elif (cmd in unary_operators or cmd in peek_operators or cmd in flag_operators
+              or cmd == 'NUM'):
+            stack.append(_operate(state, cmd, pop_value(), None))
+        elif cmd == 'DUP':
+            stack.append(stack[-1])
+        elif cmd == 'POP':
+            stack.pop()
+        elif cmd == 'CLEAR':
+            stack.clear()
+        elif cmd != 'STACK':
+            raise EsilError(f'{cmd} is not supported in symbolic lowering')
+
+def lower(tree, state=None, ctx=None):
+    ''' runs an expression symbolically on state (a fresh one by default).
+    Every ?{ condition ends up in state.conditions, in order, as a
+    bit-vector that is non-zero when the block is entered. Raises EsilError
+    for what can't be lowered (GOTO, BREAK, interrupts, ...) '''
+    if isinstance(tree, str):
+        tree = parse_esil(tree)
+    elif not isinstance(tree, EsilExpressionTree):
+        raise Exception('Expression type not recognized.')
+    if state is None:
+        state = EsilZ3State(ctx)
+
+    stack = list()
+    blocks = list()     # (guard outside the block, condition)
+    for node in _statements(tree.root):
+        cmd = node.token.cmd
+
+        if cmd == '?{' and node.is_leaf:
+            if not stack:
+                raise EsilError('?{: stack underflow')
+            cond = stack.pop()
+            if isinstance(cond, Register):
+                cond = state.read(cond)
+            state.conditions.append(cond)
+            blocks.append((state.guard, cond))
+            state.guard = z3.And(state.guard, cond != 0)
+        elif cmd == '}{' and node.is_leaf:
+            if not blocks:
+                raise EsilError('}{ without ?{')
+            outer, cond = blocks[-1]
+            state.guard = z3.And(outer, cond == 0)
+        elif cmd == '}' and node.is_leaf:
+            if not blocks:
+                raise EsilError('} without ?{')
+            state.guard = blocks.pop()[0]
+        elif not _lower_statement(state, stack, node):
+            _lower_tokens(state, stack, node)
+
+    if blocks:
+        raise EsilError('unterminated ?{')
+    return state
+
+class EsilSolver:
+    ''' one incremental z3 solver shared by every query of a run.
+
+    block() opens a push/pop scope for the facts (assume()) that hold across
+    the instructions of a basic block, every query runs in its own nested
+    scope on top of it. Answers are cached by the id of the simplified
+    predicate: z3 hash-conses terms per context, so equal ids are equal
+    predicates, and obfuscators reuse the same few shapes over and over.
+    The cache keeps the maxsize most recently used answers. '''
+    def __init__(self, ctx=None, timeout=None, maxsize=4096):
+        if z3 is None:
+            raise ImportError('z3-solver is required for symbolic lowering')
+
+        self.ctx = ctx or z3.main_ctx()
+        self.solver = z3.Solver(ctx=self.ctx)
+        if timeout is not None:
+            self.solver.set('timeout', timeout)
+        self.facts = [()]
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._hits = self._misses = self._solver_calls = 0
+
+    def info(self):
+        return QueryInfo(self._hits, self._misses, self._solver_calls, self.maxsize,
+                         len(self._cache))
+
+    def clear(self):
+        self._cache.clear()
+        self._hits = self._misses = self._solver_calls = 0
+
+    def state(self):
+        return EsilZ3State(self.ctx)
+
+    @contextmanager
+    def block(self):
+        self.solver.push()
+        self.facts.append(self.facts[-1])
+        try:
+            yield self
+        finally:
+            self.facts.pop()
+            self.solver.pop()
+
+    def assume(self, fact):
+        fact = z3.simplify(fact)
+        self.solver.add(fact)
+        # the term is kept alive with its id so the id can't be reused
+        self.facts[-1] = self.facts[-1] + ((fact.get_id(), fact),)
+
+    def _satisfiable(self, predicate):
+        self._solver_calls += 1
+        self.solver.push()
+        try:
+            self.solver.add(predicate)
+            return self.solver.check()
+        finally:
+            self.solver.pop()
+
+    def branch(self, cond):
+        ''' ALWAYS or NEVER when the condition (a bit-vector, non-zero
+        means taken) can't change under the current facts, None otherwise '''
+        taken = z3.simplify(cond != 0)
+        key = (tuple(id_ for id_, _ in self.facts[-1]), taken.get_id())
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self._hits += 1
+            return cached[0]
+        self._misses += 1
+
+        if z3.is_true(taken):
+            result = ALWAYS
+        elif z3.is_false(taken):
+            result = NEVER
+        elif self._satisfiable(z3.Not(taken)) == z3.unsat:
+            result = ALWAYS
+        elif self._satisfiable(taken) == z3.unsat:
+            result = NEVER
+        else:
+            result = None
+        self._cache[key] = (result, taken, self.facts[-1])
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return result
+
+_solver = None
+
+def default_solver():
+    ''' the process-wide solver, its bounded query cache outlives single functions '''
+    global _solver
+    if _solver is None:
+        _solver = EsilSolver(timeout=1000)
+    return _solver
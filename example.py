@@ -1,8 +1,12 @@
-import r2pipe
+import json
 import sys
 import logging
 
-from esil import EsilExpressionTree
+from esil import EsilPatternSet, parse_esil
+from esil_dataflow import FunctionDataflow
+from esil_eval import EsilError, _statements
+from esil_simplify import simplify_esil
+from esil_z3 import ALWAYS, NEVER, default_solver, lower, z3
 
 logger = logging.getLogger('iopnuke')
 logging.basicConfig()
@@ -17,6 +21,13 @@ class BasicBlock:
     def addr(self):
         return self.info['addr']
 
+    @property
+    def size(self):
+        return self.info.get('size', 0)
+
+    def __contains__(self, addr):
+        return self.addr <= addr < self.addr + self.size
+
 class Function:
     def __init__(self, r2, addr):
         self.r2 = r2
@@ -24,45 +35,182 @@ class Function:
 
     @property
     def bbs(self):
-        return list([BasicBlock(bb, self.r2.get_bb_instrs(bb['addr']))
-                     for bb in self.r2.get_fcn_bbs(self.addr)])
+        return self.r2.get_fcn(self.addr)
+
+def _addr(item):
+    # radare2 moved from 'offset' to 'addr' in its json output at some point
+    return item['addr'] if 'addr' in item else item['offset']
+
+def _blocks_from_graph(graph):
+    ''' agfj output -> BasicBlock list with pdbj-like instructions '''
+    bbs = list()
+    for fcn in graph or ():
+        for block in fcn.get('blocks', ()):
+            info = {k: v for k, v in block.items() if k != 'ops'}
+            info['addr'] = _addr(block)
+            instrs = list()
+            for op in block.get('ops', ()):
+                if 'offset' not in op:
+                    op['offset'] = _addr(op)
+                instrs.append(op)
+            bbs.append(BasicBlock(info, instrs))
+    return bbs
 
 class Radare2SimpleApi:
+    patch_ops = {'nop': 'nop', 'jmp': 'nocj'}
+
     def __init__(self, r2):
         self._r2 = r2
+        self._fcns = dict()
+
+    def _cmd(self, cmd):
+        return self._r2.cmd(cmd)
+
+    def _cmdj(self, cmd):
+        return self._r2.cmdj(cmd)
 
     def get_fcn_bbs(self, addr):
-        return self._r2.cmdj(f'abj @{addr}')
+        return self._cmdj(f'abj @{addr}')
 
     def get_bb_instrs(self, addr):
-        return self._r2.cmdj(f'pdbj @{addr}')
+        return self._cmdj(f'pdbj @{addr}')
 
     def get_opcodes(self, addr, count=1):
-        return self._r2.cmdj('f aoj {count} @{addr}')
+        return self._cmdj('f aoj {count} @{addr}')
+
+    def get_hashes(self):
+        return self._cmdj('itj') or dict()
+
+    def get_fcns(self):
+        return self._cmdj('aflj') or list()
+
+    def get_fcn(self, addr):
+        ''' basic blocks with their instructions, one agfj per function '''
+        bbs = self._fcns.get(addr)
+        if bbs is None:
+            bbs = self._fcns[addr] = _blocks_from_graph(self._cmdj(f'agfj @{addr}'))
+        return bbs
+
+    def load_all_fcns(self):
+        ''' pulls every function of the binary with a single command '''
+        output = self._cmd('agfj @@F')
+        decoder = json.JSONDecoder()
+        pos = 0
+        while True:
+            while pos < len(output) and output[pos].isspace():
+                pos += 1
+            if pos >= len(output):
+                break
+            graph, pos = decoder.raw_decode(output, pos)
+            if graph:
+                self._fcns[_addr(graph[0])] = _blocks_from_graph(graph)
+        return self._fcns
+
+    def preload(self, addr, bbs):
+        self._fcns[addr] = bbs
+
+    def invalidate(self, addr):
+        if not isinstance(addr, int):
+            self._fcns.clear()
+            return
+        for fcn_addr, bbs in list(self._fcns.items()):
+            if any(addr in bb for bb in bbs):
+                del self._fcns[fcn_addr]
 
     def patch_nop(self, addr):
-        return self._r2.cmd(f'wao nop @{addr}')
+        self.invalidate(addr)
+        return self._cmd(f'wao nop @{addr}')
 
     def patch_jmp(self, addr):
-        return self._r2.cmd(f'wao nocj @{addr}')
+        self.invalidate(addr)
+        return self._cmd(f'wao nocj @{addr}')
+
+    def apply_patches(self, patches):
+        ''' (kind, addr) pairs, 'nop' or 'jmp', sent as a single command '''
+        cmds = list()
+        for kind, addr in patches:
+            self.invalidate(addr)
+            cmds.append(f'wao {self.patch_ops[kind]} @{addr}')
+        return self._cmd(';'.join(cmds)) if cmds else ''
+
+def _as_api(r2):
+    return r2 if isinstance(r2, Radare2SimpleApi) else Radare2SimpleApi(r2)
 
 class IOPnuke:
+    jcc_patterns = EsilPatternSet(['zf,?{,any,rip,=,}', 'zf,!,?{,any,rip,=,}'])
+
     def __init__(self, r2, addr):
-        self.function = Function(Radare2SimpleApi(r2), addr)
+        self.function = Function(_as_api(r2), addr)
+        self.predicates = list()
+        self.patches = list()
 
-    def run(self):
+    def run(self, apply=True):
+        solver = default_solver() if z3 is not None else None
         for bb in self.function.bbs:
-            mem_writes = dict()
-            cmps = list()
-            for instr in bb.instrs:
-                et = EsilExpressionTree(instr['esil'])
-                for address, write in et.analyses.memory_write_catcher.mem_writes.items():
-                    mem_writes[address] = write
-                cmps += et.analyses.compare_catcher.cmps
-
-                if et.search('zf,?{,any,rip,=,}') or et.search('zf,!,?{,any,rip,=,}'):
-                    logger.info(f"je|jne detected! 0x{instr['offset']:x}, last cmp: {cmps[-1]}")
-                # TODO eliminate invariant opaque predicate if exists
+            if solver is None:
+                self.run_block(bb, None, None, apply)
+                continue
+            with solver.block():
+                self.run_block(bb, solver, solver.state(), apply)
+
+    def run_block(self, bb, solver, state, apply):
+        mem_writes = dict()
+        cmps = list()
+        for instr in bb.instrs:
+            # junk arithmetic is gone before searching and solving
+            et = parse_esil(simplify_esil(instr['esil']))
+            for address, write in et.analyses.memory_write_catcher.mem_writes.items():
+                mem_writes[address] = write
+            cmps += et.analyses.compare_catcher.cmps
+
+            conditions = 0
+            if state is not None:
+                conditions = len(state.conditions)
+                try:
+                    lower(et, state)
+                except EsilError:
+                    state.havoc()
+                    del state.conditions[conditions:]
+                # radare2 doesn't end blocks at calls, and the callee may
+                # change any register, the flags and memory
+                if self.is_call(instr, et):
+                    state.havoc()
+
+            if any(et.search_all(self.jcc_patterns)):
+                last_cmp = cmps[-1] if cmps else None
+                logger.info(f"je|jne detected! 0x{instr['offset']:x}, last cmp: {last_cmp}")
+                self.predicates.append((instr['offset'], str(last_cmp)))
+                if state is not None and len(state.conditions) > conditions:
+                    self.eliminate(instr['offset'], solver.branch(state.conditions[-1]), apply)
+
+    def is_call(self, instr, et):
+        ''' by the op type, or rip assigned outside any ?{ block, which
+        catches jmp and ret as well, but those end the block anyway '''
+        if 'type' in instr:
+            return instr['type'].endswith('call')
+        depth = 0
+        for node in _statements(et.root):
+            cmd = node.token.cmd
+            if node.is_leaf and cmd == '?{':
+                depth += 1
+            elif node.is_leaf and cmd == '}':
+                depth -= 1
+            elif not depth and cmd == '=' and node.op1 is not None and node.op1.cmd == 'rip':
+                return True
+        return False
+
+    def eliminate(self, offset, branch, apply):
+        ''' an always taken jcc becomes a jmp, a never taken one a nop '''
+        if branch == ALWAYS:
+            kind = 'jmp'
+        elif branch == NEVER:
+            kind = 'nop'
+        else:
+            return
+        logger.info(f'invariant predicate at 0x{offset:x}, {kind}')
+        self.patches.append((kind, offset))
+        if apply:
+            getattr(self.function.r2, f'patch_{kind}')(offset)
 
     def is_invariant_cmp(self, node, mem_writes):
         return (node.op2.is_integer and
@@ -70,40 +218,42 @@ class IOPnuke:
                 mem_writes[node.op1.op1].is_integer)
 
 class UnusedStackNuke:
+    ''' nops stack writes nothing reads before the slot is written again
+    or the function returns '''
     def __init__(self, r2, addr):
-        self.function = Function(Radare2SimpleApi(r2), addr)
+        self.function = Function(_as_api(r2), addr)
+        self.predicates = list()
+        self.patches = list()
+        self.dataflow = None
 
-    def run(self):
-        stack_var_writes = dict()
-        stack_var_reads = list()
-        for bb in self.function.bbs:
-            for instr in bb.instrs:
-                et = EsilExpressionTree(instr['esil'])
-                for address, value in et.analyses.memory_write_catcher.mem_writes.items():
-                    if not address.is_leaf and address.op1.cmd == "rbp":
-                        logger.info(f'memory write {address} <- {value}')
-                        stack_var_writes[address] = instr['offset']
-                for mem_read in et.analyses.memory_read_catcher.mem_reads:
-                    if not address.is_leaf and address.op1.cmd == "rbp":
-                        stack_var_reads.append(mem_read)
-
-        for mem_write in stack_var_writes:
-            if mem_write not in stack_var_reads:
-                logger.info(f'Found unused stack var at 0x{stack_var_writes[mem_write]:x}')
-                self.function.r2.patch_nop(stack_var_writes[mem_write])
+    def run(self, apply=True):
+        self.dataflow = FunctionDataflow(self.function.bbs)
+        dead = self.dataflow.dead_stores()
+        while dead:
+            for offset in dead:
+                logger.info(f'Found unused stack var at 0x{offset:x}')
+                self.patches.append(('nop', offset))
+                if apply:
+                    self.function.r2.patch_nop(offset)
+            # the writes are gone, which can only free more of them
+            self.dataflow.nop(*dead)
+            dead = self.dataflow.dead_stores()
 
 if __name__ == '__main__':
+    import r2pipe
+
     r2 = r2pipe.open()
     r2.cmd('e io.cache=True')
+    api = Radare2SimpleApi(r2)
 
     if len(sys.argv) > 1:
-        iop = IOPnuke(r2, sys.argv[1])
+        iop = IOPnuke(api, sys.argv[1])
     else:
-        iop = IOPnuke(r2, int(r2.cmd('s'), 16))
+        iop = IOPnuke(api, int(r2.cmd('s'), 16))
     iop.run()
 
     if len(sys.argv) > 1:
-        usn = UnusedStackNuke(r2, sys.argv[1])
+        usn = UnusedStackNuke(api, sys.argv[1])
     else:
-        usn = UnusedStackNuke(r2, int(r2.cmd('s'), 16))
+        usn = UnusedStackNuke(api, int(r2.cmd('s'), 16))
     usn.run()
@@ -0,0 +1,58 @@
+import json
+import sys
+import time
+
+def main(argv):
+    ''' stands in for `r2 -q0 binary` where no radare2 is around: the
+    "binary" is a RecordedR2 json and commands are answered from it,
+    unknown ones with nothing. Options, before the path:
+
+        --delay PREFIX=SECONDS   sleep before answering commands starting with PREFIX
+        --log PATH               append every command received to PATH
+    '''
+    delays = list()
+    log_path = None
+    args = argv[1:]
+    while args and args[0].startswith('--'):
+        option, value = args[0], args[1]
+        if option == '--delay':
+            prefix, _, seconds = value.rpartition('=')
+            delays.append((prefix, float(seconds)))
+        elif option == '--log':
+            log_path = value
+        else:
+            raise Exception(f'unknown option {option}')
+        args = args[2:]
+    with open(args[0]) as f:
+        responses = json.load(f)
+    if log_path is None:
+        serve(responses, delays, None)
+    else:
+        with open(log_path, 'a') as log:
+            serve(responses, delays, log)
+
+def serve(responses, delays, log):
+    out = sys.stdout.buffer
+    # the banner r2 -q0 ends with
+    out.write(b'\0')
+    out.flush()
+    for line in sys.stdin.buffer:
+        cmd = line.decode().rstrip('\r\n')
+        if cmd.startswith('q'):
+            break
+        if log is not None:
+            log.write(cmd + '\n')
+            log.flush()
+        answers = list()
+        # r2 runs ;-separated commands one after the other
+        for part in cmd.split(';'):
+            for prefix, seconds in delays:
+                if part.startswith(prefix):
+                    time.sleep(seconds)
+            answer = responses.get(part, '')
+            answers.append(answer if isinstance(answer, str) else json.dumps(answer))
+        out.write(''.join(answers).encode() + b'\0')
+        out.flush()
+
+if __name__ == '__main__':
+    main(sys.argv)
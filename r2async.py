@@ -0,0 +1,271 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+from driver import analyze_function, default_passes
+from example import Radare2SimpleApi, _addr, _blocks_from_graph
+
+logger = logging.getLogger('r2async')
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+class R2Session:
+    ''' one radare2 process spoken to like r2pipe does: `r2 -q0 binary`,
+    commands are lines on stdin, every answer (and the banner) ends with a
+    NUL byte.
+
+    Commands are pipelined: each one is written as soon as it is issued and
+    answers are matched to them in order by a reader task, so radare2 always
+    has the next command queued while the caller works on the last answer. '''
+    def __init__(self, argv):
+        self.argv = list(argv)
+        self.commands = 0
+        self._process = None
+        self._reader = None
+        self._pending = deque()
+
+    @property
+    def load(self):
+        return len(self._pending)
+
+    async def start(self):
+        self._process = await asyncio.create_subprocess_exec(
+            *self.argv, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            # whole-binary answers (agfj @@F) run to megabytes
+            limit=1 << 30)
+        # the banner
+        await self._process.stdout.readuntil(b'\0')
+        self._reader = asyncio.ensure_future(self._read())
+        return self
+
+    async def _read(self):
+        stdout = self._process.stdout
+        error = None
+        try:
+            while True:
+                answer = await stdout.readuntil(b'\0')
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(answer[:-1].decode(errors='replace'))
+        except Exception as e:
+            # radare2 exiting ends the stream, anything else the reader
+            # can't get past ends the session just the same
+            error = Exception(f'r2 session {self.argv} ended')
+            error.__cause__ = e
+        finally:
+            # nobody is left to answer these, cancelled reader included
+            while self._pending:
+                future = self._pending.popleft()
+                if future.done():
+                    continue
+                if error is None:
+                    future.cancel()
+                else:
+                    future.set_exception(error)
+
+    async def cmd(self, cmd):
+        if self._process is None or self._reader.done():
+            raise Exception('r2 session is not running')
+        future = asyncio.get_running_loop().create_future()
+        # queued and written with no await in between, answers come in this order
+        self._pending.append(future)
+        self._process.stdin.write(cmd.encode() + b'\n')
+        self.commands += 1
+        await self._process.stdin.drain()
+        return await future
+
+    async def cmdj(self, cmd):
+        answer = await self.cmd(cmd)
+        return json.loads(answer) if answer.strip() else None
+
+    async def quit(self):
+        if self._process is None:
+            return
+        if self._process.returncode is None:
+            self._process.stdin.write(b'q!!\n')
+            self._process.stdin.close()
+            try:
+                await asyncio.wait_for(self._process.wait(), 5)
+            except asyncio.TimeoutError:
+                self._process.kill()
+                await self._process.wait()
+        # None when the banner never came
+        if self._reader is not None:
+            await self._reader
+        self._process = None
+
+class R2Pool:
+    ''' r2 sessions by binary, sessions_per_binary of each, started on
+    first use. Commands go to the session with the fewest answers
+    outstanding. argv maps a binary to the command line to run. '''
+    def __init__(self, sessions_per_binary=1, argv=lambda binary: ('r2', '-q0', binary)):
+        self.sessions_per_binary = sessions_per_binary
+        self.argv = argv
+        self._sessions = dict()
+        self._starting = dict()
+
+    async def sessions(self, binary):
+        sessions = self._sessions.get(binary)
+        if sessions is None:
+            starting = self._starting.get(binary)
+            if starting is None:
+                starting = self._starting[binary] = asyncio.ensure_future(self._start(binary))
+            try:
+                sessions = self._sessions[binary] = await starting
+            finally:
+                self._starting.pop(binary, None)
+        return sessions
+
+    async def _start(self, binary):
+        sessions = [R2Session(self.argv(binary)) for _ in range(self.sessions_per_binary)]
+        started = await asyncio.gather(*(session.start() for session in sessions),
+                                       return_exceptions=True)
+        errors = [e for e in started if isinstance(e, BaseException)]
+        if errors:
+            # the ones that did start would be left running otherwise
+            await asyncio.gather(*(session.quit() for session in sessions),
+                                 return_exceptions=True)
+            raise errors[0]
+        return sessions
+
+    async def cmd(self, binary, cmd):
+        sessions = await self.sessions(binary)
+        return await min(sessions, key=lambda session: session.load).cmd(cmd)
+
+    async def cmdj(self, binary, cmd):
+        answer = await self.cmd(binary, cmd)
+        return json.loads(answer) if answer.strip() else None
+
+    async def broadcast(self, binary, cmd):
+        ''' cmd on every session of binary, writes have to be seen by all '''
+        sessions = await self.sessions(binary)
+        return await asyncio.gather(*(session.cmd(cmd) for session in sessions))
+
+    async def close(self):
+        sessions = [session for sessions in self._sessions.values() for session in sessions]
+        self._sessions.clear()
+        await asyncio.gather(*(session.quit() for session in sessions))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+class AsyncRadare2Api:
+    ''' Radare2SimpleApi over a pool, for one binary. Reads go to any of
+    its sessions, patches to all of them. '''
+    patch_ops = Radare2SimpleApi.patch_ops
+
+    def __init__(self, pool, binary):
+        self.pool = pool
+        self.binary = binary
+        self._fcns = dict()
+
+    async def _cmd(self, cmd):
+        return await self.pool.cmd(self.binary, cmd)
+
+    async def _cmdj(self, cmd):
+        return await self.pool.cmdj(self.binary, cmd)
+
+    async def setup(self, *cmds):
+        ''' commands every session needs, e io.cache=true and the like '''
+        for cmd in cmds:
+            await self.pool.broadcast(self.binary, cmd)
+
+    async def get_fcn_bbs(self, addr):
+        return await self._cmdj(f'abj @{addr}')
+
+    async def get_bb_instrs(self, addr):
+        return await self._cmdj(f'pdbj @{addr}')
+
+    async def get_hashes(self):
+        return await self._cmdj('itj') or dict()
+
+    async def get_fcns(self):
+        return await self._cmdj('aflj') or list()
+
+    async def get_fcn(self, addr):
+        bbs = self._fcns.get(addr)
+        if bbs is None:
+            bbs = self._fcns[addr] = _blocks_from_graph(await self._cmdj(f'agfj @{addr}'))
+        return bbs
+
+    def invalidate(self, addr):
+        if not isinstance(addr, int):
+            self._fcns.clear()
+            return
+        for fcn_addr, bbs in list(self._fcns.items()):
+            if any(addr in bb for bb in bbs):
+                del self._fcns[fcn_addr]
+
+    async def _patch(self, cmd, addr):
+        self.invalidate(addr)
+        answers = await self.pool.broadcast(self.binary, cmd)
+        return answers[0]
+
+    async def patch_nop(self, addr):
+        return await self._patch(f'wao nop @{addr}', addr)
+
+    async def patch_jmp(self, addr):
+        return await self._patch(f'wao nocj @{addr}', addr)
+
+    async def apply_patches(self, patches):
+        cmds = list()
+        for kind, addr in patches:
+            self.invalidate(addr)
+            cmds.append(f'wao {self.patch_ops[kind]} @{addr}')
+        if not cmds:
+            return ''
+        answers = await self.pool.broadcast(self.binary, ';'.join(cmds))
+        return answers[0]
+
+async def analyze_binary(pool, binary, passes=default_passes, max_functions=8, apply=True):
+    ''' runs the passes on every function of binary. At most max_functions
+    are fetched or analyzed at once; while one is being analyzed the agfj
+    of the others is already queued in radare2. Patches are applied in one
+    batch at the end. '''
+    api = AsyncRadare2Api(pool, binary)
+    limit = asyncio.Semaphore(max_functions)
+
+    async def function(addr):
+        async with limit:
+            bbs = await api.get_fcn(addr)
+            # the passes are synchronous, the other functions' commands are
+            # in flight meanwhile
+            return analyze_function(addr, [(bb.info, bb.instrs) for bb in bbs], passes)
+
+    start = time.perf_counter()
+    fcns = await api.get_fcns()
+    results = await asyncio.gather(*(function(_addr(fcn)) for fcn in fcns))
+    results = sorted(results, key=lambda result: result.addr)
+    logger.debug(f'{binary}: {len(results)} functions in {time.perf_counter() - start:.3f}s')
+
+    patches = sorted({patch for result in results for patch in result.patches},
+                     key=lambda patch: patch[1])
+    if apply and patches:
+        await api.apply_patches(patches)
+    return results
+
+async def analyze_binaries(binaries, passes=default_passes, sessions_per_binary=1,
+                           max_functions=8, apply=True, argv=None, setup=('e io.cache=true',)):
+    ''' binary -> FunctionResult list, every binary analyzed concurrently '''
+    pool = R2Pool(sessions_per_binary, **({'argv': argv} if argv is not None else {}))
+    async with pool:
+        async def one(binary):
+            await AsyncRadare2Api(pool, binary).setup(*setup)
+            return await analyze_binary(pool, binary, passes, max_functions, apply)
+        results = await asyncio.gather(*(one(binary) for binary in binaries))
+    return dict(zip(binaries, results))
+
+if __name__ == '__main__':
+    import sys
+
+    from driver import report
+
+    # python r2async.py binary [binary ...]
+    for binary, results in asyncio.run(analyze_binaries(sys.argv[1:])).items():
+        logger.info(binary)
+        report(results)
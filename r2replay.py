@@ -0,0 +1,45 @@
+import json
+
+class RecordedR2:
+    ''' r2pipe stand-in answering commands from recorded output '''
+    def __init__(self, responses):
+        self.responses = responses
+        self.commands = list()
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def cmd(self, cmd):
+        self.commands.append(cmd)
+        response = self.responses.get(cmd, '')
+        return response if isinstance(response, str) else json.dumps(response)
+
+    def cmdj(self, cmd):
+        response = self.cmd(cmd)
+        return json.loads(response) if response else None
+
+    def quit(self):
+        pass
+
+class RecordingR2:
+    ''' wraps a live r2pipe and remembers every answer, for RecordedR2 '''
+    def __init__(self, r2):
+        self._r2 = r2
+        self.responses = dict()
+
+    def cmd(self, cmd):
+        response = self.responses[cmd] = self._r2.cmd(cmd)
+        return response
+
+    def cmdj(self, cmd):
+        response = self.cmd(cmd)
+        return json.loads(response) if response else None
+
+    def quit(self):
+        self._r2.quit()
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.responses, f)
@@ -0,0 +1,78 @@
+import pytest
+
+from esil import (EsilExpressionTree, EsilNodeTable, EsilParseCache, EsilPatternSet, _match,
+                  preorder)
+from esil_analysis import Analysis, CompareCatcher
+from esil_corpus import X86_64_CORPUS, EsilGenerator
+
+class UseCatcher(Analysis):
+    pure = True
+    operators = {'=='}
+
+    def init(self):
+        self.seen = list()
+
+    def node_pass(self, node):
+        self.seen.append(str(node))
+
+def test_cached_trees_run_their_own_analyses():
+    cache = EsilParseCache()
+    catcher = UseCatcher()
+    first = cache.get('1,rax,==', {'uses': catcher})
+    second = cache.get('2,rbx,==', {'uses': catcher})
+    assert first.analyses.uses is not catcher
+    assert first.analyses.uses.seen == ['1,rax,==']
+    assert second.analyses.uses.seen == ['2,rbx,==']
+
+def test_hits_share_the_tree():
+    cache = EsilParseCache()
+    tree = cache.get('1,rax,==', {'uses': UseCatcher()})
+    assert cache.get('1,rax,==', {'uses': UseCatcher()}) is tree
+    assert cache.get('1,rax,==') is not tree
+    assert cache.info.hits == 1 and cache.info.misses == 2
+
+def test_impure_analyses_are_not_cached():
+    cache = EsilParseCache()
+    catcher = CompareCatcher()
+    catcher.pure = False
+    tree = cache.get('1,rax,==', {'cmps': catcher})
+    assert tree.analyses.cmps is catcher
+    assert '1,rax,==' not in cache and len(cache) == 0
+
+def corpus_expressions(seed=0):
+    generator = EsilGenerator(seed)
+    return X86_64_CORPUS + generator.generate(500, nested=20, unrolled=20)
+
+PATTERNS = ['zf,?{,any,rip,=,}', 'zf,!,?{,any,rip,=,}', 'any,any,==', 'any,0x4,rbp,-,=[4]',
+            'any,any,rbp,-,[8]', '1,any,+=[4]', '8,rsp,+=', 'rsp,[8]', '0,any,==', 'any']
+
+@pytest.mark.parametrize('indexed', [True, False], ids=['tree', 'root'])
+def test_search_all_finds_what_a_full_scan_finds(indexed):
+    patterns = EsilPatternSet(PATTERNS)
+    for expr in corpus_expressions():
+        tree = EsilExpressionTree(expr)
+        found = tree.search_all(patterns) if indexed else patterns.search(tree.root)
+        expected = [next((node for node in preorder(tree.root) if _match(node, pattern.root)), None)
+                    for pattern in patterns.patterns]
+        assert all(a is b for a, b in zip(found, expected)), expr
+
+def test_equal_subtrees_share_a_node():
+    table = EsilNodeTable()
+    root = EsilExpressionTree('rax,rbx,+,rax,rbx,+,*', node_table=table).root
+    assert root.op1 is root.op2
+    other = EsilExpressionTree('rax,rbx,+,rcx,=', node_table=table).root
+    assert other.op2 is root.op1
+    assert EsilExpressionTree('rax,rbx,+', node_table=table).root is root.op1
+    assert EsilExpressionTree('rax,rbx,+').root is not root.op1
+
+def test_integers_are_equal_by_value():
+    hex_, dec = EsilExpressionTree('0x8,rbp,-').root, EsilExpressionTree('8,rbp,-').root
+    assert hex_ == dec and hash(hex_) == hash(dec)
+    assert hex_ != EsilExpressionTree('9,rbp,-').root
+    assert EsilExpressionTree('0x8,rbp,-,[8]').search('8,rbp,-') is not None
+
+def test_repr_round_trips():
+    for expr in corpus_expressions():
+        root = EsilExpressionTree(expr).root
+        assert repr(root) == expr
+        assert EsilExpressionTree(repr(root)).root == root
@@ -0,0 +1,113 @@
+import pytest
+
+from esil import parse_esil
+from esil_dataflow import FunctionDataflow, stack_offset
+from example import BasicBlock
+
+STORE = 'rdi,0x8,rbp,-,=[8]'
+LOAD = '0x8,rbp,-,[8],rax,='
+RET = 'rsp,[8],rip,=,8,rsp,+='
+CALL = 'rip,8,rsp,-=,rsp,=[8],0x2000,rip,='
+
+def block(addr, *esils, **info):
+    ''' instructions 4 bytes apart, esil strings or (esil, type) pairs '''
+    instrs = list()
+    for i, esil in enumerate(esils):
+        esil, kind = esil if isinstance(esil, tuple) else (esil, None)
+        instr = {'offset': addr + 4 * i, 'esil': esil, 'size': 4}
+        if kind is not None:
+            instr['type'] = kind
+        instrs.append(instr)
+    return BasicBlock(dict(info, addr=addr, size=4 * len(esils)), instrs)
+
+def switch(*cases, **info):
+    return dict(info, switchop={'cases': [{'jump': case} for case in cases]})
+
+def test_store_read_by_a_switch_case_is_live():
+    bbs = [block(0x10, STORE, 'rax,rip,=', **switch(0x20, 0x30)),
+           block(0x20, LOAD, RET),
+           block(0x30, RET)]
+    dataflow = FunctionDataflow(bbs)
+    assert dataflow.succs[0x10] == [0x20, 0x30]
+    assert dataflow.dead_stores() == []
+
+def test_store_no_switch_case_reads_is_dead():
+    bbs = [block(0x10, STORE, 'rax,rip,=', **switch(0x20, 0x30)),
+           block(0x20, RET),
+           block(0x30, RET)]
+    assert FunctionDataflow(bbs).dead_stores() == [0x10]
+
+@pytest.mark.parametrize('info', [
+    # unresolved indirect jump, no successors and no ret
+    dict(),
+    # a case radare2 couldn't resolve
+    {'switchop': {'cases': [{'jump': 0x20}, {}]}},
+    # a jump out of the function
+    {'jump': 0x1000},
+], ids=['indirect', 'unresolved case', 'outside'])
+def test_unknown_successors_keep_everything_live(info):
+    bbs = [block(0x10, STORE, 'rax,rip,=', **info),
+           block(0x20, RET)]
+    dataflow = FunctionDataflow(bbs)
+    assert dataflow.dead_stores() == []
+    assert ('rbp', -8) in dataflow.live(0x10)[1]
+
+@pytest.mark.parametrize('ret', [RET, (RET, 'ret')], ids=['esil', 'type'])
+def test_stores_are_dead_at_ret(ret):
+    assert FunctionDataflow([block(0x10, STORE, ret)]).dead_stores() == [0x10]
+
+def test_call_without_successors_is_not_an_exit():
+    # a noreturn call or one radare2 ended the function at, the stores may
+    # still be read through rbp by whatever runs next
+    bbs = [block(0x10, STORE, (CALL, 'call'))]
+    assert FunctionDataflow(bbs).dead_stores() == []
+
+def test_call_inside_a_block_reads_escaped_slots():
+    bbs = [block(0x10, STORE, '0x8,rbp,-,rdi,=', (CALL, 'call'), RET)]
+    assert FunctionDataflow(bbs).dead_stores() == []
+    bbs = [block(0x10, STORE, (CALL, 'call'), RET)]
+    assert FunctionDataflow(bbs).dead_stores() == [0x10]
+
+def test_negative_displacements_are_the_same_slot():
+    assert stack_offset(parse_esil('0xfffffffffffffff8,rbp,+').root) == -8
+    assert stack_offset(parse_esil('0x8,rbp,-').root) == -8
+    assert stack_offset(parse_esil('0x100000000,rbp,+').root) is None
+    bbs = [block(0x10, STORE, '0xfffffffffffffff8,rbp,+,[8],rax,=', RET)]
+    assert FunctionDataflow(bbs).dead_stores() == []
+
+def chain(length):
+    ''' a store in the first block, a straight line of blocks after it '''
+    bbs = [block(0x1000, STORE, 'rsi,rax,=', jump=0x1008)]
+    for i in range(1, length):
+        addr = 0x1000 + 8 * i
+        info = {'jump': addr + 8} if i < length - 1 else {}
+        bbs.append(block(addr, 'rax,rbx,=', RET if i == length - 1 else 'rbx,rcx,=', **info))
+    return bbs
+
+def state(dataflow, names):
+    ''' names: locations to compare, a nopped instruction's operands are
+    only known to the dataflow that saw them '''
+    return ({addr: tuple(live & names for live in dataflow.live(addr)) for addr in dataflow.order},
+            {addr: set(dataflow.reaching(addr)) for addr in dataflow.order},
+            dataflow.dead_stores())
+
+def test_nop_only_solves_what_changes():
+    dataflow = FunctionDataflow(chain(400))
+    assert dataflow.dead_stores() == [0x1000]
+    visits = dataflow.visits
+    dataflow.nop(0x1000)
+    assert dataflow.visits - visits <= 4
+    assert dataflow.dead_stores() == []
+
+@pytest.mark.parametrize('offsets', [(0x1000,), (0x1004,), (0x1008, 0x1014), (0x1000, 0x1004)])
+def test_nop_matches_solving_from_scratch(offsets):
+    dataflow = FunctionDataflow(chain(20))
+    dataflow.nop(*offsets)
+    bbs = chain(20)
+    for bb in bbs:
+        for instr in bb.instrs:
+            if instr['offset'] in offsets:
+                instr['esil'] = ''
+    fresh = FunctionDataflow(bbs)
+    names = set(fresh.names)
+    assert state(dataflow, names) == state(fresh, names)
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+import esil_eval
+from esil import parse_esil
+from esil_corpus import REGISTERS64, X86_64_CORPUS, EsilGenerator
+from esil_eval import EsilError, EsilMachine, compile_tree
+
+# a flag computed after an operation that only runs under a condition
+GUARDED = [
+    '0x100000000,eax,==,rcx,?{,1,rdx,=,},$z,zf,:=',
+    '0x100000000,eax,==,rcx,?{,1,edx,+=,},$z,zf,:=,31,$s,sf,:=',
+    'rcx,?{,0xff,0x8,rbp,-,+=[1],}{,rax,rbx,-=,},$z,zf,:=,$p,pf,:=,63,$c,cf,:=',
+]
+
+def expressions(seed=0, count=2000):
+    generated = EsilGenerator(seed).generate(count, nested=50, unrolled=500)
+    return X86_64_CORPUS + GUARDED + generated
+
+def random_registers(rng):
+    return {name: rng.getrandbits(64) for name in REGISTERS64 + ('rbp', 'rsp', 'rflags')}
+
+def generic_program(expr, monkeypatch):
+    ''' the same expression with no statement fused, one closure per token '''
+    with monkeypatch.context() as patch:
+        patch.setattr(esil_eval, '_compile_statement', lambda node: None)
+        return compile_tree(parse_esil(expr))
+
+def outcome(run):
+    try:
+        run()
+    except EsilError as e:
+        return type(e)
+
+def machine_state(machine):
+    return machine.regs, machine.memory, (machine.old, machine.cur, machine.lastsz)
+
+def test_fused_statements_match_the_stack_machine(monkeypatch):
+    rng = random.Random(0)
+    for expr in expressions():
+        registers = random_registers(rng)
+        fused, generic = EsilMachine(registers), EsilMachine(registers)
+        program = generic_program(expr, monkeypatch)
+        assert (outcome(lambda: fused.execute(expr))
+                == outcome(lambda: generic.run(program))), expr
+        assert machine_state(fused) == machine_state(generic), expr
+
+@pytest.mark.parametrize('rcx, zf', [(0, 1), (1, 0)])
+def test_guarded_flag_width(rcx, zf):
+    machine = EsilMachine({'rax': 0, 'rcx': rcx})
+    machine.execute(GUARDED[0])
+    assert machine.get_register('zf') == zf
+
+def test_division_by_zero_traps():
+    machine = EsilMachine({'rax': 1, 'rbx': 0})
+    with pytest.raises(esil_eval.EsilTrap):
+        machine.execute('rbx,rax,/=')
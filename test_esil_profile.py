@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+import esil
+import esil_analysis
+import example
+from esil import parse_cache
+from esil_profile import Profiler
+from esil_simplify import simplify_esil
+from example import IOPnuke, Radare2SimpleApi
+from r2replay import RecordedR2
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'synthetic_x86_64.json')
+
+PATCHED = [(esil, 'tokenize'), (esil.EsilExpressionTree, '_parse'),
+           (esil.EsilExpressionTreeNode, '__init__'), (esil.EsilExpressionTree, 'search'),
+           (esil.EsilExpressionTree, 'search_all'),
+           (esil_analysis.AnalysisEngine, '_build_dispatch'),
+           (esil_analysis.AnalysisEngine, 'fini_analyses'),
+           (example.Radare2SimpleApi, '_cmd'), (example.Radare2SimpleApi, '_cmdj')]
+
+@pytest.fixture
+def profiler():
+    profiler = Profiler()
+    yield profiler
+    profiler.disable()
+
+def originals():
+    return [owner.__dict__[attr] for owner, attr in PATCHED]
+
+def test_disable_restores_everything(profiler):
+    before = originals()
+    profiler.enable()
+    assert profiler.enabled
+    assert all(patched is not original for patched, original in zip(originals(), before))
+    profiler.disable()
+    assert not profiler.enabled
+    assert all(restored is original for restored, original in zip(originals(), before))
+
+def analyze(profiler, api, addrs):
+    parse_cache.clear()
+    simplify_esil.cache_clear()
+    profiler.enable()
+    try:
+        for addr in addrs:
+            with profiler.function(addr):
+                IOPnuke(api, addr).run(apply=False)
+    finally:
+        profiler.disable()
+
+def test_calls_are_counted_per_function(profiler):
+    api = Radare2SimpleApi(RecordedR2.load(CORPUS))
+    addrs = [fcn['offset'] for fcn in api.get_fcns()][:2]
+    analyze(profiler, api, addrs)
+
+    assert profiler.functions() == addrs
+    for addr in addrs:
+        calls = {entry.name: entry.calls for entry in profiler.report(addr)}
+        assert calls['r2 agfj'] == 1
+        assert calls['parse'] == calls['tokenize'] > 0
+        assert calls['node'] > calls['parse']
+        assert any(name.endswith('.node_pass') for name in calls)
+        assert any(name.endswith('.fini') for name in calls)
+
+    # the whole run is the sum of its functions
+    everything = {entry.name: entry.calls for entry in profiler.report()}
+    for name, calls in everything.items():
+        assert calls == sum(entry.calls for addr in addrs
+                            for entry in profiler.report(addr) if entry.name == name)
+    assert all(line.startswith(f'fcn.{addrs[0]:x};') or line.startswith(f'fcn.{addrs[1]:x};')
+               for line in profiler.folded().splitlines())
+
+def test_nothing_is_counted_once_disabled(profiler):
+    api = Radare2SimpleApi(RecordedR2.load(CORPUS))
+    addr = api.get_fcns()[0]['offset']
+    analyze(profiler, api, [addr])
+    totals = {key: tuple(value) for key, value in profiler.totals.items()}
+    IOPnuke(api, addr).run(apply=False)
+    parse_cache.clear()
+    esil.parse_esil('1,rax,+=')
+    assert {key: tuple(value) for key, value in profiler.totals.items()} == totals
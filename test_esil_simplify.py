@@ -0,0 +1,70 @@
+import random
+
+import pytest
+
+from benchmark import obfuscate
+from esil import EsilExpressionTree, parse_esil
+from esil_corpus import REGISTERS64, X86_64_CORPUS, EsilGenerator
+from esil_eval import EsilError, EsilMachine
+from esil_simplify import EsilSimplifier
+
+def simplify(expr):
+    # equal integers share a node, a fresh tree and table keep the spelling
+    return str(EsilSimplifier().simplify_tree(EsilExpressionTree(expr)).root)
+
+@pytest.mark.parametrize('expr, simplified', [
+    # k2 + (base - k1) and k2 + (base + k1)
+    ('0x8,rbp,-,0x4,+', '0x4,rbp,-'),
+    ('0x8,rsp,+,0x8,+', '0x10,rsp,+'),
+    ('0x10,rbp,-,0x4,+,[4],rax,=', '0xc,rbp,-,[4],rax,='),
+    ('0x4,rbp,-,0x4,+', 'rbp'),
+    ('0x4,rbp,+,0x8,+', '0xc,rbp,+'),
+    # 4 - (rbp - 4) is no offset of rbp
+    ('0x4,rbp,-,0x4,-', '0x4,rbp,-,0x4,-'),
+])
+def test_offsets_merge(expr, simplified):
+    assert simplify(expr) == simplified
+
+@pytest.mark.parametrize('expr, simplified', [
+    ('0,rax,+,rbx,=', 'rax,rbx,='),
+    ('rax,0,+,rbx,=', 'rax,rbx,='),
+    ('rax,rax,-,rbx,=', '0,rbx,='),
+    ('rax,rax,^,rbx,=', '0,rbx,='),
+    ('rax,rax,&,rbx,=', 'rax,rbx,='),
+    ('0,rax,*,rbx,=', '0,rbx,='),
+    ('1,rax,*,rbx,=', 'rax,rbx,='),
+    ('zf,!,!,!,?{,1,rax,=,}', 'zf,!,?{,1,rax,=,}'),
+    ('zf,!,!,?{,1,rax,=,}', 'zf,?{,1,rax,=,}'),
+    ('2,3,+,rax,=', '5,rax,='),
+    # traps are kept
+    ('0,1,/,rax,=', '0,1,/,rax,='),
+    # and so is the size == takes from its op1
+    ('0,eax,eax,&,==,$z,zf,:=', '0,eax,eax,&,==,$z,zf,:='),
+    ('0,eax,==,$z,zf,:=', '0,eax,==,$z,zf,:='),
+])
+def test_identities(expr, simplified):
+    assert simplify(expr) == simplified
+
+def expressions(seed=0, count=2000):
+    obfuscated = [obfuscate(expr, seed) for seed in range(20) for expr in X86_64_CORPUS]
+    generated = EsilGenerator(seed).generate(count, nested=50, unrolled=500)
+    return X86_64_CORPUS + obfuscated + generated + [obfuscate(expr) for expr in generated]
+
+def outcome(machine, expr):
+    try:
+        machine.execute(expr)
+    except EsilError as e:
+        return type(e)
+
+def machine_state(machine):
+    return machine.regs, machine.memory, (machine.old, machine.cur, machine.lastsz)
+
+def test_simplified_runs_like_the_original():
+    rng = random.Random(0)
+    simplifier = EsilSimplifier()
+    for expr in expressions():
+        simplified = str(simplifier.simplify_tree(parse_esil(expr)).root)
+        registers = {name: rng.getrandbits(64) for name in REGISTERS64 + ('rbp', 'rsp', 'rflags')}
+        original, rewritten = EsilMachine(registers), EsilMachine(registers)
+        assert outcome(original, expr) == outcome(rewritten, simplified), (expr, simplified)
+        assert machine_state(original) == machine_state(rewritten), (expr, simplified)
@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+import driver
+import esil_store
+from esil import parse_esil
+from esil_dataflow import AccessCatcher
+from esil_store import EsilStore, code_version
+from esil_simplify import simplify_esil
+from r2replay import RecordedR2
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'synthetic_x86_64.json')
+
+EXPRS = ['rdi,0x18,rbp,-,=[8]', '0x4,rbp,-,[4],rax,=', '0x8,rbp,-,rdi,=',
+         '1,eax,+=,31,$o,of,:=,31,$s,sf,:=,$z,zf,:=', 'rax,0xfffffffffffffff8,rbp,+,=[8]']
+
+def catch(expr):
+    return parse_esil(expr, {'access_catcher': AccessCatcher()}).analyses.access_catcher
+
+def stored_events(catcher):
+    # register uses come back without their node
+    return [(kind, location, None if kind == 'use' and isinstance(location, str) else extra)
+            for kind, location, extra in catcher.events]
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'binary.esil')
+
+def fill(store):
+    for addr, expr in enumerate(EXPRS):
+        store.add_text('simplify', expr, simplify_esil(expr), addr=addr)
+        store.add_analysis(expr, catch(expr), addr=addr)
+
+def test_round_trip(path):
+    store = EsilStore(path)
+    fill(store)
+    store.save()
+    store.close()
+
+    store = EsilStore(path)
+    assert len(store) == 2 * len(EXPRS)
+    for addr, expr in enumerate(EXPRS):
+        assert store.get_text('simplify', expr, addr=addr) == simplify_esil(expr)
+        stored = store.get_analysis(expr, AccessCatcher, addr=addr)
+        assert stored.events == stored_events(catch(expr))
+        assert stored.escaped == catch(expr).escaped
+    assert store.get_text('simplify', EXPRS[0], addr=1) is None
+    assert store.get_text('other', EXPRS[0], addr=0) is None
+    assert store.hits == 2 * len(EXPRS) and store.misses == 2
+    store.close()
+
+def test_pending_entries_are_found_before_saving(path):
+    store = EsilStore(path)
+    with store.function(3):
+        store.add_text('simplify', EXPRS[0], 'x')
+        assert store.get_text('simplify', EXPRS[0]) == 'x'
+    assert store.get_text('simplify', EXPRS[0]) is None
+
+def test_another_code_version_is_thrown_away(path):
+    store = EsilStore(path, version=b'a' * 16)
+    fill(store)
+    store.save()
+    store.close()
+
+    store = EsilStore(path, version=b'b' * 16)
+    assert store.invalidated
+    assert len(store) == 0
+    assert store.get_text('simplify', EXPRS[0], addr=0) is None
+
+def test_another_format_is_thrown_away(path, monkeypatch):
+    store = EsilStore(path)
+    fill(store)
+    store.save()
+    store.close()
+
+    version = code_version()
+    monkeypatch.setattr(esil_store, 'FORMAT_VERSION', esil_store.FORMAT_VERSION + 1)
+    assert code_version() != version
+    store = EsilStore(path, version=version)
+    assert store.invalidated
+    assert len(store) == 0
+
+def test_warm_open_only_maps_the_file(path, monkeypatch):
+    store = EsilStore(path)
+    fill(store)
+    store.save()
+    store.close()
+
+    reads = list()
+
+    class File:
+        def __init__(self, f):
+            self.f = f
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return self.f.__exit__(*exc)
+
+        def __getattr__(self, name):
+            if name.startswith('read'):
+                reads.append(name)
+            return getattr(self.f, name)
+
+    def spy(name, mode):
+        # code_version() reads the module sources, only the store matters
+        return File(open(name, mode)) if name == path else open(name, mode)
+
+    monkeypatch.setattr(esil_store, 'open', spy, raising=False)
+    store = EsilStore(path)
+    assert not store.invalidated and len(store) == 2 * len(EXPRS)
+    assert store.get_text('simplify', EXPRS[1], addr=1) == simplify_esil(EXPRS[1])
+    assert reads == []
+    store.close()
+
+def test_driver_results_are_the_same_warm(tmp_path):
+    simplify_esil.cache_clear()
+    cold = driver.analyze_binary(RecordedR2.load(CORPUS), workers=1, apply=False,
+                                 cache_dir=str(tmp_path))
+    stored, = tmp_path.iterdir()
+    written = stored.stat().st_mtime_ns
+    simplify_esil.cache_clear()
+    warm = driver.analyze_binary(RecordedR2.load(CORPUS), workers=1, apply=False,
+                                 cache_dir=str(tmp_path))
+    # everything was found, nothing new to save
+    assert stored.stat().st_mtime_ns == written
+    assert [result.patches for result in warm] == [result.patches for result in cold]
+    assert [result.predicates for result in warm] == [result.predicates for result in cold]
@@ -0,0 +1,54 @@
+import io
+import os
+import threading
+
+import pytest
+
+from esil_stream import read_lines, stream_trace
+
+# longer than the buffer below, so lines cross the chunks reads come in
+LINES = ['0x1000 rdi,0x8,rbp,-,=[8]\n', '\n', '# a comment\n',
+         '0x1004 0x8,rbp,-,[8],rax,=,' + ','.join(['1,rax,+='] * 20) + '\n',
+         'rsp,[8],rip,=,8,rsp,+=']
+TEXT = ''.join(LINES)
+
+@pytest.fixture
+def trace(tmp_path):
+    path = tmp_path / 'trace.esil'
+    path.write_bytes(TEXT.encode())
+    return path
+
+@pytest.mark.parametrize('kind', [str, os.fsencode, lambda path: path], ids=['str', 'bytes', 'path'])
+def test_paths_are_mapped(trace, kind):
+    assert list(read_lines(kind(trace), buffer_size=16)) == LINES
+
+def test_file_objects(trace):
+    with open(trace, 'rb', buffering=16) as f:
+        assert list(read_lines(f)) == LINES
+    assert list(read_lines(io.BytesIO(TEXT.encode()))) == LINES
+    assert list(read_lines(io.StringIO(TEXT))) == LINES
+
+def test_pipes_are_read():
+    r, w = os.pipe()
+
+    def write():
+        with os.fdopen(w, 'wb') as f:
+            f.write(TEXT.encode())
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        assert list(read_lines(f'/dev/fd/{r}', buffer_size=16)) == LINES
+    finally:
+        writer.join()
+        os.close(r)
+
+def test_empty_files_are_read(tmp_path):
+    path = tmp_path / 'empty.esil'
+    path.write_bytes(b'')
+    assert list(read_lines(str(path))) == []
+
+def test_records_skip_blank_lines_and_comments(trace):
+    records = list(stream_trace(str(trace)))
+    assert [(record.lineno, record.offset) for record in records] == [(1, 0x1000), (4, 0x1004),
+                                                                      (5, None)]
+    assert str(records[-1].tree.root) == LINES[-1]
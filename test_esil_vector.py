@@ -0,0 +1,74 @@
+import random
+import re
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from esil_corpus import REGISTERS64, X86_64_CORPUS, EsilGenerator
+from esil_eval import EsilError, EsilTrap, EsilMachine
+from esil_vector import evaluate, invariant_value
+
+GUARDED = [
+    '0x100000000,eax,==,rcx,?{,1,rdx,=,},$z,zf,:=',
+    '0x100000000,eax,==,rcx,?{,1,edx,+=,},$z,zf,:=,31,$s,sf,:=',
+    'rcx,?{,0xff,0x8,rbp,-,+=[1],}{,rax,rbx,-=,},$z,zf,:=,$p,pf,:=,63,$c,cf,:=',
+]
+NAMES = REGISTERS64 + ('rbp', 'rsp', 'rflags')
+LANES = 8
+
+def expressions(seed=0, count=500):
+    generated = EsilGenerator(seed).generate(count, nested=50, unrolled=250)
+    return X86_64_CORPUS + GUARDED + generated
+
+def random_lanes(rng):
+    lanes = [{name: rng.getrandbits(64) for name in NAMES} for _ in range(LANES)]
+    # half of them skip the guarded blocks and compare equal
+    for lane in lanes[:LANES // 2]:
+        lane['rcx'] = 0
+        lane['rax'] = rng.choice((0, 1 << 32))
+    return lanes
+
+def test_lanes_match_the_machine():
+    rng = random.Random(0)
+    for expr in expressions():
+        lanes = random_lanes(rng)
+        state = evaluate(expr, {name: np.array([lane[name] for lane in lanes], dtype=np.uint64)
+                                for name in NAMES}).state
+        for i, registers in enumerate(lanes):
+            machine = EsilMachine(registers)
+            try:
+                machine.execute(expr)
+            except EsilTrap:
+                assert state.trapped[i], expr
+                continue
+            assert not state.trapped[i], expr
+            for name in set(machine.regs) | set(state.regs):
+                assert int(state.get_register(name)[i]) == machine.get_register(name), (expr, name)
+            for addr in set(machine.memory) | set(state.memory):
+                byte = int(state.memory[addr][i]) if addr in state.memory else 0
+                assert byte == machine.memory.get(addr, 0), (expr, addr)
+            assert ((int(state.old[i]), int(state.cur[i]), int(state.lastsz[i]))
+                    == (machine.old, machine.cur, machine.lastsz)), expr
+
+def test_guarded_flag_width_per_lane():
+    result = evaluate(GUARDED[0], {'rax': 0, 'rcx': np.array([0, 1], dtype=np.uint64)})
+    assert result.state.get_register('zf').tolist() == [1, 0]
+
+def test_memory_division_by_zero_traps():
+    result = evaluate('rcx,0x8,rbp,-,/=[4]', {'rbp': 0x1000, 'rcx': np.array([0, 2], dtype=np.uint64)})
+    assert result.trapped.tolist() == [True, False]
+
+@pytest.mark.parametrize('expr, message', [
+    ('1,rax,=,}{,2,rax,=,}', '}{ without ?{'),
+    ('1,rax,=,}', '} without ?{'),
+])
+def test_unopened_blocks_are_errors(expr, message):
+    for run in (EsilMachine().execute, lambda expr: evaluate(expr, {'rax': 0})):
+        with pytest.raises(EsilError, match=re.escape(message)):
+            run(expr)
+
+def test_invariant_value():
+    registers = {'rax': np.array([1, 2, 3], dtype=np.uint64)}
+    assert invariant_value('rax,rax,^=', registers, register_name='rax') == 0
+    assert invariant_value('1,rax,+=', registers, register_name='rax') is None
@@ -0,0 +1,119 @@
+import json
+import random
+
+import pytest
+
+z3 = pytest.importorskip('z3')
+
+from esil_corpus import REGISTERS64, X86_64_CORPUS, EsilGenerator
+from esil_eval import EsilMachine, EsilTrap, _flag_value
+from esil_z3 import ALWAYS, NEVER, EsilSolver, EsilZ3State, lower
+from example import IOPnuke, Radare2SimpleApi
+from r2replay import RecordedR2
+
+GUARDED = [
+    '0x100000000,eax,==,rcx,?{,1,rdx,=,},$z,zf,:=',
+    '0x100000000,eax,==,rcx,?{,1,edx,+=,},$z,zf,:=,31,$s,sf,:=',
+    'rcx,?{,0xff,0x8,rbp,-,+=[1],}{,rax,rbx,-=,},$z,zf,:=,$p,pf,:=,63,$c,cf,:=',
+]
+NAMES = REGISTERS64 + ('rbp', 'rsp', 'rflags', 'rip')
+
+def expressions(seed=0, count=200):
+    return X86_64_CORPUS + EsilGenerator(seed).generate(count, nested=50, unrolled=100)
+
+def concrete(registers):
+    ''' term -> its value on the machine's entry state: registers as given,
+    memory and the last operation all zero '''
+    substitutions = [(z3.BitVec(name, 64), z3.BitVecVal(value, 64))
+                     for name, value in registers.items()]
+    substitutions += [(z3.BitVec('old', 64), z3.BitVecVal(0, 64)),
+                      (z3.BitVec('cur', 64), z3.BitVecVal(0, 64)),
+                      (z3.Array('mem', z3.BitVecSort(64), z3.BitVecSort(8)),
+                       z3.K(z3.BitVecSort(64), z3.BitVecVal(0, 8)))]
+
+    def value(term):
+        term = z3.simplify(z3.substitute(term, *substitutions))
+        assert z3.is_bv_value(term), term
+        return term.as_long()
+    return value
+
+def check_against_machine(expr, registers):
+    machine = EsilMachine(registers)
+    try:
+        machine.execute(expr)
+    except EsilTrap:
+        # z3 defines division by zero, radare2 doesn't
+        return
+    state = lower(expr, EsilZ3State())
+    value = concrete(registers)
+    for name in set(machine.regs) | set(state.regs):
+        assert value(state.get_register(name)) == machine.get_register(name), (expr, name)
+    for addr, byte in machine.memory.items():
+        assert value(z3.Select(state.memory, z3.BitVecVal(addr, 64))) == byte, (expr, addr)
+    assert (value(state.old), value(state.cur)) == (machine.old, machine.cur), expr
+    assert value(state.flag('$z')) == _flag_value('$z')(machine), expr
+
+def test_lowering_matches_the_machine():
+    rng = random.Random(0)
+    for expr in expressions():
+        check_against_machine(expr, {name: rng.getrandbits(64) for name in NAMES})
+
+@pytest.mark.parametrize('expr', GUARDED)
+@pytest.mark.parametrize('rax, rcx', [(0, 0), (0, 1), (1 << 32, 0), (1 << 32, 7)])
+def test_guarded_flags_match_the_machine(expr, rax, rcx):
+    rng = random.Random(rax ^ rcx)
+    registers = {name: rng.getrandbits(64) for name in NAMES}
+    registers.update(rax=rax, rcx=rcx)
+    check_against_machine(expr, registers)
+
+def test_guarded_flag_width_is_not_invariant():
+    solver = EsilSolver()
+    with solver.block():
+        state = solver.state()
+        lower(GUARDED[0] + ',zf,?{,0x1000,rip,=,}', state)
+        # zf is 1 with eax=0, rcx=0 and 0 with rcx=1
+        assert solver.branch(state.conditions[-1]) is None
+
+def function(*ops):
+    ops = [dict(op, offset=0x1000 + 4 * i, size=4) for i, op in enumerate(ops)]
+    graph = [{'name': 'fcn.00001000', 'offset': 0x1000,
+              'blocks': [{'offset': 0x1000, 'size': 4 * len(ops), 'ops': ops}]}]
+    return Radare2SimpleApi(RecordedR2({'agfj @4096': json.dumps(graph)}))
+
+XOR_EAX = {'esil': 'eax,eax,^=,$z,zf,:=,$p,pf,:=,31,$s,sf,:=,0,cf,:=,0,of,:=', 'type': 'xor'}
+CMP_EAX = {'esil': '0,eax,==,$z,zf,:=,32,$b,cf,:=,$p,pf,:=,31,$s,sf,:=,31,$o,of,:=', 'type': 'cmp'}
+JE = {'esil': 'zf,?{,0x1100,rip,=,}', 'type': 'cjmp'}
+CALL = {'esil': 'rip,8,rsp,-=,rsp,=[8],0x2000,rip,=', 'type': 'call'}
+
+def test_invariant_jcc_is_patched():
+    iop = IOPnuke(function(XOR_EAX, CMP_EAX, JE), 0x1000)
+    iop.run(apply=False)
+    assert iop.patches == [('jmp', 0x1008)]
+
+@pytest.mark.parametrize('call', [CALL, {'esil': CALL['esil']}], ids=['typed', 'untyped'])
+def test_calls_forget_the_state(call):
+    iop = IOPnuke(function(XOR_EAX, call, CMP_EAX, JE), 0x1000)
+    iop.run(apply=False)
+    assert iop.patches == []
+    assert [offset for offset, _ in iop.predicates] == [0x100c]
+
+def test_never_taken_jcc_is_a_nop():
+    iop = IOPnuke(function(XOR_EAX, {'esil': '1,eax,==,$z,zf,:='}, JE), 0x1000)
+    iop.run(apply=False)
+    assert iop.patches == [('nop', 0x1008)]
+
+def test_query_cache_is_bounded():
+    solver = EsilSolver(maxsize=4)
+    rax = z3.BitVec('rax', 64)
+
+    def equals(k):
+        return z3.If(rax == k, z3.BitVecVal(1, 64), z3.BitVecVal(0, 64))
+    with solver.block():
+        solver.assume(rax == 7)
+        for k in range(10):
+            assert solver.branch(equals(k)) == (ALWAYS if k == 7 else NEVER)
+        assert solver.info().currsize == 4
+        # the most recent answers are kept, the oldest are asked again
+        solver.branch(equals(9))
+        solver.branch(equals(0))
+        assert solver.info()[:2] == (1, 11)
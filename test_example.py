@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from example import Radare2SimpleApi
+from r2replay import RecordedR2
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus', 'synthetic_x86_64.json')
+
+@pytest.fixture
+def r2():
+    return RecordedR2.load(CORPUS)
+
+def fcn_addrs(r2):
+    return [fcn['offset'] for fcn in r2.cmdj('aflj')]
+
+def test_get_fcn_is_one_command_and_cached(r2):
+    api = Radare2SimpleApi(r2)
+    addr = fcn_addrs(r2)[0]
+    del r2.commands[:]
+    bbs = api.get_fcn(addr)
+    assert api.get_fcn(addr) is bbs
+    assert r2.commands == [f'agfj @{addr}']
+    assert bbs[0].addr == addr
+    assert len(bbs) == 12
+    for bb in bbs:
+        assert bb.instrs
+        for instr in bb.instrs:
+            assert instr['offset'] in bb
+
+def test_load_all_fcns_matches_get_fcn(r2):
+    addrs = fcn_addrs(r2)
+    api = Radare2SimpleApi(r2)
+    del r2.commands[:]
+    fcns = api.load_all_fcns()
+    assert r2.commands == ['agfj @@F']
+    assert sorted(fcns) == sorted(addrs)
+
+    one_by_one = Radare2SimpleApi(RecordedR2.load(CORPUS))
+    for addr in addrs:
+        assert api.get_fcn(addr) is fcns[addr]
+        expected = one_by_one.get_fcn(addr)
+        assert [bb.info for bb in fcns[addr]] == [bb.info for bb in expected]
+        assert [bb.instrs for bb in fcns[addr]] == [bb.instrs for bb in expected]
+    assert r2.commands == ['agfj @@F']
+
+def test_apply_patches_is_one_command(r2):
+    api = Radare2SimpleApi(r2)
+    del r2.commands[:]
+    api.apply_patches([('nop', 0x401004), ('jmp', 0x402000)])
+    assert r2.commands == ['wao nop @4198404;wao nocj @4202496']
+
+def test_apply_no_patches_sends_nothing(r2):
+    api = Radare2SimpleApi(r2)
+    del r2.commands[:]
+    assert api.apply_patches([]) == ''
+    assert r2.commands == []
+
+def test_patches_invalidate_only_the_patched_function(r2):
+    api = Radare2SimpleApi(r2)
+    fcns = api.load_all_fcns()
+    first, second = fcn_addrs(r2)[:2]
+    # inside the second block of the first function
+    api.apply_patches([('nop', first + 44)])
+    assert first not in fcns
+    assert second in fcns
+
+    del r2.commands[:]
+    api.get_fcn(first)
+    api.get_fcn(second)
+    assert r2.commands == [f'agfj @{first}']
+
+def test_invalidate_outside_any_function(r2):
+    api = Radare2SimpleApi(r2)
+    api.load_all_fcns()
+    api.patch_jmp(0x10)
+    del r2.commands[:]
+    for addr in fcn_addrs(r2):
+        api.get_fcn(addr)
+    assert r2.commands == ['aflj']
+
+def test_invalidate_everything(r2):
+    api = Radare2SimpleApi(r2)
+    addr = fcn_addrs(r2)[0]
+    api.load_all_fcns()
+    api.invalidate(None)
+    del r2.commands[:]
+    api.get_fcn(addr)
+    assert r2.commands == [f'agfj @{addr}']
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import driver
+from r2async import R2Pool, R2Session, analyze_binaries
+from r2replay import RecordedR2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CORPUS = os.path.join(HERE, 'corpus', 'synthetic_x86_64.json')
+FAKE_R2 = os.path.join(HERE, 'fake_r2.py')
+
+def fake_r2(*options):
+    return lambda binary: (sys.executable, FAKE_R2, *options, binary)
+
+def recorded(cmd):
+    with open(CORPUS) as f:
+        answer = json.load(f).get(cmd, '')
+    return answer if isinstance(answer, str) else json.dumps(answer)
+
+def test_pipelined_answers_come_back_in_order():
+    addrs = [fcn['offset'] for fcn in RecordedR2.load(CORPUS).cmdj('aflj')]
+
+    async def run():
+        session = await R2Session(fake_r2('--delay', 'agfj=0.01')(CORPUS)).start()
+        try:
+            return await asyncio.gather(*(session.cmd(f'agfj @{addr}') for addr in addrs))
+        finally:
+            await session.quit()
+
+    assert asyncio.run(run()) == [recorded(f'agfj @{addr}') for addr in addrs]
+
+def test_session_end_fails_pending_commands():
+    async def run():
+        session = await R2Session(fake_r2()(CORPUS)).start()
+        try:
+            # fake_r2 exits on q without answering, aflj is never read
+            answers = await asyncio.gather(session.cmd('q'), session.cmd('aflj'),
+                                           return_exceptions=True)
+            with pytest.raises(Exception, match='not running'):
+                await session.cmd('aflj')
+            return answers
+        finally:
+            await session.quit()
+
+    for answer in asyncio.run(run()):
+        assert isinstance(answer, Exception)
+        assert 'ended' in str(answer)
+        assert isinstance(answer.__cause__, asyncio.IncompleteReadError)
+
+def test_reader_errors_fail_pending_commands(monkeypatch):
+    readuntil = asyncio.StreamReader.readuntil
+
+    async def overlong(self, separator=b'\n'):
+        data = await readuntil(self, separator)
+        if b'synthetic' in data:
+            raise asyncio.LimitOverrunError('separator is not found', len(data))
+        return data
+
+    monkeypatch.setattr(asyncio.StreamReader, 'readuntil', overlong)
+
+    async def run():
+        session = await R2Session(fake_r2('--delay', 'aflj=0.2')(CORPUS)).start()
+        try:
+            return await asyncio.wait_for(asyncio.gather(
+                session.cmd('itj'), session.cmd('aflj'), return_exceptions=True), 5)
+        finally:
+            await session.quit()
+
+    for answer in asyncio.run(run()):
+        assert isinstance(answer, Exception)
+        assert isinstance(answer.__cause__, asyncio.LimitOverrunError)
+
+def test_failed_start_quits_the_started_sessions(monkeypatch):
+    quit = R2Session.quit
+    quitted = list()
+
+    async def recording_quit(self):
+        quitted.append(self)
+        await quit(self)
+
+    monkeypatch.setattr(R2Session, 'quit', recording_quit)
+    argvs = iter([fake_r2()(CORPUS), (sys.executable, '-c', 'pass')])
+
+    async def run():
+        pool = R2Pool(2, argv=lambda binary: next(argvs))
+        with pytest.raises(asyncio.IncompleteReadError):
+            await pool.sessions(CORPUS)
+        return pool
+
+    pool = asyncio.run(run())
+    assert len(quitted) == 2
+    assert all(session._process is None for session in quitted)
+    assert not pool._sessions and not pool._starting
+
+def test_fake_r2_closes_its_log(tmp_path):
+    log = tmp_path / 'commands'
+    process = subprocess.run(
+        (sys.executable, '-W', 'always::ResourceWarning', FAKE_R2, '--log', str(log), CORPUS),
+        input=b'itj\nq\n', capture_output=True, timeout=30)
+    assert process.stderr == b''
+    assert process.stdout == b'\0' + recorded('itj').encode() + b'\0'
+    assert log.read_text() == 'itj\n'
+
+def test_analyze_binaries_matches_the_driver(tmp_path):
+    log = tmp_path / 'commands'
+    results = asyncio.run(analyze_binaries(
+        [CORPUS], sessions_per_binary=2, argv=fake_r2('--log', str(log))))[CORPUS]
+    expected = driver.analyze_binary(RecordedR2.load(CORPUS), workers=1, apply=False)
+
+    assert [result.addr for result in results] == [result.addr for result in expected]
+    assert [result.patches for result in results] == [result.patches for result in expected]
+    assert [result.predicates for result in results] == [result.predicates for result in expected]
+    commands = log.read_text().splitlines()
+    # setup and the patch batch reach both sessions, reads only one
+    assert commands.count('e io.cache=true') == 2
+    patches = [cmd for cmd in commands if cmd.startswith('wao')]
+    assert len(patches) == 2 and patches[0] == patches[1]
+    assert commands.count('aflj') == 1